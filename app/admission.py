@@ -0,0 +1,130 @@
+import asyncio
+from collections import deque
+from fastapi import status
+from fastapi.responses import JSONResponse
+from .config import settings
+from .shards import shards
+from . import metrics
+
+#Admission control: at most `capacity` requests per worker run against the database at once.
+#Capacity is held back for login and writes so a flood of reads can't starve them, the rest wait in a
+#bounded queue and get a fast 503 with Retry-After once it is full or their wait times out.
+#While threads are already queued for a pool connection (of any database) no extra requests are let in.
+
+CLASSES = ("login", "write", "read")    #also the order waiters are woken in
+WRITE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+EXEMPT_PATHS = ("/health", "/ready", "/metrics", "/docs", "/redoc", "/openapi.json")
+
+
+def classify(scope: dict) -> str:
+    if scope["path"].startswith("/login"):
+        return "login"
+    if scope["method"] in WRITE_METHODS:
+        return "write"
+    return "read"
+
+
+def exempt(scope: dict) -> bool:
+    #SSE streams are long lived and only touch the database to replay, they would pin a slot for hours
+    path = scope["path"]
+    return path in EXEMPT_PATHS or path.rstrip("/").endswith("/events")
+
+
+class AdmissionController:
+    def __init__(self, capacity: int, reserves: dict, queue_size: int, timeout: float):
+        self.capacity = capacity
+        self.reserves = reserves
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.in_flight = dict.fromkeys(CLASSES, 0)
+        self.waiters = {cls: deque() for cls in CLASSES}
+
+    def queued(self) -> int:
+        return sum(len(waiters) for waiters in self.waiters.values())
+
+    def _admissible(self, cls: str) -> bool:
+        total = sum(self.in_flight.values())
+        limit = max(total, 1) if shards.waiting() else self.capacity
+        held_back = sum(max(self.reserves.get(other, 0) - self.in_flight[other], 0) for other in CLASSES if other != cls)
+        #reserves never take the last slot, every class can always make progress
+        return total + min(held_back, self.capacity - 1) < limit
+
+    def _ahead(self, cls: str) -> bool:
+        return any(self.waiters[other] for other in CLASSES[:CLASSES.index(cls) + 1])
+
+    async def acquire(self, cls: str) -> bool:
+        if not self._ahead(cls) and self._admissible(cls):
+            self.in_flight[cls] += 1
+            return True
+
+        if self.queued() >= self.queue_size:
+            metrics.admission_rejected.inc(cls, "queue_full")
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[cls].append(future)
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+
+        except asyncio.TimeoutError:
+            metrics.admission_rejected.inc(cls, "timeout")
+            return False
+
+        except asyncio.CancelledError:
+            #client went away after being admitted but before running
+            if future.done() and not future.cancelled():
+                self.release(cls)
+            raise
+
+        finally:
+            if future in self.waiters[cls]:
+                self.waiters[cls].remove(future)
+
+    def release(self, cls: str):
+        self.in_flight[cls] -= 1
+        for waiting in CLASSES:
+            waiters = self.waiters[waiting]
+            while waiters and self._admissible(waiting):
+                future = waiters.popleft()
+                if not future.done():
+                    self.in_flight[waiting] += 1
+                    future.set_result(True)
+
+    def in_flight_gauge(self) -> dict:
+        return {(cls,): count for cls, count in self.in_flight.items()}
+
+    def queue_gauge(self) -> dict:
+        return {(cls,): len(waiters) for cls, waiters in self.waiters.items()}
+
+
+controller = AdmissionController(
+    settings.admission_capacity or settings.database_pool_size,
+    {"login": settings.admission_reserve_login, "write": settings.admission_reserve_write},
+    settings.admission_queue_size,
+    settings.admission_timeout
+)
+metrics.Gauge("admission_in_flight", "Admitted requests currently running", ("class",), controller.in_flight_gauge)
+metrics.Gauge("admission_queue_length", "Requests waiting for admission", ("class",), controller.queue_gauge)
+
+
+class AdmissionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or exempt(scope):
+            return await self.app(scope, receive, send)
+
+        cls = classify(scope)
+        if not await controller.acquire(cls):
+            response = JSONResponse(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                content={"detail": "Server is busy, retry later"},
+                headers={"Retry-After": str(settings.admission_retry_after)}
+            )
+            return await response(scope, receive, send)
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            controller.release(cls)
@@ -0,0 +1,153 @@
+from bisect import bisect_left, bisect_right
+from datetime import date
+from .database import Database
+from .shards import shards
+
+#Repair turnaround computed in SQL, for the manager dashboard (see app/routers/analytics.py).
+#wait: created_at to start_date, work: start_date to finished_date, in seconds.
+#Date ranges are start inclusive, end exclusive, over repairs and repairs_archive, each scanned by its time index.
+#The backlog is the open repairs right now, archived repairs are all completed.
+#With sharded customers every shard computes its part. Counts, averages and maxima combine exactly, the percentiles
+#are read from the merged distribution of each shard's percentiles at every half percent (GRID).
+
+PERCENTILES = [0.5, 0.9, 0.99]
+GRID = [step / 200 for step in range(201)]
+
+
+#the same select over the hot and the archived repairs
+def _all_repairs(select: str) -> str:
+    return f"({select.format(table='repairs')} UNION ALL {select.format(table='repairs_archive')})"
+
+
+TURNAROUND = f"""
+    SELECT count(*) AS repairs, count(wait) AS started, count(work) AS finished,
+           percentile_cont(%(percentiles)s::float8[]) WITHIN GROUP (ORDER BY wait) AS wait, avg(wait) AS wait_avg, max(wait) AS wait_max,
+           percentile_cont(%(percentiles)s::float8[]) WITHIN GROUP (ORDER BY work) AS work, avg(work) AS work_avg, max(work) AS work_max
+    FROM {_all_repairs(
+        "SELECT extract(epoch FROM start_date - created_at)::float8 AS wait, extract(epoch FROM finished_date - start_date)::float8 AS work "
+        "FROM {table} WHERE created_at >= %(start)s AND created_at < %(end)s"
+    )} timed
+"""
+
+THROUGHPUT = f"""
+    SELECT day::date AS day, coalesce(created.repairs, 0) AS created, coalesce(finished.repairs, 0) AS finished
+    FROM generate_series(%(start)s::timestamp, %(end)s::timestamp - interval '1 day', interval '1 day') AS day
+    LEFT JOIN (
+        SELECT date_trunc('day', created_at) AS day, count(*) AS repairs
+        FROM {_all_repairs("SELECT created_at FROM {table} WHERE created_at >= %(start)s AND created_at < %(end)s")} created_repairs
+        GROUP BY 1
+    ) created USING (day)
+    LEFT JOIN (
+        SELECT date_trunc('day', finished_date) AS day, count(*) AS repairs
+        FROM {_all_repairs("SELECT finished_date FROM {table} WHERE finished_date >= %(start)s AND finished_date < %(end)s")} finished_repairs
+        GROUP BY 1
+    ) finished USING (day)
+    ORDER BY day
+"""
+
+#age of a pending repair counts from its creation, of one in progress from its start.
+#LOCALTIMESTAMP matches the created_at default
+BACKLOG = f"""
+    SELECT count(*) FILTER (WHERE status = 'pending') AS pending,
+           count(*) FILTER (WHERE status = 'in_progress') AS in_progress,
+           percentile_cont(%(percentiles)s::float8[]) WITHIN GROUP (ORDER BY age) FILTER (WHERE status = 'pending') AS pending_age,
+           avg(age) FILTER (WHERE status = 'pending') AS pending_age_avg,
+           max(age) FILTER (WHERE status = 'pending') AS pending_age_max,
+           percentile_cont(%(percentiles)s::float8[]) WITHIN GROUP (ORDER BY age) FILTER (WHERE status = 'in_progress') AS in_progress_age,
+           avg(age) FILTER (WHERE status = 'in_progress') AS in_progress_age_avg,
+           max(age) FILTER (WHERE status = 'in_progress') AS in_progress_age_max
+    FROM (
+        SELECT status, extract(epoch FROM LOCALTIMESTAMP - CASE WHEN status = 'pending' THEN created_at ELSE coalesce(start_date, created_at) END)::float8 AS age
+        FROM repairs WHERE status IN ('pending', 'in_progress')
+    ) open
+"""
+
+
+#the rows of every shard, with the percentiles to report, or the grid to merge them from when there are several
+def _scatter(sql: str, params: dict) -> list:
+    params = {**params, "percentiles": GRID if len(shards.pools) > 1 else PERCENTILES}
+
+    def fetch(db: Database, shard: int) -> list:
+        db.cursor.execute(sql, params)
+        return db.cursor.fetchall()
+
+    return shards.scatter(fetch)
+
+
+#fraction of a shard's values below x, interpolated between its grid points
+def _grid_fraction(values: list, x: float) -> float:
+    if x < values[0]:
+        return 0.0
+    if x >= values[-1]:
+        return 1.0
+    i = bisect_right(values, x) - 1
+    return GRID[i] + (GRID[i + 1] - GRID[i]) * (x - values[i]) / (values[i + 1] - values[i])
+
+
+#percentiles of the union of the shards' values, from (count, values at GRID) of each shard
+def merge_percentiles(parts: list, percentiles: list) -> list:
+    total = sum(count for count, _ in parts)
+    points = sorted({value for _, values in parts for value in values})
+    fractions = [sum(count * _grid_fraction(values, point) for count, values in parts) / total for point in points]
+
+    merged = []
+    for percentile in percentiles:
+        i = bisect_left(fractions, percentile)
+        if i == 0 or i == len(points):
+            merged.append(points[min(i, len(points) - 1)])
+        else:
+            share = (percentile - fractions[i - 1]) / (fractions[i] - fractions[i - 1])
+            merged.append(points[i - 1] + (points[i] - points[i - 1]) * share)
+    return merged
+
+
+#`count` is the column counting the values the percentiles are over
+def _percentiles(rows: list, name: str, count: str) -> dict:
+    if len(rows) == 1:
+        row = rows[0]
+        p50, p90, p99 = row[name] or (None, None, None)
+        return {"p50": p50, "p90": p90, "p99": p99, "avg": row[f"{name}_avg"], "max": row[f"{name}_max"]}
+
+    rows = [row for row in rows if row[count]]
+    if not rows:
+        return {"p50": None, "p90": None, "p99": None, "avg": None, "max": None}
+    p50, p90, p99 = merge_percentiles([(row[count], row[name]) for row in rows], PERCENTILES)
+    values = sum(row[count] for row in rows)
+    return {
+        "p50": p50, "p90": p90, "p99": p99,
+        "avg": sum(row[f"{name}_avg"] * row[count] for row in rows) / values,
+        "max": max(row[f"{name}_max"] for row in rows),
+    }
+
+
+def turnaround(start: date, end: date) -> dict:
+    rows = [shard_rows[0] for shard_rows in _scatter(TURNAROUND, {"start": start, "end": end})]
+    return {
+        "start": start,
+        "end": end,
+        "repairs": sum(row["repairs"] for row in rows),
+        "started": sum(row["started"] for row in rows),
+        "finished": sum(row["finished"] for row in rows),
+        "wait_seconds": _percentiles(rows, "wait", "started"),
+        "work_seconds": _percentiles(rows, "work", "finished"),
+    }
+
+
+#every shard returns the same days
+def throughput(start: date, end: date) -> dict:
+    results = _scatter(THROUGHPUT, {"start": start, "end": end})
+    days = results[0]
+    for shard_days in results[1:]:
+        days = [{**day, "created": day["created"] + other["created"], "finished": day["finished"] + other["finished"]}
+                for day, other in zip(days, shard_days)]
+    return {"start": start, "end": end, "days": days}
+
+
+def backlog() -> dict:
+    rows = [shard_rows[0] for shard_rows in _scatter(BACKLOG, {})]
+    return {
+        "pending": sum(row["pending"] for row in rows),
+        "in_progress": sum(row["in_progress"] for row in rows),
+        "pending_age_seconds": _percentiles(rows, "pending_age", "pending"),
+        "in_progress_age_seconds": _percentiles(rows, "in_progress_age", "in_progress"),
+    }
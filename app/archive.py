@@ -0,0 +1,133 @@
+import argparse
+import time
+from datetime import datetime, timedelta
+from .config import settings
+from .database import Database
+from .fieldsets import columns
+from .shards import create_tables, shard_databases
+
+#Archival of closed services to the *_archive tables
+#Usage: python -m app.archive --older-than-days 365 --batch-size 1000
+#
+#A service is closed once it is older than the cutoff and every one of its repairs is completed and finished
+#before the cutoff (sales have no repairs). It moves together with its repairs and items, one batch per
+#transaction, so a service is always found complete in exactly one place. Rows are locked with SKIP LOCKED:
+#the job runs next to the app and never waits on a request. repair_events older than the cutoff are pruned.
+#With sharded customers every shard is archived in turn.
+
+ARCHIVE = {
+    "service_requests": "service_requests_archive",
+    "repairs": "repairs_archive",
+    "item_requests": "item_requests_archive",
+}
+
+
+def archive_table(table: str, archived: bool) -> str:
+    return ARCHIVE[table] if archived else table
+
+
+#one row from the hot table, or from the archive if it has been moved. Returns (row, archived)
+def fetch_one(db: Database, table: str, select: str, where: str, values: tuple) -> tuple:
+    db.cursor.execute(f"SELECT {select} FROM {table} WHERE {where}", values)
+    row = db.cursor.fetchone()
+    if row is not None:
+        return row, False
+
+    db.cursor.execute(f"SELECT {select} FROM {ARCHIVE[table]} WHERE {where}", values)
+    row = db.cursor.fetchone()
+    return row, row is not None
+
+
+def archive_batch(db: Database, cutoff: datetime, batch_size: int) -> dict:
+    service_columns = columns("service_requests")
+    db.cursor.execute(
+        "WITH batch AS ("
+        f"SELECT {service_columns} FROM service_requests service WHERE date < %s AND NOT EXISTS ("
+        "SELECT 1 FROM repairs WHERE repairs.service_id = service.id "
+        "AND (status IS DISTINCT FROM 'completed' OR finished_date IS NULL OR finished_date >= %s)"
+        ") ORDER BY date LIMIT %s FOR UPDATE SKIP LOCKED"
+        f") INSERT INTO service_requests_archive ({service_columns}) SELECT {service_columns} FROM batch RETURNING id, date",
+        (cutoff, cutoff, batch_size)
+    )
+    services = db.cursor.fetchall()
+    if not services:
+        return {}
+
+    ids = [service["id"] for service in services]
+    oldest = min(service["date"] for service in services)
+    counts = {"service_requests": len(ids)}
+
+    #children first, deleting the services would cascade them away. The date bounds prune partitions
+    for table, bound in (("repairs", ""), ("item_requests", " AND created_at >= %s")):
+        db.cursor.execute(
+            f"WITH moved AS (DELETE FROM {table} WHERE service_id = ANY(%s){bound} RETURNING {columns(table)}) "
+            f"INSERT INTO {ARCHIVE[table]} ({columns(table)}) SELECT {columns(table)} FROM moved",
+            (ids, oldest) if bound else (ids,)
+        )
+        counts[table] = db.cursor.rowcount
+
+    db.cursor.execute("DELETE FROM service_requests WHERE id = ANY(%s) AND date >= %s AND date < %s", (ids, oldest, cutoff))
+    return counts
+
+
+def prune_events(db: Database, cutoff: datetime, batch_size: int) -> int:
+    db.cursor.execute(
+        "DELETE FROM repair_events WHERE id IN (SELECT id FROM repair_events WHERE created_at < %s ORDER BY id LIMIT %s)",
+        (cutoff, batch_size)
+    )
+    return db.cursor.rowcount
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.archive", description="Move closed services, repairs and items to the archive tables")
+    parser.add_argument("--older-than-days", type=int, default=settings.archive_after_days)
+    parser.add_argument("--batch-size", type=int, default=settings.archive_batch_size)
+    parser.add_argument("--max-batches", type=int, default=None, help="stop after this many batches, default runs until nothing is left")
+    parser.add_argument("--pause", type=float, default=0.1, help="seconds between batches, leaves room for the app's own writes")
+    return parser.parse_args(argv)
+
+
+#one customer shard, --max-batches counts per shard
+def archive_shard(db: Database, label: str, args, cutoff: datetime):
+    totals = dict.fromkeys(ARCHIVE, 0)
+    batches = 0
+    while args.max_batches is None or batches < args.max_batches:
+        try:
+            counts = archive_batch(db, cutoff, args.batch_size)
+            db.conn.commit()
+        except Exception:
+            db.conn.rollback()
+            raise
+
+        if not counts:
+            break
+        batches += 1
+        for table, count in counts.items():
+            totals[table] += count
+        print(f"{label}[batch {batches}] archived " + ", ".join(f"{count} {table}" for table, count in counts.items()))
+        time.sleep(args.pause)
+
+    pruned = 0
+    while True:
+        deleted = prune_events(db, cutoff, args.batch_size)
+        db.conn.commit()
+        pruned += deleted
+        if deleted < args.batch_size:
+            break
+
+    print(f"{label}Done, everything closed before {cutoff:%Y-%m-%d}: " + ", ".join(f"{count} {table}" for table, count in totals.items())
+          + f", pruned {pruned} repair_events")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    cutoff = datetime.utcnow() - timedelta(days=args.older_than_days)
+
+    create_tables()
+    for _, label, db in shard_databases():
+        archive_shard(db, label, args, cutoff)
+        db.conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+from fastapi import HTTPException, Query, Response, status
+from typing import Optional
+from .config import settings
+
+#Batch fetch by ids: GET list endpoints take ?ids=1,2,3, POST .../batch takes {"ids": [...]} for larger sets.
+#Rows come back in the order the ids were given (duplicates dropped), ids that don't exist are reported as missing
+
+
+def unique_ids(ids: list) -> list:
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > settings.batch_max_ids:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {settings.batch_max_ids} ids per request, got {len(ids)}"
+        )
+    return ids
+
+
+#dependency for the ?ids= query parameter, None when it wasn't given
+def id_list(ids: Optional[str] = Query(None, description="Comma separated ids to fetch, in the order to return them")) -> Optional[list]:
+    if ids is None:
+        return None
+    try:
+        return unique_ids([int(value) for value in ids.split(",") if value.strip()])
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="ids must be a comma separated list of integers")
+
+
+def in_order(rows: list, ids: list) -> tuple:
+    by_id = {row["id"]: row for row in rows}
+    return [by_id[id] for id in ids if id in by_id], [id for id in ids if id not in by_id]
+
+
+#X-Missing-Ids goes on the JSONResponse of a sparse fieldset, otherwise on the injected response
+def with_missing(result, response: Response, missing: list):
+    if missing:
+        target = result if isinstance(result, Response) else response
+        target.headers["X-Missing-Ids"] = ",".join(str(id) for id in missing)
+    return result
@@ -1,5 +1,5 @@
-from pydantic import BaseModel, EmailStr
-from typing import Literal, Optional
+from pydantic import BaseModel, EmailStr, Field
+from typing import Literal, Optional, List
 
 #PYDANTIC validators
 
@@ -34,12 +34,25 @@ class ItemRequest(BaseModel):
     quantity: int
     unit_price: float
 
+class BatchIds(BaseModel):
+    ids: List[int]
+
+class VariantStock(BaseModel):
+    product_id: int
+    size: str
+    color: str
+    stock_quantity: int = Field(ge=0)
+
 
 #Token
 class Token(BaseModel):
     access_token: str
     token_type: str
     customer_id: int
+    refresh_token: Optional[str] = None
+
+class RefreshToken(BaseModel):
+    refresh_token: str
    
 class TokenData(BaseModel):
     id: Optional[int] = None
\ No newline at end of file
@@ -0,0 +1,36 @@
+import threading
+from time import monotonic
+from . import metrics
+
+#In-process TTL cache for results that are expensive to compute and fine to serve a little stale.
+#Each worker process keeps its own entries. Lookups show up in the cache_* metrics under the cache's name
+
+
+class TTLCache:
+    def __init__(self, name: str, ttl: float, max_entries: int = 256):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    #the cached value of key, or load() stored for ttl seconds. load runs outside the lock
+    def get(self, key, load):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > monotonic():
+                metrics.record_cache(self.name, True)
+                return entry[1]
+
+        metrics.record_cache(self.name, False)
+        value = load()
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (monotonic() + self.ttl, value)
+            while len(self.entries) > self.max_entries:
+                del self.entries[next(iter(self.entries))]
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,94 @@
+import asyncio
+from collections import OrderedDict
+from time import monotonic
+from .admission import exempt
+from .config import settings
+from . import metrics
+
+#Single-flight reads: concurrent identical GET/HEAD requests share one run of the handler.
+#The first request (the leader) runs normally and records the messages it sends, requests with the same key
+#that arrive meanwhile wait and replay them. With settings.coalesce_grace_ms > 0 a 200 is also replayed to
+#identical requests for that long after it finished.
+
+#headers that change the response (content negotiation) or who may see it
+KEY_HEADERS = (b"accept", b"accept-encoding", b"authorization")
+GRACE_ENTRIES = 1000
+
+
+def request_key(scope: dict) -> tuple:
+    headers = dict((name.lower(), value) for name, value in scope["headers"] if name.lower() in KEY_HEADERS)
+    return (scope["method"], scope["path"], scope["query_string"]) + tuple(headers.get(name) for name in KEY_HEADERS)
+
+
+#exports stream far too much to buffer for followers
+def coalescable(scope: dict) -> bool:
+    return (scope["type"] == "http" and scope["method"] in ("GET", "HEAD") and not exempt(scope)
+            and not scope["path"].startswith("/exports"))
+
+
+class CoalesceMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self.flights = {}
+        self.recent = OrderedDict()
+
+    async def replay(self, messages: list, send):
+        for message in messages:
+            await send(message)
+
+    def _recent(self, key):
+        entry = self.recent.get(key)
+        if entry is None:
+            return None
+        expires, messages = entry
+        if expires < monotonic():
+            del self.recent[key]
+            return None
+        return messages
+
+    def _remember(self, key, messages: list):
+        self.recent[key] = (monotonic() + settings.coalesce_grace_ms / 1000, messages)
+        self.recent.move_to_end(key)
+        while len(self.recent) > GRACE_ENTRIES:
+            self.recent.popitem(last=False)
+
+    async def __call__(self, scope, receive, send):
+        if not settings.coalesce_reads or not coalescable(scope):
+            return await self.app(scope, receive, send)
+
+        key = request_key(scope)
+        messages = self._recent(key)
+        if messages is not None:
+            metrics.record_cache("coalesce", True)
+            return await self.replay(messages, send)
+
+        flight = self.flights.get(key)
+        if flight is not None:
+            metrics.record_cache("coalesce", True)
+            try:
+                messages = await asyncio.shield(flight)
+            except Exception:
+                #the leader failed or went away without a response, run this one on its own
+                return await self.app(scope, receive, send)
+            return await self.replay(messages, send)
+
+        metrics.record_cache("coalesce", False)
+        flight = self.flights[key] = asyncio.get_running_loop().create_future()
+        messages = []
+
+        async def capture(message):
+            messages.append(message)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, capture)
+        except BaseException:
+            flight.set_exception(RuntimeError("leader request failed"))
+            flight.exception()  #mark retrieved, there may be no followers
+            raise
+        finally:
+            del self.flights[key]
+
+        flight.set_result(messages)
+        if settings.coalesce_grace_ms > 0 and messages and messages[0].get("status") == 200:
+            self._remember(key, messages)
@@ -1,4 +1,5 @@
 from pydantic_settings import BaseSettings
+from typing import Literal, Optional
 
 class Settings(BaseSettings):
     database_hostname: str  
@@ -9,6 +10,43 @@ class Settings(BaseSettings):
     secret_key: str         
     algorithm: str          
     token_minutes: int      
+    database_pool_size: int = 10        #connections per worker process
+    database_pool_warm: int = 2         #connections opened before the worker reports ready
+    database_pool_timeout: float = 10   #seconds a request waits for a free connection before a 503
+    n_plus_one_threshold: int = 10      #same statement shape executed more often than this in one request is flagged
+    bcrypt_concurrency: Optional[int] = None    #concurrent bcrypt hashes, defaults to the number of CPUs
+    slow_query_ms: float = 500                  #statements slower than this go to the slow query log, 0 disables it
+    slow_query_explain_rate: float = 0.1        #share of slow statements captured with their EXPLAIN plan
+    slow_query_log: str = "slow_queries.log"
+    slow_query_log_bytes: int = 10_000_000
+    slow_query_log_backups: int = 5
+    admission_capacity: Optional[int] = None    #requests admitted at once per worker, defaults to database_pool_size
+    admission_reserve_login: int = 1            #slots only logins may use
+    admission_reserve_write: int = 2            #slots only writes may use
+    admission_queue_size: int = 50              #requests allowed to wait for a slot, beyond that they get a 503
+    admission_timeout: float = 5                #seconds a queued request waits before a 503
+    admission_retry_after: int = 1              #Retry-After sent with the 503
+    coalesce_reads: bool = True                 #identical concurrent GETs share one handler run
+    coalesce_grace_ms: float = 0                #also replay a 200 to identical GETs for this long after it finished
+    batch_max_ids: int = 1000                   #ids accepted by one ?ids= or /batch request
+    stock_sync_max_rows: int = 50_000           #rows accepted by one stock sync request
+    export_stall_seconds: int = 60              #a CSV export whose client takes no data for this long is aborted
+    partition_months_ahead: int = 3             #monthly partitions created ahead of the current month
+    archive_after_days: int = 365               #closed services older than this are moved to the archive tables
+    archive_batch_size: int = 1000              #services moved per archive transaction
+    idempotency_ttl_hours: int = 24             #how long a stored Idempotency-Key response is replayed
+    compression_min_bytes: int = 1024           #smaller responses are sent uncompressed
+    gzip_level: int = 6
+    brotli_quality: int = 4                     #higher qualities cost far more CPU than they save on JSON
+    page_max_limit: int = 1000                  #largest ?limit= of a list endpoint
+    exact_count_threshold: int = 10_000         #?count=auto counts exactly below this estimated total
+    analytics_cache_seconds: float = 60         #repair analytics are recomputed at most this often per worker
+    analytics_max_days: int = 366               #longest date range of an analytics request
+    refresh_token_days: int = 30                #a refresh token not used within this many days expires
+    staff_token: Optional[str] = None           #X-Staff-Token of the staff routes (CSV exports, repair queue), they are closed without it
+    shard_databases: Optional[str] = None       #comma-separated customer shards ("name" or "host:port/name"), see app/shards.py
+    shard_strategy: Literal["hash", "range"] = "hash"
+    shard_range_bounds: Optional[str] = None    #range strategy: first customer id of every shard after the first, comma-separated
     
     class Config:
         env_file = ".env"
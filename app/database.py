@@ -1,60 +1,419 @@
 import psycopg2
+import re
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+from fastapi import HTTPException, status
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
 from psycopg2.extras import RealDictCursor
 from .config import settings
+from . import metrics
+from .slowlog import log_slow_query
 
-class Database:
-    def __init__(self):
+#Per-request query statistics, set by the request_timing middleware (app/middleware.py)
+current_stats: ContextVar = ContextVar("current_stats", default=None)
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%s|%\(\w+\)s")
+_whitespace = re.compile(r"\s+")
+
+#turns a statement into its shape: literals and placeholders become ?, whitespace is collapsed
+def statement_shape(query: str) -> str:
+    return _whitespace.sub(" ", _literals.sub("?", query)).strip()
+
+
+class QueryStats:
+    def __init__(self, scope: dict = None):
+        self.scope = scope or {}
+        self.count = 0
+        self.total = 0.0
+        self.slowest = (0.0, None)
+        self.shapes = {}
+        self.lock = threading.Lock()    #scatter-gather queries of app/shards.py record from several threads
+
+    #matched route template once routing happened, raw path before that
+    @property
+    def route(self) -> str:
+        route = self.scope.get("route")
+        return getattr(route, "path", None) or self.scope.get("path")
+
+    def record(self, query, duration: float):
+        shape = statement_shape(query)
+        with self.lock:
+            self.count += 1
+            self.total += duration
+            self.shapes[shape] = self.shapes.get(shape, 0) + 1
+            if duration > self.slowest[0]:
+                self.slowest = (duration, shape)
+
+    #statement shapes executed more than threshold times in the request
+    def repeated(self, threshold: int) -> dict:
+        return {shape: count for shape, count in self.shapes.items() if count > threshold}
+
+
+#Cursor that times every statement, feeds db_query_duration_seconds, the current request's QueryStats and the slow query log
+class InstrumentedCursor(RealDictCursor):
+    def execute(self, query, vars=None):
+        return self._timed(super().execute, query, vars, params=vars)
+
+    def executemany(self, query, vars_list):
+        return self._timed(super().executemany, query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._timed(super().copy_expert, sql, file, size)
+
+    def _timed(self, method, query, *args, params=None):
+        start = perf_counter()
         try:
-            self.conn = psycopg2.connect(
-                host=settings.database_hostname,
-                database=settings.database_name,
-                user=settings.database_server,
-                password=settings.database_password,
-                cursor_factory=RealDictCursor)
-            
-            self.cursor = self.conn.cursor()
-
-        except Exception as e:
-            print(f"Connetion to database failed. Error: {e}")
-
-    #altered password to handle total number of text after password hashing
-    def create_tables(self):
-        commands = (
-            """
-            DO $$
-            BEGIN
-                IF NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = 'request_type') THEN
-                    CREATE TYPE request_type AS ENUM ('sale', 'repair');
-                END IF;
+            return method(query, *args)
+        finally:
+            self._record(query, params, perf_counter() - start)
 
-                IF NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = 'status_type') THEN CREATE TYPE
-                    status_type AS ENUM ('pending', 'in_progress', 'completed');
-                END IF;
-            END$$;
-            """,
-            """
-            CREATE TABLE IF NOT EXISTS customers(
-                id SERIAL PRIMARY KEY,
-                name VARCHAR(255) NOT NULL, 
-                email VARCHAR(64) NOT NULL UNIQUE, 
-                password VARCHAR(32) NOT NULL,          
-                address VARCHAR(255) NOT NULL, 
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """,
-            """
-                CREATE TABLE IF NOT EXISTS service_requests(
-                id SERIAL PRIMARY KEY,
-                customer_id INTEGER NOT NULL,
-                total_cost FLOAT DEFAULT 0,
-                date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                type request_type,
+    def _record(self, query, params, duration: float):
+        if isinstance(query, bytes):
+            query = query.decode()
+        elif not isinstance(query, str):
+            query = query.as_string(self)
 
-                -- foreign keys --
-                FOREIGN KEY (customer_id) REFERENCES customers (id)
-                ON UPDATE CASCADE ON DELETE CASCADE
-                );
-            """,
+        metrics.db_latency.observe(duration, metrics.statement_name(query))
+        stats = current_stats.get()
+        if stats is not None:
+            stats.record(query, duration)
+
+        if duration * 1000 >= settings.slow_query_ms > 0:
+            log_slow_query(self.connection, query, statement_shape(query), params, duration, stats.route if stats else None)
+
+
+#`target` overrides host, port and database of the settings, for the customer shards of app/shards.py
+def connect(target: dict = None):
+    target = target or {}
+    return psycopg2.connect(
+        host=target.get("host", settings.database_hostname),
+        port=target.get("port", settings.database_port),
+        database=target.get("database", settings.database_name),
+        user=settings.database_server,
+        password=settings.database_password,
+        cursor_factory=InstrumentedCursor)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+#Thread-safe connection pool. Nothing connects until the first getconn() or warm_up(),
+#so importing the app never touches the database. Idle connections are reused LIFO.
+class ConnectionPool:
+    def __init__(self, size: int, timeout: float, target: dict = None):
+        self.size = size
+        self.timeout = timeout
+        self.target = target
+        self.idle = []
+        self.in_use = 0
+        self.waiting = 0
+        self.warm = False
+        self.closed = False
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def getconn(self):
+        with self.lock:
+            self.waiting += 1
+        acquired = self.slots.acquire(timeout=self.timeout)
+        with self.lock:
+            self.waiting -= 1
+            if not acquired:
+                raise PoolTimeout(f"No database connection available after {self.timeout}s")
+            conn = self.idle.pop() if self.idle else None
+            self.in_use += 1
+
+        try:
+            if conn is None or conn.closed:
+                conn = connect(self.target)
+            return conn
+
+        except Exception:
+            with self.lock:
+                self.in_use -= 1
+            self.slots.release()
+            raise
+
+    #returns the connection in a clean state, connections that lost the server are dropped
+    def putconn(self, conn):
+        try:
+            if not conn.closed:
+                status = conn.info.transaction_status
+                if status == TRANSACTION_STATUS_UNKNOWN:
+                    conn.close()
+                elif status != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+        except psycopg2.Error:
+            conn.close()
+
+        with self.lock:
+            self.in_use -= 1
+            keep = not conn.closed and not self.closed
+            if keep:
+                self.idle.append(conn)
+        if not keep and not conn.closed:
+            conn.close()
+        self.slots.release()
+
+    #opens connections until `count` are idle, the pool reports warm afterwards
+    def warm_up(self, count: int):
+        conns = []
+        try:
+            while len(conns) + len(self.idle) < min(count, self.size):
+                conns.append(self.getconn())
+        finally:
+            for conn in conns:
+                self.putconn(conn)
+        self.warm = True
+
+    def open(self):
+        with self.lock:
+            self.closed = False
+
+    def close(self):
+        with self.lock:
+            self.closed, self.warm = True, False
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+    def connection_gauges(self) -> dict:
+        with self.lock:
+            return {("in_use",): self.in_use, ("idle",): len(self.idle)}
+
+    def waiting_gauge(self) -> dict:
+        with self.lock:
+            return {(): self.waiting}
+
+
+pool = ConnectionPool(settings.database_pool_size, settings.database_pool_timeout)
+metrics.Gauge("db_pool_connections", "Database connections by state", ("state",), pool.connection_gauges)
+metrics.Gauge("db_pool_waiting", "Threads waiting for a database connection", (), pool.waiting_gauge)
+
+
+#not on a customer shard, product_variants is in the catalog database there (see app/shards.py)
+VARIANT_FOREIGN_KEY = """
+        FOREIGN KEY (product_variant_id) REFERENCES product_variants (id)
+        ON UPDATE CASCADE ON DELETE CASCADE,"""
+
+#Monthly range partitioning of service_requests (by date) and item_requests (by created_at), see app/partitions.py.
+#Rows outside every monthly partition land in the _default partition until their month is created.
+PARTITIONED_TABLES = {
+    "service_requests": """
+        CREATE TABLE IF NOT EXISTS service_requests(
+        id SERIAL,
+        customer_id INTEGER NOT NULL,
+        total_cost FLOAT DEFAULT 0,
+        date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        type request_type,
+
+        -- the partition key has to be part of the primary key
+        PRIMARY KEY (id, date),
+
+        -- foreign keys --
+        FOREIGN KEY (customer_id) REFERENCES customers (id)
+        ON UPDATE CASCADE ON DELETE CASCADE
+        ) PARTITION BY RANGE (date);
+
+        DO $$
+        BEGIN
+            -- only once partitioned, an existing table is converted by python -m app.partitions migrate
+            IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'service_requests'::regclass) THEN
+                CREATE TABLE IF NOT EXISTS service_requests_default PARTITION OF service_requests DEFAULT;
+            END IF;
+        END$$;
+    """,
+    "item_requests": f"""
+        CREATE TABLE IF NOT EXISTS item_requests (
+        id SERIAL,
+        service_id INTEGER NOT NULL,
+        product_variant_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        unit_price FLOAT NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+        PRIMARY KEY (id, created_at),
+
+        -- foreign, service_id is checked by the item_requests_check trigger{VARIANT_FOREIGN_KEY}
+
+        -- constraints, unique_request_variant is enforced by the item_requests_check trigger
+        CONSTRAINT check_positive_quantity CHECK (quantity > 0),
+        CONSTRAINT check_positive_price CHECK (unit_price >= 0)
+        ) PARTITION BY RANGE (created_at);
+
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'item_requests'::regclass) THEN
+                CREATE TABLE IF NOT EXISTS item_requests_default PARTITION OF item_requests DEFAULT;
+                CREATE INDEX IF NOT EXISTS idx_item_requests_service ON item_requests (service_id, product_variant_id);
+            END IF;
+        END$$;
+    """,
+}
+
+#`catalog` False leaves out the foreign keys into the catalog tables, for a customer shard
+def partitioned_table(table: str, catalog: bool = True) -> str:
+    return PARTITIONED_TABLES[table] if catalog else PARTITIONED_TABLES[table].replace(VARIANT_FOREIGN_KEY, "")
+
+
+#create_month_partitions(parent, from_month, months): creates the missing monthly partitions starting at from_month.
+#Rows of the new month already sitting in the default partition are moved into it first
+PARTITION_FUNCTIONS = """
+    CREATE OR REPLACE FUNCTION create_month_partitions(parent regclass, from_month date, months integer) RETURNS integer AS $$
+    DECLARE
+        key text;
+        month date;
+        next_month date;
+        partition text;
+        default_partition regclass := to_regclass(parent::text || '_default');
+        has_rows boolean;
+        created integer := 0;
+    BEGIN
+        SELECT attribute.attname INTO key
+        FROM pg_partitioned_table partitioned
+        JOIN pg_attribute attribute ON attribute.attrelid = partitioned.partrelid AND attribute.attnum = partitioned.partattrs[0]
+        WHERE partitioned.partrelid = parent;
+        IF key IS NULL THEN
+            RETURN 0;
+        END IF;
+
+        FOR i IN 0 .. months - 1 LOOP
+            month := (date_trunc('month', from_month) + make_interval(months => i))::date;
+            next_month := (month + interval '1 month')::date;
+            partition := parent::text || '_' || to_char(month, 'YYYY_MM');
+            CONTINUE WHEN to_regclass(partition) IS NOT NULL;
+
+            has_rows := false;
+            IF default_partition IS NOT NULL THEN
+                EXECUTE format('SELECT EXISTS (SELECT 1 FROM %s WHERE %I >= %L AND %I < %L)', default_partition, key, month, key, next_month)
+                INTO has_rows;
+            END IF;
+
+            IF has_rows THEN
+                -- statement triggers on the parent don't fire for the partition, nothing cascades
+                EXECUTE format('CREATE TABLE %I (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', partition, parent);
+                EXECUTE format('WITH moved AS (DELETE FROM %s WHERE %I >= %L AND %I < %L RETURNING *) INSERT INTO %I SELECT * FROM moved',
+                               default_partition, key, month, key, next_month, partition);
+                EXECUTE format('ALTER TABLE %s ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', parent, partition, month, next_month);
+            ELSE
+                EXECUTE format('CREATE TABLE %I PARTITION OF %s FOR VALUES FROM (%L) TO (%L)', partition, parent, month, next_month);
+            END IF;
+            created := created + 1;
+        END LOOP;
+        RETURN created;
+    END $$ LANGUAGE plpgsql;
+"""
+
+#Foreign keys to service_requests can't exist once it is partitioned (its primary key includes the date),
+#these triggers take their place: existence checks with FOR KEY SHARE like a foreign key, and ON DELETE CASCADE
+REFERENTIAL_TRIGGERS = """
+    CREATE OR REPLACE FUNCTION service_requests_cascade() RETURNS trigger AS $$
+    BEGIN
+        DELETE FROM repairs WHERE service_id IN (SELECT id FROM deleted);
+        DELETE FROM item_requests WHERE service_id IN (SELECT id FROM deleted);
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE TRIGGER service_requests_cascade AFTER DELETE ON service_requests
+    REFERENCING OLD TABLE AS deleted FOR EACH STATEMENT EXECUTE FUNCTION service_requests_cascade();
+
+    CREATE OR REPLACE FUNCTION repairs_service_exists() RETURNS trigger AS $$
+    BEGIN
+        PERFORM 1 FROM service_requests WHERE id = NEW.service_id FOR KEY SHARE;
+        IF NOT FOUND THEN
+            RAISE EXCEPTION 'service_requests row % referenced by repairs does not exist', NEW.service_id
+            USING ERRCODE = 'foreign_key_violation';
+        END IF;
+        RETURN NEW;
+    END $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE TRIGGER repairs_service_exists BEFORE INSERT OR UPDATE OF service_id ON repairs
+    FOR EACH ROW EXECUTE FUNCTION repairs_service_exists();
+
+    -- the service row lock serialises item inserts per service so the uniqueness check can't race.
+    -- items are never older than their service, routers rely on it to prune item_requests partitions
+    CREATE OR REPLACE FUNCTION item_requests_check() RETURNS trigger AS $$
+    DECLARE
+        service_date timestamp;
+    BEGIN
+        SELECT date INTO service_date FROM service_requests WHERE id = NEW.service_id FOR NO KEY UPDATE;
+        IF NOT FOUND THEN
+            RAISE EXCEPTION 'service_requests row % referenced by item_requests does not exist', NEW.service_id
+            USING ERRCODE = 'foreign_key_violation';
+        END IF;
+        IF NEW.created_at < service_date THEN
+            RAISE EXCEPTION 'item_requests.created_at is before the date of service %', NEW.service_id
+            USING ERRCODE = 'check_violation';
+        END IF;
+        IF EXISTS (SELECT 1 FROM item_requests WHERE service_id = NEW.service_id AND product_variant_id = NEW.product_variant_id
+                   AND id <> NEW.id AND created_at >= service_date) THEN
+            RAISE EXCEPTION 'variant % is already part of service %', NEW.product_variant_id, NEW.service_id
+            USING ERRCODE = 'unique_violation', CONSTRAINT = 'unique_request_variant';
+        END IF;
+        RETURN NEW;
+    END $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE TRIGGER item_requests_check BEFORE INSERT OR UPDATE OF service_id, product_variant_id, created_at ON item_requests
+    FOR EACH ROW EXECUTE FUNCTION item_requests_check();
+"""
+
+#Ids handed out by the customer shards: every shard uses every shards-th value (shard + 1, shard + 1 + shards, ...)
+#from above its current value, so ids stay unique across them. Customer ids come from the customer_directory
+INTERLEAVED_SEQUENCES = """
+    CREATE OR REPLACE FUNCTION interleave_sequence(seq regclass, shard integer, shards integer) RETURNS void AS $$
+    DECLARE
+        increment bigint;
+        upcoming bigint;
+        called boolean;
+    BEGIN
+        SELECT seqincrement INTO increment FROM pg_sequence WHERE seqrelid = seq;
+        EXECUTE format('SELECT last_value, is_called FROM %s', seq) INTO upcoming, called;
+        IF called THEN
+            upcoming := upcoming + increment;
+        END IF;
+        IF increment = shards AND (upcoming - shard - 1) % shards = 0 THEN
+            RETURN;
+        END IF;
+        EXECUTE format('ALTER SEQUENCE %s INCREMENT BY %s RESTART WITH %s',
+                       seq, shards, upcoming + ((shard + 1 - upcoming) % shards + shards) % shards);
+    END $$ LANGUAGE plpgsql;
+
+    SELECT interleave_sequence(pg_get_serial_sequence(name, 'id')::regclass, {shard}, {shards})
+    FROM unnest(ARRAY['service_requests', 'repairs', 'item_requests', 'repair_events', 'refresh_tokens']) AS name;
+"""
+
+#one variant per size and color of a product, the conflict target of the stock sync upsert
+UNIQUE_VARIANTS = """
+    CREATE UNIQUE INDEX IF NOT EXISTS unique_product_size_color ON product_variants (product_id, size, color);
+"""
+
+
+#the existing database needs a manual fix before create_tables can bring it up to date, retrying won't help
+class SchemaConflict(Exception):
+    pass
+
+
+#in the catalog database of a sharded setup: allocates customer ids and keeps emails unique over all shards
+CUSTOMER_DIRECTORY = """
+    CREATE TABLE IF NOT EXISTS customer_directory(
+    id SERIAL PRIMARY KEY,
+    email VARCHAR(64) NOT NULL UNIQUE
+    );
+"""
+
+
+class Database:
+    def __init__(self, conn=None, target: dict = None):
+        self.conn = conn if conn is not None else connect(target)
+        self.cursor = self.conn.cursor()
+
+    #`catalog`: products and variants, `customers`: customers and their services, repairs and items.
+    #Both by default, app/shards.py splits them over the catalog database and the customer shards
+    def create_tables(self, catalog: bool = True, customers: bool = True, shard: int = 0, shards: int = 1):
+        catalog_commands = (
             """
                 CREATE TABLE IF NOT EXISTS products(
                 id SERIAL PRIMARY KEY,
@@ -64,6 +423,11 @@ class Database:
                 stock_quantity INTEGER NOT NULL DEFAULT 0,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
 
+                -- availability derived from product_variants, kept up to date by triggers
+                total_variant_stock INTEGER NOT NULL DEFAULT 0,
+                in_stock_variant_count INTEGER NOT NULL DEFAULT 0,
+                available_sizes VARCHAR(32)[] NOT NULL DEFAULT '{}',
+
                 -- constraints
                 CONSTRAINT check_positive_price CHECK (price >= 0),
                 CONSTRAINT check_stock_positive CHECK (stock_quantity >= 0)
@@ -85,6 +449,127 @@ class Database:
                 CONSTRAINT check_variant_stock_positive CHECK (stock_quantity >= 0)
                 );
             """,
+            UNIQUE_VARIANTS,
+            """
+                -- product availability: recomputed for the products a statement touched, once per statement.
+                -- The product rows are locked first so the aggregate is read after any concurrent variant change commits
+                CREATE OR REPLACE FUNCTION refresh_product_availability(product_ids integer[]) RETURNS void AS $$
+                BEGIN
+                    PERFORM 1 FROM products WHERE id = ANY(product_ids) ORDER BY id FOR UPDATE;
+
+                    UPDATE products SET
+                        total_variant_stock = availability.total_stock,
+                        in_stock_variant_count = availability.in_stock,
+                        available_sizes = availability.sizes
+                    FROM (
+                        SELECT product.id,
+                            COALESCE(SUM(variant.stock_quantity), 0) AS total_stock,
+                            COUNT(variant.id) FILTER (WHERE variant.stock_quantity > 0) AS in_stock,
+                            -- numeric sizes in numeric order
+                            ARRAY(
+                                SELECT DISTINCT ON (sort_number, size) size FROM (
+                                    SELECT size, substring(size FROM '^[0-9]+(?:\\.[0-9]+)?')::numeric AS sort_number
+                                    FROM product_variants WHERE product_id = product.id AND stock_quantity > 0
+                                ) sizes ORDER BY sort_number NULLS LAST, size
+                            ) AS sizes
+                        FROM products product
+                        LEFT JOIN product_variants variant ON variant.product_id = product.id
+                        WHERE product.id = ANY(product_ids)
+                        GROUP BY product.id
+                    ) availability
+                    WHERE products.id = availability.id;
+                END $$ LANGUAGE plpgsql;
+
+                CREATE OR REPLACE FUNCTION product_variants_availability() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'INSERT' THEN
+                        PERFORM refresh_product_availability(ARRAY(SELECT DISTINCT product_id FROM new_variants));
+                    ELSIF TG_OP = 'DELETE' THEN
+                        PERFORM refresh_product_availability(ARRAY(SELECT DISTINCT product_id FROM old_variants));
+                    ELSE
+                        PERFORM refresh_product_availability(ARRAY(
+                            SELECT product_id FROM old_variants UNION SELECT product_id FROM new_variants
+                        ));
+                    END IF;
+                    RETURN NULL;
+                END $$ LANGUAGE plpgsql;
+
+                -- transition tables need one trigger per event
+                CREATE OR REPLACE TRIGGER product_variants_availability_insert AFTER INSERT ON product_variants
+                REFERENCING NEW TABLE AS new_variants FOR EACH STATEMENT EXECUTE FUNCTION product_variants_availability();
+                CREATE OR REPLACE TRIGGER product_variants_availability_update AFTER UPDATE ON product_variants
+                REFERENCING OLD TABLE AS old_variants NEW TABLE AS new_variants FOR EACH STATEMENT EXECUTE FUNCTION product_variants_availability();
+                CREATE OR REPLACE TRIGGER product_variants_availability_delete AFTER DELETE ON product_variants
+                REFERENCING OLD TABLE AS old_variants FOR EACH STATEMENT EXECUTE FUNCTION product_variants_availability();
+
+                -- databases from before the availability columns: add and backfill them once
+                DO $$
+                BEGIN
+                    IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name = 'products' AND column_name = 'available_sizes') THEN
+                        ALTER TABLE products
+                            ADD COLUMN total_variant_stock INTEGER NOT NULL DEFAULT 0,
+                            ADD COLUMN in_stock_variant_count INTEGER NOT NULL DEFAULT 0,
+                            ADD COLUMN available_sizes VARCHAR(32)[] NOT NULL DEFAULT '{}';
+                        PERFORM refresh_product_availability(ARRAY(SELECT id FROM products));
+                    END IF;
+                END$$;
+            """,
+        )
+        if not customers:
+            catalog_commands += (CUSTOMER_DIRECTORY,)
+
+        #altered password to handle total number of text after password hashing
+        customer_commands = (
+            """
+            DO $$
+            BEGIN
+                IF NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = 'request_type') THEN
+                    CREATE TYPE request_type AS ENUM ('sale', 'repair');
+                END IF;
+
+                IF NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = 'status_type') THEN CREATE TYPE
+                    status_type AS ENUM ('pending', 'in_progress', 'completed');
+                END IF;
+            END$$;
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS customers(
+                id SERIAL PRIMARY KEY,
+                name VARCHAR(255) NOT NULL, 
+                email VARCHAR(64) NOT NULL UNIQUE, 
+                password VARCHAR(255) NOT NULL,          
+                address VARCHAR(255) NOT NULL, 
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+
+                -- databases created with VARCHAR(32) can't store a bcrypt hash (60 characters)
+                DO $$
+                BEGIN
+                    IF (SELECT character_maximum_length FROM information_schema.columns
+                        WHERE table_schema = current_schema() AND table_name = 'customers' AND column_name = 'password') < 60 THEN
+                        ALTER TABLE customers ALTER COLUMN password TYPE VARCHAR(255);
+                    END IF;
+                END$$;
+            """,
+            """
+                -- see app/oauth2.py. A family is one login and the tokens rotated from it
+                CREATE TABLE IF NOT EXISTS refresh_tokens(
+                id BIGSERIAL PRIMARY KEY,
+                customer_id INTEGER NOT NULL,
+                family UUID NOT NULL,
+                token_hash CHAR(64) NOT NULL UNIQUE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                expires_at TIMESTAMP NOT NULL,
+                used_at TIMESTAMP DEFAULT NULL,
+                revoked_at TIMESTAMP DEFAULT NULL,
+                FOREIGN KEY (customer_id) REFERENCES customers (id)
+                ON UPDATE CASCADE ON DELETE CASCADE
+                );
+
+                CREATE INDEX IF NOT EXISTS idx_refresh_tokens_customer ON refresh_tokens (customer_id, family);
+            """,
+            PARTITION_FUNCTIONS,
+            PARTITIONED_TABLES["service_requests"],
             """
                 CREATE TABLE IF NOT EXISTS repairs(
                 id SERIAL PRIMARY KEY,
@@ -93,34 +578,140 @@ class Database:
                 status status_type,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 start_date TIMESTAMP DEFAULT NULL,
-                finished_date TIMESTAMP DEFAULT NULL,
-                FOREIGN KEY (service_id) REFERENCES service_requests (id)
-                ON UPDATE CASCADE ON DELETE CASCADE
+                finished_date TIMESTAMP DEFAULT NULL
+                -- service_id is checked by the repairs_service_exists trigger, service_requests is partitioned
                 );
+
+                -- the shop-wide work queue, see app/routers/queue.py. Completed repairs, the bulk of the table, aren't in it
+                CREATE INDEX IF NOT EXISTS idx_repairs_queue ON repairs (status, created_at, id) WHERE status IN ('pending', 'in_progress');
+
+                -- date ranges of the repair analytics, see app/analytics.py
+                CREATE INDEX IF NOT EXISTS idx_repairs_created ON repairs (created_at);
+                CREATE INDEX IF NOT EXISTS idx_repairs_finished ON repairs (finished_date) WHERE finished_date IS NOT NULL;
             """,
+            partitioned_table("item_requests", catalog),
+            REFERENTIAL_TRIGGERS,
             """
-                CREATE TABLE IF NOT EXISTS item_requests (
-                id SERIAL PRIMARY KEY,
+                -- repair status feed, see app/events.py. No foreign keys: events outlive deleted repairs
+                CREATE TABLE IF NOT EXISTS repair_events(
+                id BIGSERIAL PRIMARY KEY,
+                repair_id INTEGER NOT NULL,
                 service_id INTEGER NOT NULL,
-                product_variant_id INTEGER NOT NULL,
-                quantity INTEGER NOT NULL,
-                unit_price FLOAT NOT NULL,
+                customer_id INTEGER NOT NULL,
+                event VARCHAR(16) NOT NULL,
+                status status_type,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+
+                CREATE INDEX IF NOT EXISTS idx_repair_events_customer ON repair_events (customer_id, id);
+            """,
+            """
+                -- first response of each Idempotency-Key, see app/idempotency.py
+                CREATE TABLE IF NOT EXISTS idempotency_keys(
+                customer_id INTEGER NOT NULL,
+                key VARCHAR(255) NOT NULL,
+                request_hash CHAR(64) NOT NULL,
+                status_code SMALLINT NOT NULL,
+                body JSONB NOT NULL,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                
-                -- foreign
-                FOREIGN KEY (service_id) REFERENCES service_requests (id)
-                ON UPDATE CASCADE ON DELETE CASCADE,
-                FOREIGN KEY (product_variant_id) REFERENCES product_variants (id)
-                ON UPDATE CASCADE ON DELETE CASCADE,
+                PRIMARY KEY (customer_id, key)
+                );
+            """,
+            """
+                -- cold storage for closed services and their repairs and items, filled by python -m app.archive.
+                -- same columns as the hot tables plus archived_at, read only for the API
+                CREATE TABLE IF NOT EXISTS service_requests_archive(
+                LIKE service_requests,
+                archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id),
+                FOREIGN KEY (customer_id) REFERENCES customers (id)
+                ON UPDATE CASCADE ON DELETE CASCADE
+                );
 
-                -- constraints
-                CONSTRAINT unique_request_variant UNIQUE (service_id, product_variant_id),
-                CONSTRAINT check_positive_quantity CHECK (quantity > 0),
-                CONSTRAINT check_positive_price CHECK (unit_price >= 0)
+                CREATE TABLE IF NOT EXISTS repairs_archive(
+                LIKE repairs,
+                archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id),
+                FOREIGN KEY (service_id) REFERENCES service_requests_archive (id)
+                ON UPDATE CASCADE ON DELETE CASCADE
                 );
+
+                CREATE TABLE IF NOT EXISTS item_requests_archive(
+                LIKE item_requests,
+                archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id),
+                FOREIGN KEY (service_id) REFERENCES service_requests_archive (id)
+                ON UPDATE CASCADE ON DELETE CASCADE
+                );
+
+                CREATE INDEX IF NOT EXISTS idx_service_requests_archive_customer ON service_requests_archive (customer_id);
+                CREATE INDEX IF NOT EXISTS idx_repairs_archive_service ON repairs_archive (service_id);
+                CREATE INDEX IF NOT EXISTS idx_item_requests_archive_service ON item_requests_archive (service_id);
+                CREATE INDEX IF NOT EXISTS idx_repairs_archive_created ON repairs_archive (created_at);
+                CREATE INDEX IF NOT EXISTS idx_repairs_archive_finished ON repairs_archive (finished_date);
+            """,
+            #this month and the next settings.partition_months_ahead, no-op for tables not migrated yet
+            f"""
+                SELECT create_month_partitions('service_requests', CURRENT_DATE, {settings.partition_months_ahead + 1});
+                SELECT create_month_partitions('item_requests', CURRENT_DATE, {settings.partition_months_ahead + 1});
             """
         )
-        for command in commands:
-            self.cursor.execute(command)
-        self.conn.commit()
-        self.conn.close()
\ No newline at end of file
+        if shards > 1:
+            customer_commands += (INTERLEAVED_SEQUENCES.format(shard=shard, shards=shards),)
+
+        commands = (catalog_commands if catalog else ()) + (customer_commands if customers else ())
+        try:
+            for command in commands:
+                if command is UNIQUE_VARIANTS:
+                    self.check_unique_variants()
+                self.cursor.execute(command)
+            self.conn.commit()
+        finally:
+            self.conn.close()
+
+    #databases from before unique_product_size_color can hold duplicate variants. They aren't merged here:
+    #deleting one would cascade to its item requests
+    def check_unique_variants(self):
+        self.cursor.execute("SELECT to_regclass('unique_product_size_color') IS NOT NULL AS indexed")
+        if self.cursor.fetchone()["indexed"]:
+            return
+        self.cursor.execute(
+            "SELECT product_id, size, color, count(*) AS variants FROM product_variants "
+            "GROUP BY product_id, size, color HAVING count(*) > 1 ORDER BY product_id, size, color"
+        )
+        duplicates = self.cursor.fetchall()
+        if duplicates:
+            examples = ", ".join(f"({row['product_id']}, {row['size']}, {row['color']}) x{row['variants']}" for row in duplicates[:5])
+            raise SchemaConflict(
+                f"product_variants has {len(duplicates)} (product_id, size, color) with more than one variant, e.g. {examples}. "
+                "Move their item requests to one variant and delete the others, then start again"
+            )
+
+
+#a connection from the pool, a 503 when none can be had
+def acquire(source: ConnectionPool):
+    try:
+        return source.getconn()
+    except (PoolTimeout, psycopg2.OperationalError) as e:
+        print(f"Connection to database failed. Error: {e}")
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Database unavailable")
+
+
+#a pooled connection, always handed back (rolled back if left open). A 503 when none can be had
+@contextmanager
+def session(source: ConnectionPool):
+    conn = acquire(source)
+    db = Database(conn)
+    try:
+        yield db
+    finally:
+        db.cursor.close()
+        source.putconn(conn)
+
+
+#FastAPI dependency: one pooled connection per request. The catalog database when customers are sharded,
+#customer data goes through app.shards.get_customer_db
+def get_db():
+    with session(pool) as db:
+        yield db
+
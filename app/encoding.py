@@ -0,0 +1,157 @@
+import json
+import zlib
+from starlette.datastructures import MutableHeaders
+from .config import settings
+
+#optional: without brotli only gzip is offered, without msgpack every response stays JSON
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+#Response encoding, negotiated per request:
+#Accept: application/msgpack (or x-msgpack / vnd.msgpack) gets the JSON body re-encoded as MessagePack,
+#the response models and fieldsets stay the same. Routes keep FastAPI's direct JSON serialization and
+#only the requests that asked for MessagePack pay for the conversion.
+#Accept-Encoding: br or gzip compresses bodies of at least settings.compression_min_bytes, and streamed
+#bodies (CSV exports) chunk by chunk. Event streams are never compressed, each event has to reach the client as it happens.
+
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+COMPRESSIBLE_TYPES = ("application/json", "text/csv", "text/plain", "text/html") + MSGPACK_TYPES
+
+
+def qualities(value: bytes) -> dict:
+    result = {}
+    for part in value.decode("latin-1").split(","):
+        name, _, params = part.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, number = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(number)
+                except ValueError:
+                    quality = 0.0
+        if name.strip():
+            result[name.strip().lower()] = quality
+    return result
+
+
+#the MessagePack type the client prefers over JSON, None for JSON
+def msgpack_type(accept: bytes):
+    if msgpack is None or not accept:
+        return None
+    accepted = qualities(accept)
+    quality, media_type = max((accepted.get(media_type, 0), media_type) for media_type in MSGPACK_TYPES)
+    json_quality = accepted.get("application/json", accepted.get("application/*", accepted.get("*/*", 0)))
+    return media_type if quality > 0 and quality >= json_quality else None
+
+
+#br before gzip at equal quality, None for identity
+def content_coding(accept_encoding: bytes):
+    if not accept_encoding:
+        return None
+    accepted = qualities(accept_encoding)
+    wildcard = accepted.get("*", 0)
+    codings = [("gzip", accepted.get("gzip", wildcard))]
+    if brotli is not None:
+        codings.insert(0, ("br", accepted.get("br", wildcard)))
+    coding, quality = max(codings, key=lambda coding: coding[1])
+    return coding if quality > 0 else None
+
+
+def to_msgpack(body: bytes) -> bytes:
+    return msgpack.packb(json.loads(body), use_bin_type=True)
+
+
+class GzipEncoder:
+    def __init__(self, level: int = None):
+        self.compressor = zlib.compressobj(settings.gzip_level if level is None else level, zlib.DEFLATED, 31)
+
+    #every chunk is flushed so a stream reaches the client as it is produced
+    def compress(self, data: bytes, final: bool) -> bytes:
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class BrotliEncoder:
+    def __init__(self, quality: int = None):
+        self.compressor = brotli.Compressor(quality=settings.brotli_quality if quality is None else quality)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        return self.compressor.process(data) + (self.compressor.finish() if final else self.compressor.flush())
+
+
+ENCODERS = {"gzip": GzipEncoder, "br": BrotliEncoder}
+
+
+def _vary(headers: MutableHeaders, name: str):
+    vary = [value.strip() for value in headers.get("vary", "").split(",") if value.strip()]
+    if name not in vary:
+        headers["vary"] = ", ".join(vary + [name])
+
+
+class EncodingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            return await self.app(scope, receive, send)
+
+        request_headers = dict((name.lower(), value) for name, value in scope["headers"])
+        as_msgpack = msgpack_type(request_headers.get(b"accept", b""))
+        coding = content_coding(request_headers.get(b"accept-encoding", b""))
+        if as_msgpack is None and coding is None:
+            return await self.app(scope, receive, send)
+
+        start = None
+        encoder = None
+
+        async def encode(message):
+            nonlocal start, encoder
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                return await send(message)
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+            #the first body message decides, the start message is held back until then
+            if start is not None:
+                headers = MutableHeaders(scope=start)
+                content_type = headers.get("content-type", "").split(";")[0].strip().lower()
+
+                if as_msgpack is not None and content_type == "application/json" and not more_body and body:
+                    body = to_msgpack(body)
+                    content_type = headers["content-type"] = as_msgpack
+                    headers["content-length"] = str(len(body))
+                    _vary(headers, "Accept")
+
+                if (coding is not None and start["status"] not in (204, 304) and "content-encoding" not in headers
+                        and content_type in COMPRESSIBLE_TYPES and (more_body or len(body) >= settings.compression_min_bytes)):
+                    encoder = ENCODERS[coding]()
+                    headers["content-encoding"] = coding
+                    _vary(headers, "Accept-Encoding")
+                    body = encoder.compress(body, not more_body)
+                    if more_body:
+                        del headers["content-length"]
+                    else:
+                        headers["content-length"] = str(len(body))
+
+                message = {**message, "body": body}
+                await send(start)
+                start = None
+
+            elif encoder is not None:
+                message = {**message, "body": encoder.compress(body, not more_body)}
+
+            await send(message)
+
+        await self.app(scope, receive, encode)
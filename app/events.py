@@ -0,0 +1,137 @@
+import asyncio
+import json
+import select
+import threading
+from fastapi.encoders import jsonable_encoder
+from typing import Optional
+from .database import Database, connect
+from .shards import shards
+
+#Repair status feed: writes record an event row and NOTIFY it in the same transaction,
+#each worker holds one LISTEN connection per customer shard and fans the notifications out to its SSE subscribers
+
+CHANNEL = "repair_events"
+QUEUE_SIZE = 1000
+
+
+#call inside the writing transaction, PostgreSQL only delivers the NOTIFY on commit
+def publish_repair_event(db: Database, repair: dict, customer_id: int, event: str):
+    db.cursor.execute(
+        "WITH published AS ("
+        "INSERT INTO repair_events (repair_id, service_id, customer_id, event, status) VALUES (%s, %s, %s, %s, %s) RETURNING *"
+        ") SELECT pg_notify(%s, row_to_json(published)::text) FROM published",
+        (repair["id"], repair["service_id"], customer_id, event, None if event == "deleted" else repair["status"], CHANNEL)
+    )
+
+
+#events after last_event_id for a reconnecting client, oldest first
+def replay(db: Database, last_event_id: int, customer_id: int = None, service_id: int = None, limit: int = QUEUE_SIZE) -> list:
+    sql = "SELECT * FROM repair_events WHERE id > %s"
+    values = (last_event_id,)
+    if customer_id is not None:
+        sql += " AND customer_id = %s"
+        values += (customer_id,)
+    if service_id is not None:
+        sql += " AND service_id = %s"
+        values += (service_id,)
+
+    db.cursor.execute(sql + " ORDER BY id LIMIT %s", values + (limit,))
+    return jsonable_encoder(db.cursor.fetchall())
+
+
+#where a new shop-wide stream starts on a shard
+def last_event_id(db: Database) -> int:
+    db.cursor.execute("SELECT coalesce(max(id), 0) AS id FROM repair_events")
+    return db.cursor.fetchone()["id"]
+
+
+class Subscriber:
+    def __init__(self, loop, customer_id: Optional[int], service_id: Optional[int]):
+        self.loop = loop
+        self.queue = asyncio.Queue(QUEUE_SIZE)
+        self.customer_id = customer_id
+        self.service_id = service_id
+        self.lagging = False
+
+    def wants(self, event: dict) -> bool:
+        return ((self.customer_id is None or event["customer_id"] == self.customer_id) and
+                (self.service_id is None or event["service_id"] == self.service_id))
+
+    #runs on the subscriber's event loop with (shard, event). A full queue means a stalled client: later events are dropped,
+    #the stream ends once the queue is drained and the client resumes from its Last-Event-ID
+    def push(self, event):
+        if self.lagging:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.lagging = True
+
+
+class RepairFeed:
+    def __init__(self):
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def subscribe(self, customer_id: int = None, service_id: int = None) -> Subscriber:
+        subscriber = Subscriber(asyncio.get_running_loop(), customer_id, service_id)
+        with self.lock:
+            self.subscribers.add(subscriber)
+            if not any(thread.is_alive() for thread in self.threads):
+                self.stopping.clear()
+                self.threads = [
+                    threading.Thread(target=self._listen, args=(shard, source.target), name=f"repair-feed-{shard}", daemon=True)
+                    for shard, source in enumerate(shards.pools)
+                ]
+                for thread in self.threads:
+                    thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def stop(self):
+        self.stopping.set()
+        with self.lock:
+            subscribers, self.subscribers = self.subscribers, set()
+        for subscriber in subscribers:
+            subscriber.loop.call_soon_threadsafe(subscriber.push, None)
+
+    def dispatch(self, shard: int, event: dict):
+        with self.lock:
+            subscribers = [subscriber for subscriber in self.subscribers if subscriber.wants(event)]
+        for subscriber in subscribers:
+            subscriber.loop.call_soon_threadsafe(subscriber.push, (shard, event))
+
+    #LISTEN loop on one shard with its own autocommit connection, reconnects with backoff if the connection drops
+    def _listen(self, shard: int, target: Optional[dict]):
+        delay = 1
+        while not self.stopping.is_set():
+            conn = None
+            try:
+                conn = connect(target)
+                conn.autocommit = True
+                conn.cursor().execute(f"LISTEN {CHANNEL}")
+                delay = 1
+
+                while not self.stopping.is_set():
+                    if select.select([conn], [], [], 5) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self.dispatch(shard, json.loads(conn.notifies.pop(0).payload))
+
+            except Exception as e:
+                print(f"Repair feed connection to shard {shard} lost, retrying in {delay}s. Error: {e}")
+                self.stopping.wait(delay)
+                delay = min(delay * 2, 30)
+
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+feed = RepairFeed()
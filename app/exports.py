@@ -0,0 +1,189 @@
+import io
+import queue
+import threading
+from .config import settings
+from .database import ConnectionPool, acquire, pool
+from .shards import shards
+
+#CSV exports straight from COPY (SELECT ...) TO STDOUT: rows never become Python objects.
+#A thread runs the COPY on a pooled connection and hands chunks to the response through a bounded queue,
+#so memory stays at a few chunks whatever the export size and a slow client slows the COPY down.
+#With sharded customers the shards are exported one after the other, each in the export's order. Their item requests
+#join a temporary copy of the catalog's variants, COPYed from the catalog once per export.
+#The route takes the first connection (and the catalog copy) before the response starts: a busy pool is a 503,
+#not a 200 with a cut-off CSV. A later shard failing mid-stream can only abort the response.
+
+CHUNK_BYTES = 64 * 1024
+QUEUE_CHUNKS = 16
+DONE = object()
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+class ChunkWriter:
+    def __init__(self, chunks: queue.Queue, cancelled: threading.Event):
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.buffer = bytearray()
+
+    #psycopg2 calls write once per row
+    def write(self, data):
+        self.buffer += data.encode() if isinstance(data, str) else data
+        if len(self.buffer) >= CHUNK_BYTES:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.put(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    #gives up once the response is gone or has not taken a chunk for export_stall_seconds
+    def put(self, item):
+        waited = 0
+        while not self.cancelled.is_set():
+            try:
+                return self.chunks.put(item, timeout=1)
+            except queue.Full:
+                waited += 1
+                if waited >= settings.export_stall_seconds:
+                    break
+        raise ExportCancelled()
+
+
+def _copy(conn, sql: str, writer: ChunkWriter):
+    try:
+        with conn.cursor() as cursor:
+            cursor.copy_expert(sql, writer)
+        writer.flush()
+        writer.put(DONE)
+    except ExportCancelled:
+        pass
+    except Exception as e:
+        try:
+            writer.put(e)
+        except ExportCancelled:
+            pass
+
+
+#sync generator over the COPY on a connection taken from `source`, which always gets it back.
+#An export that did not finish leaves the connection mid-COPY so it is closed instead of reused.
+#prepare(cursor) runs first in the same transaction, which the pool rolls back afterwards
+def stream_copy(conn, source: ConnectionPool, query: str, params: tuple, header: bool = True, prepare=None):
+    chunks = queue.Queue(QUEUE_CHUNKS)
+    cancelled = threading.Event()
+    finished = False
+    thread = None
+    try:
+        with conn.cursor() as cursor:
+            if prepare is not None:
+                prepare(cursor)
+            sql = cursor.mogrify(f"COPY ({query}) TO STDOUT WITH (FORMAT csv{', HEADER' if header else ''})", params).decode()
+        thread = threading.Thread(target=_copy, args=(conn, sql, ChunkWriter(chunks, cancelled)), name="csv-export", daemon=True)
+        thread.start()
+
+        while True:
+            chunk = chunks.get()
+            if chunk is DONE:
+                finished = True
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    finally:
+        cancelled.set()
+        if thread is not None and thread.is_alive():
+            conn.cancel()
+            thread.join()
+        if not finished:
+            conn.close()
+        source.putconn(conn)
+
+
+#the variants with their product, {variants} in the export queries
+VARIANTS = (
+    "(SELECT variant.id, variant.product_id, product.name AS product_name, variant.size, variant.color "
+    "FROM product_variants variant JOIN products product ON product.id = variant.product_id)"
+)
+CATALOG_VARIANTS = "pg_temp.catalog_variants"
+
+
+def copy_catalog_variants() -> bytes:
+    data = io.BytesIO()
+    conn = acquire(pool)
+    try:
+        with conn.cursor() as cursor:
+            cursor.copy_expert(f"COPY {VARIANTS} TO STDOUT", data)
+    finally:
+        pool.putconn(conn)
+    return data.getvalue()
+
+
+def load_catalog_variants(cursor, data: bytes):
+    cursor.execute(
+        f"CREATE TEMPORARY TABLE {CATALOG_VARIANTS.split('.')[1]} "
+        "(id INTEGER PRIMARY KEY, product_id INTEGER, product_name TEXT, size TEXT, color TEXT) ON COMMIT DROP"
+    )
+    cursor.copy_expert(f"COPY {CATALOG_VARIANTS} FROM STDIN", io.BytesIO(data))
+
+
+#The body of an export response: stream_copy over every shard, the header comes with the first.
+#Created in the route, close() returns the first connection if the body was never iterated
+class Export:
+    def __init__(self, query: str, params: tuple):
+        self.params = params
+        self.prepare = None
+        if shards.sharded and "{variants}" in query:
+            #the catalog connection is given back before any shard connection is taken
+            data = copy_catalog_variants()
+            self.prepare = lambda cursor: load_catalog_variants(cursor, data)
+        self.query = query.format(variants=CATALOG_VARIANTS if shards.sharded else VARIANTS)
+        self.conn = acquire(shards.pools[0])
+
+    def __iter__(self):
+        for index, source in enumerate(shards.pools):
+            if index == 0:
+                conn, self.conn = self.conn, None
+            else:
+                conn = source.getconn()
+            yield from stream_copy(conn, source, self.query, self.params, index == 0, self.prepare)
+
+    def close(self):
+        if self.conn is not None:
+            shards.pools[0].putconn(self.conn)
+            self.conn = None
+
+
+SALES = (
+    "SELECT item.id AS item_id, item.created_at, item.service_id, service.customer_id, "
+    "variant.product_id, variant.product_name, variant.id AS variant_id, variant.size, variant.color, "
+    "item.quantity, item.unit_price, item.quantity * item.unit_price AS line_total "
+    "FROM item_requests item "
+    "JOIN service_requests service ON service.id = item.service_id "
+    "JOIN {variants} variant ON variant.id = item.product_variant_id"
+)
+
+REPAIRS = (
+    "SELECT repair.id AS repair_id, repair.created_at, repair.service_id, service.customer_id, "
+    "customer.name AS customer_name, customer.email AS customer_email, repair.description, repair.status, "
+    "repair.start_date, repair.finished_date, service.total_cost "
+    "FROM repairs repair "
+    "JOIN service_requests service ON service.id = repair.service_id "
+    "JOIN customers customer ON customer.id = service.customer_id"
+)
+
+
+#half-open [start, end) on the row's created_at, ordered so the file is stable between runs
+def date_range(query: str, column: str, start, end) -> tuple:
+    conditions, params = [], ()
+    if start is not None:
+        conditions.append(f"{column} >= %s")
+        params += (start,)
+    if end is not None:
+        conditions.append(f"{column} < %s")
+        params += (end,)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    return query + f" ORDER BY {column}", params
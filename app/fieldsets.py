@@ -0,0 +1,103 @@
+from fastapi import HTTPException, Query, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from typing import Optional
+
+#Sparse fieldsets: ?fields= picks the columns (and relationships) of the resource, ?include= the relationships to embed
+#Without either parameter the full response model is returned as before
+
+#Columns each table exposes, customers.password is never selected
+COLUMNS = {
+    "customers": ("id", "name", "email", "address", "created_at"),
+    "service_requests": ("id", "customer_id", "total_cost", "date", "type"),
+    "products": ("id", "name", "description", "price", "stock_quantity", "created_at",
+                 "total_variant_stock", "in_stock_variant_count", "available_sizes"),
+    "product_variants": ("id", "product_id", "size", "color", "stock_quantity"),
+    "repairs": ("id", "service_id", "description", "status", "created_at", "start_date", "finished_date"),
+    "item_requests": ("id", "service_id", "product_variant_id", "quantity", "unit_price", "created_at"),
+}
+
+RELATIONSHIPS = {
+    "customers": ("services",),
+    "service_requests": ("user", "repairs", "items"),
+    "products": ("variants",),
+    "product_variants": ("product",),
+    "repairs": ("service",),
+    "item_requests": ("service",),
+}
+
+
+def columns(table: str) -> str:
+    return ", ".join(COLUMNS[table])
+
+
+class Fieldset:
+    def __init__(self, table: str, fields: Optional[set] = None, include: Optional[set] = None):
+        self.table = table
+        self.fields = fields
+        self.include = include
+
+    @property
+    def sparse(self) -> bool:
+        return self.fields is not None or self.include is not None
+
+    #relationships to load: all of them by default, otherwise only the ones asked for
+    def relations(self) -> set:
+        if self.include is not None:
+            return self.include
+        if self.fields is not None:
+            return self.fields & set(RELATIONSHIPS[self.table])
+        return set(RELATIONSHIPS[self.table])
+
+    #column list for the SELECT, `required` columns are fetched for relationship lookups even if not returned
+    def select(self, *required) -> str:
+        if self.fields is None:
+            return columns(self.table)
+        return ", ".join(column for column in COLUMNS[self.table] if column in self.fields or column in required)
+
+    def shape(self, row: dict) -> dict:
+        if self.fields is None:
+            return row
+        wanted = self.fields | self.relations()
+        return {key: value for key, value in row.items() if key in wanted}
+
+    #sparse rows skip the response model, they would fail its validation
+    def respond(self, result):
+        if not self.sparse:
+            return result
+        if isinstance(result, list):
+            return JSONResponse(jsonable_encoder([self.shape(row) for row in result]))
+        return JSONResponse(jsonable_encoder(self.shape(result)))
+
+    def respond_batch(self, results: list, missing: list):
+        if not self.sparse:
+            return {"results": results, "missing": missing}
+        return JSONResponse(jsonable_encoder({"results": [self.shape(row) for row in results], "missing": missing}))
+
+
+def _parse(value: Optional[str], allowed: tuple, kind: str) -> Optional[set]:
+    if value is None:
+        return None
+
+    names = {name.strip() for name in value.split(",") if name.strip()}
+    unknown = names - set(allowed)
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown {kind}: {', '.join(sorted(unknown))}. Allowed: {', '.join(allowed)}"
+        )
+    return names
+
+
+#dependency factory, e.g. fieldset: Fieldset = Depends(fieldset("customers"))
+def fieldset(table: str):
+    def dependency(
+            fields: Optional[str] = Query(None, description="Comma separated fields to return"),
+            include: Optional[str] = Query(None, description="Comma separated relationships to embed, empty for none")
+            ) -> Fieldset:
+        return Fieldset(
+            table,
+            _parse(fields, COLUMNS[table] + RELATIONSHIPS[table], "field"),
+            _parse(include, RELATIONSHIPS[table], "relationship")
+        )
+    return dependency
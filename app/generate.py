@@ -0,0 +1,328 @@
+import argparse
+import io
+import multiprocessing
+import random
+from datetime import datetime, timedelta
+from .database import Database, INTERLEAVED_SEQUENCES
+from .partitions import create_partitions
+from .shards import create_tables, shards
+from .utils import hash
+
+#Synthetic data generator for capacity planning
+#Usage: python -m app.generate --customers 1000000 --workers 8 --seed 42
+#
+#Rows are written with explicit ids and bulk loaded with COPY, one worker process per chunk of customers.
+#Every chunk owns a fixed id range per table (sized from the --max-* options), so workers never
+#coordinate and the same seed always produces the same rows. Sequences are moved past the loaded ids at the end.
+#With sharded customers every customer's rows go to its shard and its id and email to the catalog's customer_directory.
+
+SIZES = ["5", "5.5", "6", "6.5", "7", "7.5", "8", "8.5", "9", "9.5", "10", "10.5", "11", "12", "13"]
+COLORS = ["black", "white", "brown", "tan", "navy", "red", "grey", "green"]
+MATERIALS = ["Leather", "Suede", "Canvas", "Mesh", "Nubuck"]
+STYLES = ["Oxford", "Loafer", "Sneaker", "Boot", "Sandal", "Derby", "Runner", "Slip-on"]
+REPAIR_JOBS = ["Resole", "Heel replacement", "Stitching repair", "Stretching", "Zipper replacement", "Cleaning and polish"]
+INT_MAX = 2**31 - 1
+
+
+def parse_weights(value: str) -> dict:
+    weights = {}
+    for pair in value.split(","):
+        key, _, weight = pair.partition("=")
+        weights[key.strip()] = float(weight)
+
+    unknown = set(weights) - {"pending", "in_progress", "completed"}
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Unknown repair status: {', '.join(sorted(unknown))}")
+    return weights
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.generate", description="Generate and bulk load synthetic shoeshop data")
+    parser.add_argument("--customers", type=int, default=100_000)
+    parser.add_argument("--products", type=int, default=500)
+    parser.add_argument("--max-variants-per-product", type=int, default=12)
+    parser.add_argument("--services-per-customer", type=float, default=3.0, help="mean number of service requests per customer")
+    parser.add_argument("--max-services-per-customer", type=int, default=20)
+    parser.add_argument("--sale-ratio", type=float, default=0.7, help="share of service requests that are sales")
+    parser.add_argument("--items-per-sale", type=float, default=2.0, help="mean number of item requests per sale")
+    parser.add_argument("--max-items-per-sale", type=int, default=10)
+    parser.add_argument("--max-repairs-per-service", type=int, default=3)
+    parser.add_argument("--repair-status", type=parse_weights, default="pending=0.15,in_progress=0.25,completed=0.6")
+    parser.add_argument("--days", type=int, default=730, help="history window the timestamps are spread over")
+    parser.add_argument("--password", default="password", help="plain password shared by every generated customer")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=5_000, help="customers generated and committed per task")
+    return parser.parse_args(argv)
+
+
+#COPY text format: tab separated, \N for NULL
+def copy_value(value) -> str:
+    if value is None:
+        return "\\N"
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ")
+    return str(value)
+
+
+def copy_rows(db: Database, table: str, columns: tuple, rows: list):
+    if not rows:
+        return
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(copy_value(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    db.cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+
+def bounded(rng: random.Random, mean: float, low: int, high: int) -> int:
+    if mean <= 0:
+        return low
+    return max(low, min(high, int(rng.expovariate(1 / mean))))
+
+
+def random_time(rng: random.Random, start: datetime, end: datetime) -> datetime:
+    return start + timedelta(seconds=rng.uniform(0, max((end - start).total_seconds(), 0)))
+
+
+#Catalog is small, generated and loaded by the parent process before any worker starts
+def generate_catalog(args, rng: random.Random, product_base: int, variant_base: int, start: datetime, end: datetime):
+    products, variants = [], []
+    variant_id = variant_base
+
+    for index in range(args.products):
+        product_id = product_base + index + 1
+        price = round(rng.uniform(25, 250), 2)
+        combos = [(size, color) for size in SIZES for color in COLORS]
+        picked = rng.sample(combos, rng.randint(1, min(args.max_variants_per_product, len(combos))))
+
+        total_stock = 0
+        for size, color in picked:
+            variant_id += 1
+            stock = rng.randint(0, 60)
+            total_stock += stock
+            variants.append((variant_id, product_id, size, color, stock, price))
+
+        name = f"{rng.choice(MATERIALS)} {rng.choice(STYLES)} {product_id}"
+        products.append((product_id, name, f"{name} shoe", price, total_stock, random_time(rng, start, end)))
+
+    return products, variants
+
+
+#Worker state, set once per process by init_worker
+_worker = {}
+
+def init_worker(args, variants, password_hash, bases, start, end):
+    dbs = [Database(target=source.target) for source in shards.pools]
+    directory = Database() if shards.sharded else None
+    for db in dbs + ([directory] if directory is not None else []):
+        db.cursor.execute("SET synchronous_commit TO OFF")
+    _worker.update(dbs=dbs, directory=directory, args=args, variants=variants, password_hash=password_hash, bases=bases, start=start, end=end)
+
+
+def chunk_capacity(args) -> dict:
+    services = args.chunk_size * args.max_services_per_customer
+    return {
+        "customers": args.chunk_size,
+        "service_requests": services,
+        "repairs": services * args.max_repairs_per_service,
+        "item_requests": services * args.max_items_per_sale,
+    }
+
+
+def generate_chunk(chunk: int, args, variants, password_hash, bases, start, end) -> dict:
+    rng = random.Random(args.seed * 1_000_003 + chunk)
+    capacity = chunk_capacity(args)
+    next_id = {table: bases[table] + chunk * capacity[table] for table in capacity}
+    statuses, status_weights = zip(*args.repair_status.items())
+
+    customers, services, repairs, items = [], [], [], []
+    first = chunk * args.chunk_size
+    for customer_index in range(first, min(first + args.chunk_size, args.customers)):
+        next_id["customers"] += 1
+        customer_id = next_id["customers"]
+        joined = random_time(rng, start, end)
+        customers.append((customer_id, f"Customer {customer_id}", f"customer{customer_id}@example.com",
+                          password_hash, f"{rng.randint(1, 9999)} Market Street", joined))
+
+        for _ in range(bounded(rng, args.services_per_customer, 0, args.max_services_per_customer)):
+            next_id["service_requests"] += 1
+            service_id = next_id["service_requests"]
+            service_date = random_time(rng, joined, end)
+
+            if rng.random() < args.sale_ratio:
+                count = bounded(rng, args.items_per_sale, 1, min(args.max_items_per_sale, len(variants)))
+                total_cost = 0
+                #unique_request_variant: a variant appears at most once per sale
+                for variant_id, price in rng.sample(variants, count):
+                    next_id["item_requests"] += 1
+                    quantity = rng.randint(1, 3)
+                    total_cost += quantity * price
+                    items.append((next_id["item_requests"], service_id, variant_id, quantity, price, service_date))
+                services.append((service_id, customer_id, round(total_cost, 2), service_date, "sale"))
+
+            else:
+                services.append((service_id, customer_id, round(rng.uniform(10, 150), 2), service_date, "repair"))
+                for _ in range(rng.randint(1, args.max_repairs_per_service)):
+                    next_id["repairs"] += 1
+                    status = rng.choices(statuses, status_weights)[0]
+                    created_at = service_date + timedelta(minutes=rng.randint(0, 30))
+                    start_date = finished_date = None
+
+                    #timeline: queued -> started -> finished, never later than the end of the window
+                    if status != "pending":
+                        start_date = created_at + timedelta(hours=rng.expovariate(1 / 24))
+                        if start_date > end:
+                            status, start_date = "pending", None
+                    if status == "completed":
+                        finished_date = start_date + timedelta(hours=rng.expovariate(1 / 48))
+                        if finished_date > end:
+                            status, finished_date = "in_progress", None
+
+                    repairs.append((next_id["repairs"], service_id, f"{rng.choice(REPAIR_JOBS)}", status,
+                                    created_at, start_date, finished_date))
+
+    return {"customers": customers, "service_requests": services, "repairs": repairs, "item_requests": items}
+
+
+COLUMNS = {
+    "customers": ("id", "name", "email", "password", "address", "created_at"),
+    "service_requests": ("id", "customer_id", "total_cost", "date", "type"),
+    "repairs": ("id", "service_id", "description", "status", "created_at", "start_date", "finished_date"),
+    "item_requests": ("id", "service_id", "product_variant_id", "quantity", "unit_price", "created_at"),
+}
+
+
+#the chunk's rows of every customer shard, each row goes to the shard of its customer
+def split_by_shard(rows: dict) -> list:
+    parts = [{table: [] for table in rows} for _ in shards.pools]
+    service_shards = {}
+    for row in rows["customers"]:
+        parts[shards.index(row[0])]["customers"].append(row)
+    for row in rows["service_requests"]:
+        service_shards[row[0]] = shards.index(row[1])
+        parts[service_shards[row[0]]]["service_requests"].append(row)
+    for table in ("repairs", "item_requests"):
+        for row in rows[table]:
+            parts[service_shards[row[1]]][table].append(row)
+    return parts
+
+
+def load_chunk(chunk: int) -> tuple:
+    dbs, directory = _worker["dbs"], _worker["directory"]
+    rows = generate_chunk(chunk, _worker["args"], _worker["variants"], _worker["password_hash"],
+                          _worker["bases"], _worker["start"], _worker["end"])
+    try:
+        #the directory first: a failed chunk leaves unused customer ids behind, never customers without an entry
+        if directory is not None:
+            copy_rows(directory, "customer_directory", ("id", "email"), [(row[0], row[2]) for row in rows["customers"]])
+            directory.conn.commit()
+
+        for db, part in zip(dbs, split_by_shard(rows)):
+            #parents first so the foreign keys hold inside the transaction
+            for table in ("customers", "service_requests", "repairs", "item_requests"):
+                copy_rows(db, table, COLUMNS[table], part[table])
+            db.conn.commit()
+
+    except Exception:
+        for db in dbs + ([directory] if directory is not None else []):
+            db.conn.rollback()
+        raise
+
+    return chunk, {table: len(table_rows) for table, table_rows in rows.items()}
+
+
+CATALOG_TABLES = ("products", "product_variants")
+CUSTOMER_TABLES = ("service_requests", "repairs", "item_requests")
+
+
+def max_id(db: Database, table: str) -> int:
+    db.cursor.execute(f"SELECT COALESCE(MAX(id), 0) AS max_id FROM {table}")
+    return db.cursor.fetchone()["max_id"]
+
+
+#highest ids over the catalog db and the customer shards, customer ids come from customer_directory when sharded
+def max_ids(db: Database, shard_dbs: list) -> dict:
+    ids = {table: max_id(db, table) for table in CATALOG_TABLES}
+    ids["customers"] = max_id(db, "customer_directory") if shards.sharded else max_id(db, "customers")
+    for table in CUSTOMER_TABLES:
+        ids[table] = max(max_id(shard_db, table) for shard_db in shard_dbs)
+    return ids
+
+
+def set_sequence(db: Database, table: str, value: int):
+    db.cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), %s)", (max(value, 1),))
+
+
+#every shard's sequences past the highest id of all shards, then interleaved again
+def sync_sequences(db: Database, shard_dbs: list):
+    ids = max_ids(db, shard_dbs)
+    for table in CATALOG_TABLES:
+        set_sequence(db, table, ids[table])
+    set_sequence(db, "customer_directory" if shards.sharded else "customers", ids["customers"])
+    db.conn.commit()
+
+    for shard, shard_db in enumerate(shard_dbs):
+        for table in CUSTOMER_TABLES:
+            set_sequence(shard_db, table, ids[table])
+        if shards.sharded:
+            shard_db.cursor.execute(INTERLEAVED_SEQUENCES.format(shard=shard, shards=len(shard_dbs)))
+        shard_db.conn.commit()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    end = datetime.utcnow()
+    start = end - timedelta(days=args.days)
+
+    create_tables()
+    db = Database()
+    shard_dbs = [Database(target=source.target) for source in shards.pools] if shards.sharded else [db]
+    #one partition per month of history, the rows would otherwise all land in the default partitions
+    for shard_db in shard_dbs:
+        create_partitions(shard_db, start.date(), end.date())
+
+    #bcrypt once, every generated customer shares the hash so they can all log in with --password
+    password_hash = hash(args.password)
+    customers_db = shard_dbs[0]
+    customers_db.cursor.execute(
+        "SELECT character_maximum_length AS length FROM information_schema.columns "
+        "WHERE table_name = 'customers' AND column_name = 'password'"
+    )
+    length = customers_db.cursor.fetchone()["length"]
+    if length is not None and length < len(password_hash):
+        raise SystemExit(f"customers.password is VARCHAR({length}) but bcrypt hashes are {len(password_hash)} characters, widen the column first")
+
+    bases = max_ids(db, shard_dbs)
+    capacity = chunk_capacity(args)
+    chunks = (args.customers + args.chunk_size - 1) // args.chunk_size
+    for table, per_chunk in capacity.items():
+        if bases[table] + chunks * per_chunk > INT_MAX:
+            raise SystemExit(f"id range for {table} would overflow INTEGER, lower --chunk-size or the --max-* options")
+
+    products, variants = generate_catalog(args, random.Random(args.seed), bases["products"], bases["product_variants"], start, end)
+    copy_rows(db, "products", ("id", "name", "description", "price", "stock_quantity", "created_at"), products)
+    copy_rows(db, "product_variants", ("id", "product_id", "size", "color", "stock_quantity"), [row[:5] for row in variants])
+    db.conn.commit()
+    print(f"Loaded {len(products)} products and {len(variants)} variants")
+
+    catalog = [(row[0], row[5]) for row in variants]
+    totals = dict.fromkeys(COLUMNS, 0)
+    with multiprocessing.Pool(args.workers, initializer=init_worker,
+                              initargs=(args, catalog, password_hash, bases, start, end)) as pool:
+        for done, (chunk, counts) in enumerate(pool.imap_unordered(load_chunk, range(chunks)), start=1):
+            for table, count in counts.items():
+                totals[table] += count
+            print(f"[{done}/{chunks}] chunk {chunk} loaded: " + ", ".join(f"{count} {table}" for table, count in counts.items()))
+
+    sync_sequences(db, shard_dbs)
+    for analyzed in [db] + (shard_dbs if shards.sharded else []):
+        analyzed.cursor.execute("ANALYZE")
+        analyzed.conn.commit()
+        analyzed.conn.close()
+    print("Done: " + ", ".join(f"{count} {table}" for table, count in totals.items()))
+
+
+if __name__ == "__main__":
+    main()
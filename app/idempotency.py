@@ -0,0 +1,55 @@
+import hashlib
+import json
+from typing import Optional
+from fastapi import HTTPException, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from psycopg2.extras import Json
+from .config import settings
+from .database import Database
+
+#Idempotency-Key support for the create handlers.
+#A retried POST with the same key (per customer) gets the first response back instead of running again.
+#Both calls run inside the handler transaction: replay() takes a transaction advisory lock on the key, so a
+#concurrent duplicate waits for the first attempt to commit or roll back, and remember() stores the response
+#in the same transaction as the rows it created. A failed attempt stores nothing and can be retried.
+#Keys expire after settings.idempotency_ttl_hours.
+
+
+def fingerprint(route: str, payload) -> str:
+    return hashlib.sha256(json.dumps([route, jsonable_encoder(payload)], sort_keys=True).encode()).hexdigest()
+
+
+def replay(db: Database, key: Optional[str], customer_id: int, route: str, payload) -> Optional[JSONResponse]:
+    if key is None:
+        return None
+
+    db.cursor.execute("SELECT pg_advisory_xact_lock(hashtextextended(%s, 0))", (f"{customer_id}:{key}",))
+    db.cursor.execute(
+        "SELECT request_hash, status_code, body FROM idempotency_keys "
+        "WHERE customer_id = %s AND key = %s AND created_at > now() - make_interval(hours => %s)",
+        (customer_id, key, settings.idempotency_ttl_hours)
+    )
+    stored = db.cursor.fetchone()
+    if stored is None:
+        return None
+
+    if stored["request_hash"] != fingerprint(route, payload):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Idempotency-Key was already used for a different request")
+
+    return JSONResponse(status_code=stored["status_code"], content=stored["body"], headers={"Idempotent-Replayed": "true"})
+
+
+#`body` is the response model instance, stored as it is sent
+def remember(db: Database, key: Optional[str], customer_id: int, route: str, payload, status_code: int, body):
+    if key is None:
+        return
+
+    db.cursor.execute(
+        "DELETE FROM idempotency_keys WHERE customer_id = %s AND created_at <= now() - make_interval(hours => %s)",
+        (customer_id, settings.idempotency_ttl_hours)
+    )
+    db.cursor.execute(
+        "INSERT INTO idempotency_keys (customer_id, key, request_hash, status_code, body) VALUES (%s, %s, %s, %s, %s)",
+        (customer_id, key, fingerprint(route, payload), status_code, Json(jsonable_encoder(body)))
+    )
@@ -1,19 +1,45 @@
+import threading
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from app.routers import customers, service, product, variant, repairs, items, login
-from .database import Database
+from app.routers import customers, service, product, variant, repairs, items, login, metrics, health, events, exports, queue, analytics
+from .shards import shards, start_pools
+from .events import feed
+from .admission import AdmissionMiddleware
+from .coalesce import CoalesceMiddleware
+from .encoding import EncodingMiddleware
+from .middleware import request_timing
 
-app = FastAPI()
+# Nothing connects at import: tables are created and the pools are warmed in the background on startup,
+# GET /ready answers 503 until that is done
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    stop = threading.Event()
+    threading.Thread(target=start_pools, args=(stop,), name="db-start", daemon=True).start()
+    yield
+    stop.set()
+    feed.stop()
+    shards.close()
+
+app = FastAPI(lifespan=lifespan)
+
+#added last is outermost: timing also covers the requests admission control turns away,
+#coalesced followers wait outside admission so they never hold a slot and replay the already encoded response
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(EncodingMiddleware)
+app.add_middleware(CoalesceMiddleware)
+app.middleware("http")(request_timing)
 
 app.include_router(customers.router)
 app.include_router(service.router)
 app.include_router(product.router)
 app.include_router(variant.router)
+app.include_router(variant.batch_router)
 app.include_router(repairs.router)
+app.include_router(queue.router)
 app.include_router(items.router)
 app.include_router(login.router)
-
-# Initialize the database and create tables on startup if there are any new tables created
-@app.on_event("startup")
-def startup():
-    db = Database()
-    db.create_tables()
+app.include_router(metrics.router)
+app.include_router(health.router)
+app.include_router(events.router)
+app.include_router(exports.router)
+app.include_router(analytics.router)
@@ -0,0 +1,147 @@
+import re
+import threading
+from bisect import bisect_left
+
+#In-process metrics rendered in the Prometheus text format by GET /metrics
+#Every metric guards its samples with its own lock, so handlers in the threadpool can record concurrently
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+_registry = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labelnames = name, help, labels
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(self.values)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self.snapshot().items():
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, labels
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}    #labels -> [per bucket counts..., +Inf count, sum]
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            sample = self.values.get(labels)
+            if sample is None:
+                sample = self.values[labels] = [0] * (len(self.buckets) + 2)
+            sample[index] += 1
+            sample[-1] += value
+
+    def render(self) -> list:
+        with self.lock:
+            values = {labels: list(sample) for labels, sample in self.values.items()}
+
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, sample in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), sample):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                bucket = _labels(self.labelnames, labels, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{bucket} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(sample[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+#Value read from a callback at scrape time, callback returns {labels tuple: value}
+class Gauge:
+    def __init__(self, name: str, help: str, labels: tuple, callback):
+        self.name, self.help, self.labelnames, self.callback = name, help, labels, callback
+        _registry.append(self)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for labels, value in self.callback().items():
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+#statement name used as the label of db_query_duration_seconds: verb plus target table, e.g. "SELECT products"
+_table_after = {
+    "SELECT": re.compile(r"\bFROM\s+(\w+)", re.IGNORECASE),
+    "DELETE": re.compile(r"\bFROM\s+(\w+)", re.IGNORECASE),
+    "COPY": re.compile(r"\bFROM\s+(\w+)|^\s*COPY\s+(\w+)", re.IGNORECASE),
+    "INSERT": re.compile(r"\bINTO\s+(\w+)", re.IGNORECASE),
+    "UPDATE": re.compile(r"\bUPDATE\s+(\w+)", re.IGNORECASE),
+}
+
+def statement_name(query: str) -> str:
+    words = query.split(None, 1)
+    if not words:
+        return "UNKNOWN"
+
+    verb = words[0].upper()
+    pattern = _table_after.get(verb)
+    match = pattern.search(query) if pattern else None
+    if match:
+        return f"{verb} {(match.group(1) or match.group(match.lastindex)).lower()}"
+    return verb
+
+
+http_requests = Counter("http_requests_total", "HTTP requests by route, method and status", ("method", "route", "status"))
+http_latency = Histogram("http_request_duration_seconds", "HTTP request latency", ("method", "route", "status"))
+db_latency = Histogram("db_query_duration_seconds", "Database statement latency", ("statement",), DB_BUCKETS)
+bcrypt_queue = Histogram("bcrypt_queue_seconds", "Time spent waiting for a bcrypt slot", ("operation",), DB_BUCKETS)
+bcrypt_latency = Histogram("bcrypt_duration_seconds", "Time spent hashing or verifying with bcrypt", ("operation",))
+cache_requests = Counter("cache_requests_total", "Cache lookups by cache and result", ("cache", "result"))
+admission_rejected = Counter("admission_rejected_total", "Requests shed by admission control", ("class", "reason"))
+
+
+def record_cache(cache: str, hit: bool):
+    cache_requests.inc(cache, "hit" if hit else "miss")
+
+
+def _cache_ratios() -> dict:
+    totals = {}
+    for (cache, result), count in cache_requests.snapshot().items():
+        hits, lookups = totals.get(cache, (0, 0))
+        totals[cache] = (hits + (count if result == "hit" else 0), lookups + count)
+    return {(cache,): hits / lookups for cache, (hits, lookups) in totals.items() if lookups}
+
+Gauge("cache_hit_ratio", "Share of cache lookups that were hits since start", ("cache",), _cache_ratios)
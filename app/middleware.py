@@ -0,0 +1,53 @@
+import json
+import logging
+from time import perf_counter
+from fastapi import Request
+from .config import settings
+from .database import QueryStats, current_stats
+from . import metrics
+
+logger = logging.getLogger("app.db")
+
+
+#Records query count, total DB time and the slowest statement of every request,
+#exposes them as a Server-Timing header, logs one JSON line per request and feeds the http_* metrics
+async def request_timing(request: Request, call_next):
+    stats = QueryStats(request.scope)
+    token = current_stats.set(stats)
+    start = perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        current_stats.reset(token)
+    elapsed = perf_counter() - start
+
+    #unmatched paths share one label so random URLs can't blow up the metric cardinality
+    route = stats.route if request.scope.get("route") else "unmatched"
+    metrics.http_requests.inc(request.method, route, str(response.status_code))
+    metrics.http_latency.observe(elapsed, request.method, route, str(response.status_code))
+
+    slowest, slowest_statement = stats.slowest
+    response.headers["Server-Timing"] = (
+        f'db;dur={stats.total * 1000:.2f};desc="{stats.count} queries", '
+        f"db-slowest;dur={slowest * 1000:.2f}, "
+        f"app;dur={elapsed * 1000:.2f}"
+    )
+
+    repeated = stats.repeated(settings.n_plus_one_threshold)
+    entry = {
+        "method": request.method,
+        "route": route,
+        "status": response.status_code,
+        "duration_ms": round(elapsed * 1000, 2),
+        "db_queries": stats.count,
+        "db_time_ms": round(stats.total * 1000, 2),
+        "db_slowest_ms": round(slowest * 1000, 2),
+        "db_slowest_statement": slowest_statement,
+    }
+    if repeated:
+        entry["n_plus_one"] = [{"statement": shape, "count": count} for shape, count in repeated.items()]
+        logger.warning(json.dumps(entry))
+    else:
+        logger.info(json.dumps(entry))
+
+    return response
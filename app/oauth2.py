@@ -1,9 +1,14 @@
+import hashlib
+import secrets
+import uuid
 from jose import JWTError, jwt
-from fastapi import Depends, status, HTTPException
+from fastapi import Depends, Header, status, HTTPException
 from datetime import datetime, timedelta
+from typing import Optional
 from .body import TokenData
 from fastapi.security import OAuth2PasswordBearer
 from .config import settings
+from .database import Database
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
@@ -41,4 +46,70 @@ def get_current_user(token = Depends(oauth2_scheme)):
                                           detail="Could not validate credentials",
                                           headers={"WWW-Authenticate": "Bearer"})
     
-    return verify_token(token, credentials_exception)
\ No newline at end of file
+    return verify_token(token, credentials_exception)
+
+
+#Staff routes (CSV exports, the repair queue) take the shared settings.staff_token in X-Staff-Token, a customer's access token doesn't
+#open them. Without a configured staff_token they are refused.
+def get_staff(x_staff_token: Optional[str] = Header(None)):
+    if not settings.staff_token or x_staff_token is None or not secrets.compare_digest(x_staff_token.encode(), settings.staff_token.encode()):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail="Staff credentials required.")
+
+
+#Refresh tokens: opaque random strings, only their sha256 is stored (they carry 256 bits of entropy, a slow hash adds nothing).
+#Each one renews the access token once and is replaced by a new one of the same family.
+#Presenting a token that was already used means it leaked: the whole family is revoked.
+#Tokens start with the customer id, which finds the customer's shard (app/shards.py)
+
+def _token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+#the customer id of a refresh token, None for one without it
+def token_customer(token: str) -> Optional[int]:
+    customer_id, _, secret = token.partition(".")
+    return int(customer_id) if secret and customer_id.isdigit() else None
+
+
+def issue_refresh_token(db: Database, customer_id: int, family: Optional[str] = None) -> str:
+    token = f"{customer_id}.{secrets.token_urlsafe(32)}"
+    db.cursor.execute("DELETE FROM refresh_tokens WHERE customer_id = %s AND expires_at <= LOCALTIMESTAMP", (customer_id,))
+    db.cursor.execute(
+        "INSERT INTO refresh_tokens (customer_id, family, token_hash, expires_at) "
+        "VALUES (%s, %s::uuid, %s, LOCALTIMESTAMP + make_interval(days => %s))",
+        (customer_id, family or str(uuid.uuid4()), _token_hash(token), settings.refresh_token_days)
+    )
+    return token
+
+
+#(customer_id, new refresh token), None when the token is unknown, expired, revoked or already used
+def rotate_refresh_token(db: Database, token: str) -> Optional[tuple]:
+    token_hash = _token_hash(token)
+    db.cursor.execute(
+        "UPDATE refresh_tokens SET used_at = LOCALTIMESTAMP "
+        "WHERE token_hash = %s AND used_at IS NULL AND revoked_at IS NULL AND expires_at > LOCALTIMESTAMP "
+        "RETURNING customer_id, family",
+        (token_hash,)
+    )
+    current = db.cursor.fetchone()
+    if current is None:
+        db.cursor.execute(
+            "UPDATE refresh_tokens SET revoked_at = LOCALTIMESTAMP WHERE revoked_at IS NULL AND family = "
+            "(SELECT family FROM refresh_tokens WHERE token_hash = %s AND used_at IS NOT NULL)",
+            (token_hash,)
+        )
+        return None
+
+    return current["customer_id"], issue_refresh_token(db, current["customer_id"], current["family"])
+
+
+def revoke_refresh_tokens(db: Database, customer_id: int, token: Optional[str] = None):
+    if token is None:
+        db.cursor.execute("UPDATE refresh_tokens SET revoked_at = LOCALTIMESTAMP WHERE customer_id = %s AND revoked_at IS NULL", (customer_id,))
+    else:
+        db.cursor.execute(
+            "UPDATE refresh_tokens SET revoked_at = LOCALTIMESTAMP WHERE customer_id = %s AND revoked_at IS NULL AND family = "
+            "(SELECT family FROM refresh_tokens WHERE token_hash = %s)",
+            (customer_id, _token_hash(token))
+        )
\ No newline at end of file
@@ -0,0 +1,95 @@
+from fastapi import Query, Response
+from typing import Literal, Optional
+from .config import settings
+from .database import Database
+
+#Paging and totals for list endpoints: ?limit= and ?offset= page the rows in id order (without limit every row comes back).
+#X-Total-Count is the size of the whole list, X-Total-Count-Mode says how it was counted (?count= picks it):
+#  exact     count(*) of the matching rows
+#  estimate  pg_class.reltuples for a whole table, the planner's row estimate for a filtered list. Cheap but approximate
+#  auto      the estimate, replaced by an exact count when it is below settings.exact_count_threshold
+#  none      no total
+#A page that isn't full already tells the exact total, no count query is run for it.
+
+
+class Page:
+    def __init__(self, limit: Optional[int], offset: int, count: str):
+        self.limit = limit
+        self.offset = offset
+        self.count = count
+
+    #ORDER BY/LIMIT/OFFSET to append to the list query, empty when the whole list is asked for
+    def clause(self) -> str:
+        if self.limit is None and not self.offset:
+            return ""
+        limit = f" LIMIT {self.limit}" if self.limit is not None else ""
+        return f" ORDER BY id{limit} OFFSET {self.offset}"
+
+    #the page every one of `shards` shards returns for a merged list (app/shards.py): its first offset + limit rows
+    def spread(self, shards: int) -> "Page":
+        if shards == 1:
+            return self
+        return Page(None if self.limit is None else self.offset + self.limit, 0, self.count)
+
+
+def page(
+        limit: Optional[int] = Query(None, ge=1, le=settings.page_max_limit, description="Rows per page, all rows when not given"),
+        offset: int = Query(0, ge=0),
+        count: Literal["auto", "exact", "estimate", "none"] = Query("auto", description="How X-Total-Count is computed")
+        ) -> Page:
+    return Page(limit, offset, count)
+
+
+def exact_count(db: Database, table: str, where: str = "", values: tuple = ()) -> int:
+    db.cursor.execute(f"SELECT count(*) AS total FROM {table}{' WHERE ' + where if where else ''}", values)
+    return db.cursor.fetchone()["total"]
+
+
+def estimated_count(db: Database, table: str, where: str = "", values: tuple = ()) -> int:
+    if not where:
+        #leaf tables only: a partitioned table's rows are in its partitions. reltuples is -1 before the first ANALYZE
+        db.cursor.execute(
+            "SELECT sum(reltuples) AS total, bool_or(reltuples < 0) AS unknown FROM pg_class "
+            "WHERE relkind = 'r' AND (oid = %s::regclass OR oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = %s::regclass))",
+            (table, table)
+        )
+        estimate = db.cursor.fetchone()
+        if estimate["total"] is not None and not estimate["unknown"]:
+            return int(estimate["total"])
+
+    db.cursor.execute(f"EXPLAIN (FORMAT JSON) SELECT 1 FROM {table}{' WHERE ' + where if where else ''}", values)
+    return int(db.cursor.fetchone()["QUERY PLAN"][0]["Plan"]["Plan Rows"])
+
+
+#(total, mode) for the list the page was taken from, None for ?count=none
+def total(db: Database, page: Page, rows: list, table: str, where: str = "", values: tuple = ()) -> Optional[tuple]:
+    if page.count == "none":
+        return None
+    if (page.limit is None or len(rows) < page.limit) and (rows or not page.offset):
+        return page.offset + len(rows), "exact"
+    if page.count == "exact":
+        return exact_count(db, table, where, values), "exact"
+
+    estimate = estimated_count(db, table, where, values)
+    if page.count == "auto" and estimate < settings.exact_count_threshold:
+        return exact_count(db, table, where, values), "exact"
+    return estimate, "estimate"
+
+
+#total of a list merged from several shards, from the total of each shard's spread page
+def combined_total(counted: list) -> Optional[tuple]:
+    if len(counted) == 1:
+        return counted[0]
+    if None in counted:
+        return None
+    exact = all(mode == "exact" for _, mode in counted)
+    return sum(total for total, _ in counted), "exact" if exact else "estimate"
+
+
+#like with_missing: on the JSONResponse of a sparse fieldset, otherwise on the injected response
+def with_total(result, response: Response, counted: Optional[tuple]):
+    if counted is not None:
+        target = result if isinstance(result, Response) else response
+        target.headers["X-Total-Count"] = str(counted[0])
+        target.headers["X-Total-Count-Mode"] = counted[1]
+    return result
@@ -0,0 +1,157 @@
+import argparse
+from datetime import date
+from .config import settings
+from .database import Database, INTERLEAVED_SEQUENCES, REFERENTIAL_TRIGGERS, partitioned_table
+from .shards import create_tables, shard_databases, shards
+
+#Monthly partition maintenance for service_requests and item_requests
+#Usage: python -m app.partitions create [--from 2024-01-01] [--months 4]
+#       python -m app.partitions migrate
+#
+#New databases get partitioned tables from create_tables and the app creates this month's and the next
+#settings.partition_months_ahead partitions on every start. Run `create` from cron to stay ahead without restarts.
+#`migrate` converts tables created before partitioning, in one transaction per table holding an exclusive lock:
+#the old table is renamed, the partitioned one created with partitions for every month of data, rows copied and the old table dropped.
+#Both run on every customer shard when customers are sharded.
+
+PARTITION_KEYS = {"service_requests": "date", "item_requests": "created_at"}
+COLUMNS = {
+    "service_requests": "id, customer_id, total_cost, date, type",
+    "item_requests": "id, service_id, product_variant_id, quantity, unit_price, created_at",
+}
+
+
+def months_between(first: date, last: date) -> int:
+    return (last.year - first.year) * 12 + last.month - first.month + 1
+
+
+def add_months(day: date, months: int) -> date:
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def is_partitioned(db: Database, table: str) -> bool:
+    db.cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", (table,))
+    return db.cursor.fetchone() is not None
+
+
+#partitions for every month from start to end, returns how many were created
+def create_partitions(db: Database, start: date, end: date) -> int:
+    created = 0
+    for table in PARTITION_KEYS:
+        db.cursor.execute("SELECT create_month_partitions(%s, %s, %s) AS created", (table, start, months_between(start, end)))
+        created += db.cursor.fetchone()["created"]
+    db.conn.commit()
+    return created
+
+
+def _check_keys(db: Database, table: str, legacy: str):
+    key = PARTITION_KEYS[table]
+    db.cursor.execute(f"SELECT COUNT(*) AS count FROM {legacy} WHERE {key} IS NULL")
+    if db.cursor.fetchone()["count"]:
+        raise SystemExit(f"{table}.{key} has NULL values, the partition key can't be NULL. Set them before migrating")
+
+    #routers prune item_requests partitions with the service date
+    if table == "item_requests":
+        db.cursor.execute(
+            f"SELECT COUNT(*) AS count FROM {legacy} item JOIN service_requests service ON service.id = item.service_id "
+            "WHERE item.created_at < service.date"
+        )
+        if db.cursor.fetchone()["count"]:
+            raise SystemExit("item_requests has rows created before their service, fix created_at before migrating")
+
+
+def migrate_table(db: Database, table: str):
+    if is_partitioned(db, table):
+        print(f"{table} is already partitioned")
+        return
+
+    key = PARTITION_KEYS[table]
+    legacy = f"{table}_unpartitioned"
+    try:
+        db.cursor.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+
+        #foreign keys can't point at a partitioned table without the key column, REFERENTIAL_TRIGGERS replace them
+        db.cursor.execute(
+            "SELECT conrelid::regclass::text AS child, conname FROM pg_constraint WHERE contype = 'f' AND confrelid = %s::regclass",
+            (table,)
+        )
+        for foreign_key in db.cursor.fetchall():
+            db.cursor.execute(f'ALTER TABLE {foreign_key["child"]} DROP CONSTRAINT "{foreign_key["conname"]}"')
+
+        #free the table, sequence and index names for the partitioned table
+        db.cursor.execute("SELECT pg_get_serial_sequence(%s, 'id') AS sequence", (table,))
+        sequence = db.cursor.fetchone()["sequence"]
+        db.cursor.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+        db.cursor.execute(f"ALTER SEQUENCE {sequence} RENAME TO {legacy}_id_seq")
+        db.cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s", (legacy,))
+        for index in db.cursor.fetchall():
+            db.cursor.execute(f'ALTER INDEX "{index["indexname"]}" RENAME TO "{legacy}_{index["indexname"]}"')
+        db.cursor.execute("SELECT conname FROM pg_constraint WHERE contype = 'f' AND conrelid = %s::regclass", (legacy,))
+        for constraint in db.cursor.fetchall():
+            db.cursor.execute(f'ALTER TABLE {legacy} RENAME CONSTRAINT "{constraint["conname"]}" TO "{legacy}_{constraint["conname"]}"')
+
+        _check_keys(db, table, legacy)
+        db.cursor.execute(partitioned_table(table, not shards.sharded))
+        db.cursor.execute(REFERENTIAL_TRIGGERS)
+
+        today = date.today()
+        db.cursor.execute(f"SELECT MIN({key})::date AS first FROM {legacy}")
+        first = min(db.cursor.fetchone()["first"] or today, today)
+        last = add_months(today, settings.partition_months_ahead)
+        db.cursor.execute("SELECT create_month_partitions(%s, %s, %s)", (table, first, months_between(first, last)))
+
+        #rows were already checked by the old constraints
+        if table == "item_requests":
+            db.cursor.execute("ALTER TABLE item_requests DISABLE TRIGGER item_requests_check")
+        db.cursor.execute(f"INSERT INTO {table} ({COLUMNS[table]}) SELECT {COLUMNS[table]} FROM {legacy}")
+        print(f"{table}: copied {db.cursor.rowcount} rows into monthly partitions from {first:%Y-%m} to {last:%Y-%m}")
+        if table == "item_requests":
+            db.cursor.execute("ALTER TABLE item_requests ENABLE TRIGGER item_requests_check")
+
+        db.cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT COALESCE(MAX(id), 1) FROM {table}))")
+        db.cursor.execute(f"DROP TABLE {legacy}")
+        db.conn.commit()
+
+    except BaseException:
+        db.conn.rollback()
+        raise
+
+    db.cursor.execute(f"ANALYZE {table}")
+    db.conn.commit()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.partitions", description="Monthly partitions of service_requests and item_requests")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    create = commands.add_parser("create", help="create missing monthly partitions")
+    create.add_argument("--from", dest="start", type=date.fromisoformat, default=date.today())
+    create.add_argument("--months", type=int, default=settings.partition_months_ahead + 1)
+
+    commands.add_parser("migrate", help="convert unpartitioned tables from before partitioning")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    create_tables()
+
+    for shard, label, db in shard_databases():
+        if args.command == "create":
+            created = create_partitions(db, args.start, add_months(args.start, args.months - 1))
+            print(f"{label}Created {created} partitions")
+        else:
+            #service_requests first, dropping its foreign keys frees item_requests from the old table
+            for table in PARTITION_KEYS:
+                migrate_table(db, table)
+            #the new tables come with new sequences
+            if shards.sharded:
+                db.cursor.execute(INTERLEAVED_SEQUENCES.format(shard=shard, shards=len(shards.pools)))
+                db.conn.commit()
+
+        db.conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,60 +1,125 @@
 from .database import Database
+from .fieldsets import columns
+from .archive import archive_table
 
-def customer_relationship(customer, db: Database):
-    db.cursor.execute("SELECT * FROM service_requests WHERE customer_id = %s", (customer["id"],))
-    services = db.cursor.fetchall()
+#`include` limits the relationships that are loaded, None loads all of them.
+#`archived` rows have their service, repairs and items in the archive tables
 
-    return {
-        **customer,
-        "services": services
-        }
+def _grouped(rows: list, key: str) -> dict:
+    groups = {}
+    for row in rows:
+        groups.setdefault(row[key], []).append(row)
+    return groups
 
 
-def service_relationship(service, db: Database):
-    db.cursor.execute("SELECT * FROM customers WHERE id = %s", (service["customer_id"],))
-    user = db.cursor.fetchone()
+#set-based: one query for the relationships of all the rows
+def customers_relationship(customers: list, db: Database, include: set = None) -> list:
+    if not customers or (include is not None and "services" not in include):
+        return [{**customer} for customer in customers]
 
-    db.cursor.execute("SELECT * FROM repairs WHERE service_id = %s", (service["id"],))
-    repair = db.cursor.fetchall()
+    db.cursor.execute(
+        f"SELECT {columns('service_requests')} FROM service_requests WHERE customer_id = ANY(%s)",
+        ([customer["id"] for customer in customers],)
+    )
+    services = _grouped(db.cursor.fetchall(), "customer_id")
 
-    db.cursor.execute("SELECT * FROM item_requests WHERE service_id = %s", (service["id"],))
-    item_request = db.cursor.fetchall()
+    return [{**customer, "services": services.get(customer["id"], [])} for customer in customers]
 
-    return {
-        **service, 
-        "user": user,
-        "repairs": repair,
-        "items": item_request
-        }
 
+def customer_relationship(customer, db: Database, include: set = None):
+    return customers_relationship([customer], db, include)[0]
 
-def product_relationship(product, db: Database):
-    db.cursor.execute("SELECT * FROM product_variants WHERE product_id = %s", (product["id"],))
-    variants = db.cursor.fetchall()
-    product["variants"] = variants
 
-    return {
-        **product, 
-        "variants": variants
-        }
+def services_relationship(services: list, db: Database, include: set = None, archived: bool = False) -> list:
+    if not services:
+        return []
+    related = [{} for _ in services]
+    ids = [service["id"] for service in services]
 
+    if include is None or "user" in include:
+        db.cursor.execute(
+            f"SELECT {columns('customers')} FROM customers WHERE id = ANY(%s)", (list({service["customer_id"] for service in services}),)
+        )
+        users = {user["id"]: user for user in db.cursor.fetchall()}
+        for service, fields in zip(services, related):
+            fields["user"] = users.get(service["customer_id"])
 
-def variant_relationship(variant, db: Database):
-    db.cursor.execute("SELECT * FROM products WHERE id = %s", (variant["product_id"],))
-    product = db.cursor.fetchone()
+    if include is None or "repairs" in include:
+        db.cursor.execute(f"SELECT {columns('repairs')} FROM {archive_table('repairs', archived)} WHERE service_id = ANY(%s)", (ids,))
+        repairs = _grouped(db.cursor.fetchall(), "service_id")
+        for service, fields in zip(services, related):
+            fields["repairs"] = repairs.get(service["id"], [])
 
-    return {
-        **variant, 
-        "product": product
-        }
+    if include is None or "items" in include:
+        dates = [service.get("date") for service in services]
+        if archived:
+            db.cursor.execute(f"SELECT {columns('item_requests')} FROM item_requests_archive WHERE service_id = ANY(%s)", (ids,))
+        #the oldest service date bounds the item_requests partitions to scan when the rows have it
+        elif None not in dates:
+            db.cursor.execute(
+                f"SELECT {columns('item_requests')} FROM item_requests WHERE service_id = ANY(%s) AND created_at >= %s", (ids, min(dates))
+            )
+        else:
+            db.cursor.execute(f"SELECT {columns('item_requests')} FROM item_requests WHERE service_id = ANY(%s)", (ids,))
+        items = _grouped(db.cursor.fetchall(), "service_id")
+        for service, fields in zip(services, related):
+            fields["items"] = items.get(service["id"], [])
 
+    return [{**service, **fields} for service, fields in zip(services, related)]
 
-def type_of_service_relationship(service_type, db: Database):
-    db.cursor.execute("SELECT * FROM service_requests WHERE id = %s", (service_type["service_id"],))
-    service = db.cursor.fetchone()
 
-    return {
-        **service_type, 
-        "service": service
-        }
+def service_relationship(service, db: Database, include: set = None, archived: bool = False):
+    return services_relationship([service], db, include, archived)[0]
+
+
+def products_relationship(products: list, db: Database, include: set = None) -> list:
+    if not products or (include is not None and "variants" not in include):
+        return [{**product} for product in products]
+
+    db.cursor.execute(
+        f"SELECT {columns('product_variants')} FROM product_variants WHERE product_id = ANY(%s)",
+        ([product["id"] for product in products],)
+    )
+    variants = _grouped(db.cursor.fetchall(), "product_id")
+
+    return [{**product, "variants": variants.get(product["id"], [])} for product in products]
+
+
+def product_relationship(product, db: Database, include: set = None):
+    return products_relationship([product], db, include)[0]
+
+
+def variants_relationship(variants: list, db: Database, include: set = None) -> list:
+    if not variants or (include is not None and "product" not in include):
+        return [{**variant} for variant in variants]
+
+    db.cursor.execute(
+        f"SELECT {columns('products')} FROM products WHERE id = ANY(%s)",
+        (list({variant["product_id"] for variant in variants}),)
+    )
+    products = {product["id"]: product for product in db.cursor.fetchall()}
+
+    return [{**variant, "product": products.get(variant["product_id"])} for variant in variants]
+
+
+def variant_relationship(variant, db: Database, include: set = None):
+    return variants_relationship([variant], db, include)[0]
+
+
+#repairs and item requests with their service
+def types_of_service_relationship(service_types: list, db: Database, include: set = None, archived: bool = False) -> list:
+    if not service_types or (include is not None and "service" not in include):
+        return [{**service_type} for service_type in service_types]
+
+    db.cursor.execute(
+        f"SELECT {columns('service_requests')} FROM {archive_table('service_requests', archived)} WHERE id = ANY(%s)",
+        (list({service_type["service_id"] for service_type in service_types}),)
+    )
+    services = {service["id"]: service for service in db.cursor.fetchall()}
+
+    return [{**service_type, "service": services.get(service_type["service_id"])} for service_type in service_types]
+
+
+def type_of_service_relationship(service_type, db: Database, include: set = None, archived: bool = False):
+    return types_of_service_relationship([service_type], db, include, archived)[0]
 
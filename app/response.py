@@ -1,6 +1,6 @@
 from pydantic import BaseModel, EmailStr, Field
 from typing import Optional, Literal, List
-from datetime import datetime
+from datetime import datetime, date
 
 #PYDANTIC validators
 
@@ -33,6 +33,9 @@ class BaseProductResponse(BaseModel):
     price: float
     stock_quantity: int
     created_at: datetime
+    total_variant_stock: int = 0
+    in_stock_variant_count: int = 0
+    available_sizes: List[str] = Field(default_factory=list)
 
     class Config:
         orm_mode = True
@@ -103,6 +106,9 @@ class ProductResponse(BaseModel):
     price: float
     stock_quantity: int
     created_at: datetime
+    total_variant_stock: int = 0        #availability derived from the variants
+    in_stock_variant_count: int = 0
+    available_sizes: List[str] = Field(default_factory=list)
     variants: Optional[List[BaseProductVariantResponse]] = Field(default_factory=list)
 
     class Config:
@@ -142,4 +148,57 @@ class ItemRequestResponse(BaseModel):
     service: BaseServiceResponse    #uses BaseServiceResponse as a response model
 
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+
+#Batch fetch by ids: results in request order, ids that were not found in missing
+class CustomerBatchResponse(BaseModel):
+    results: List[CustomerResponse]
+    missing: List[int]
+
+class ProductBatchResponse(BaseModel):
+    results: List[ProductResponse]
+    missing: List[int]
+
+class ProductVariantBatchResponse(BaseModel):
+    results: List[ProductVariantResponse]
+    missing: List[int]
+
+class StockSyncResponse(BaseModel):
+    received: int       #rows after dropping duplicate (product_id, size, color) keys
+    inserted: int
+    updated: int
+    unchanged: int
+
+#Repair analytics, durations in seconds. None when there is nothing to measure
+class Percentiles(BaseModel):
+    p50: Optional[float] = None
+    p90: Optional[float] = None
+    p99: Optional[float] = None
+    avg: Optional[float] = None
+    max: Optional[float] = None
+
+class TurnaroundResponse(BaseModel):
+    start: date
+    end: date
+    repairs: int        #created in the range
+    started: int
+    finished: int
+    wait_seconds: Percentiles   #created to started
+    work_seconds: Percentiles   #started to finished
+
+class ThroughputDay(BaseModel):
+    day: date
+    created: int
+    finished: int
+
+class ThroughputResponse(BaseModel):
+    start: date
+    end: date
+    days: List[ThroughputDay]
+
+class BacklogResponse(BaseModel):
+    pending: int
+    in_progress: int
+    pending_age_seconds: Percentiles        #since created
+    in_progress_age_seconds: Percentiles    #since started
\ No newline at end of file
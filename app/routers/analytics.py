@@ -0,0 +1,43 @@
+from datetime import date, timedelta
+from fastapi import APIRouter, Depends, HTTPException, status
+from typing import Optional
+from ..body import TokenData
+from ..response import TurnaroundResponse, ThroughputResponse, BacklogResponse
+from ..config import settings
+from ..oauth2 import get_current_user
+from ..cache import TTLCache
+from .. import analytics
+
+router = APIRouter(
+    prefix="/analytics/repairs",
+    tags=["Analytics"]
+)
+
+#a dashboard refresh within analytics_cache_seconds is served from memory
+cache = TTLCache("analytics", settings.analytics_cache_seconds)
+
+
+#the last 30 days by default, start inclusive and end exclusive
+def date_range(start: Optional[date] = None, end: Optional[date] = None) -> tuple:
+    end = end or date.today() + timedelta(days=1)
+    start = start or end - timedelta(days=30)
+    if start >= end:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="start must be before end")
+    if (end - start).days > settings.analytics_max_days:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"At most {settings.analytics_max_days} days per request")
+    return start, end
+
+
+@router.get("/turnaround", response_model=TurnaroundResponse)
+def get_turnaround(days: tuple = Depends(date_range), current_user: TokenData = Depends(get_current_user)):
+    return cache.get(("turnaround",) + days, lambda: analytics.turnaround(*days))
+
+
+@router.get("/throughput", response_model=ThroughputResponse)
+def get_throughput(days: tuple = Depends(date_range), current_user: TokenData = Depends(get_current_user)):
+    return cache.get(("throughput",) + days, lambda: analytics.throughput(*days))
+
+
+@router.get("/backlog", response_model=BacklogResponse)
+def get_backlog(current_user: TokenData = Depends(get_current_user)):
+    return cache.get(("backlog",), lambda: analytics.backlog())
@@ -1,67 +1,116 @@
-from ..database import Database
-from fastapi import APIRouter, status, Depends, HTTPException
-from ..body import Customer, TokenData
+from ..database import Database, session
+from fastapi import APIRouter, status, Depends, HTTPException, Response
+from ..body import Customer, TokenData, BatchIds
 from ..update import CustomerPut, CustomerPatch, dynamic_patch_query
-from ..response import CustomerResponse
-from typing import List
+from ..response import CustomerResponse, CustomerBatchResponse
+from typing import List, Optional
 from ..status_code import validate_customer_exists, exception, validate_customer_ownership
 from ..utils import hash
-from ..oauth2 import get_current_user
-from ..relationships import customer_relationship
+from ..oauth2 import get_current_user, revoke_refresh_tokens
+from ..relationships import customer_relationship, customers_relationship
+from ..fieldsets import Fieldset, fieldset
+from ..batch import id_list, unique_ids, in_order, with_missing
+from ..pagination import Page, page, total, with_total
+from ..shards import shards, get_customer_db, register_customer, unregister_customer, rename_customer, restore_customer_email
 
 router = APIRouter(
     prefix="/customers",
     tags=["Customers"]
 )
 
-db = Database()
+#customers by id from the shards that own them, with their relationships. (customers in the ids' order, missing ids)
+def customers_by_id(ids: list, fields: Fieldset) -> tuple:
+    groups = shards.group(ids)
+
+    def fetch(db: Database, shard: int) -> list:
+        db.cursor.execute(f"SELECT {fields.select('id')} FROM customers WHERE id = ANY(%s)", (groups[shard],))
+        return customers_relationship(db.cursor.fetchall(), db, fields.relations())
+
+    return in_order([customer for customers in shards.scatter(fetch, list(groups)) for customer in customers], ids)
+
 
 @router.get("/", response_model=List[CustomerResponse])
-def get_customers():
-    db.cursor.execute("SELECT * FROM customers")
-    customers = db.cursor.fetchall()
+def get_customers(response: Response, ids: Optional[list] = Depends(id_list), paging: Page = Depends(page), fields: Fieldset = Depends(fieldset("customers"))):
+    missing = []
+    if ids is None:
+        def fetch(db: Database, shard_page: Page) -> tuple:
+            db.cursor.execute(f"SELECT {fields.select('id')} FROM customers{shard_page.clause()}")
+            customers = db.cursor.fetchall()
+            return customers, total(db, shard_page, customers, "customers")
+
+        pairs, counted = shards.scatter_page(paging, fetch, lambda customer: customer["id"])
+        customers = shards.scatter_related(pairs, lambda customers, db: customers_relationship(customers, db, fields.relations()))
+    else:
+        customers, missing = customers_by_id(ids, fields)
+        counted = (len(customers), "exact")
     
-    return [customer_relationship(customer, db) for customer in customers]
+    result = fields.respond(customers)
+    return with_total(with_missing(result, response, missing), response, counted)
+
+
+@router.post("/batch", response_model=CustomerBatchResponse)
+def get_customers_batch(batch: BatchIds, fields: Fieldset = Depends(fieldset("customers"))):
+    customers, missing = customers_by_id(unique_ids(batch.ids), fields)
+
+    return fields.respond_batch(customers, missing)
 
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=CustomerResponse)
 def create_customer(customer:Customer):
+    customer_id = None
     try:
         customer.password = hash(customer.password)
-        db.cursor.execute(
-            "INSERT INTO customers (name, email, password, address) VALUES (%s, %s, %s, %s) RETURNING *", 
-            tuple(customer.dict().values())
-            )
-        new_customer = db.cursor.fetchone()
+        #when sharded the id comes from the customer directory and decides the shard, otherwise from customers.id
+        customer_id = register_customer(customer.email)
+        columns, values = ("name", "email", "password", "address"), tuple(customer.dict().values())
+        if customer_id is not None:
+            columns, values = ("id",) + columns, (customer_id,) + values
+
+        with session(shards.pool(customer_id)) as db:
+            try:
+                db.cursor.execute(
+                    f"INSERT INTO customers ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(values))}) RETURNING *",
+                    values
+                    )
+                new_customer = db.cursor.fetchone()
+
+                db.conn.commit()
+                return new_customer
+
+            except Exception:
+                db.conn.rollback()
+                raise
 
-        db.conn.commit()
-        return new_customer
+    except HTTPException as http_error:
+        unregister_customer(customer_id)
+        raise http_error
     
     except Exception as e:
-        db.conn.rollback()
+        unregister_customer(customer_id)
         exception(e)
 
 
 @router.get("/{customer_id}", response_model=CustomerResponse)
-def get_customer(customer_id:int):
-    db.cursor.execute("SELECT * FROM customers WHERE id = %s", (customer_id,))
+def get_customer(customer_id:int, fields: Fieldset = Depends(fieldset("customers")), db: Database = Depends(get_customer_db)):
+    db.cursor.execute(f"SELECT {fields.select('id')} FROM customers WHERE id = %s", (customer_id,))
     customer = db.cursor.fetchone()
     validate_customer_exists(customer, customer_id)
 
-    return customer_relationship(customer, db)
+    return fields.respond(customer_relationship(customer, db, fields.relations()))
 
 
 @router.delete("/{customer_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_custoemr(customer_id: int, current_user: TokenData = Depends(get_current_user)):
+def delete_custoemr(customer_id: int, current_user: TokenData = Depends(get_current_user), db: Database = Depends(get_customer_db)):
     try:
-        db.cursor.execute(
-            "DELETE FROM customers WHERE id = %s RETURNING *", (customer_id,)
-        )
+        #ownership comes from the token, a forbidden request never reaches the database
+        validate_customer_ownership(customer_id, current_user.id)
+
+        db.cursor.execute("DELETE FROM customers WHERE id = %s RETURNING id", (current_user.id,))
         customer = db.cursor.fetchone()
         validate_customer_exists(customer, customer_id)
-        validate_customer_ownership(customer["id"], current_user.id)
 
         db.conn.commit()
+        unregister_customer(current_user.id)
         return
 
     #raises the errors captured from status_code.py
@@ -75,18 +124,24 @@ def delete_custoemr(customer_id: int, current_user: TokenData = Depends(get_curr
 
 
 @router.put("/{customer_id}", response_model=CustomerResponse)
-def put_customer(customer_id: int, customer: CustomerPut, current_user: TokenData = Depends(get_current_user)):
+def put_customer(customer_id: int, customer: CustomerPut, current_user: TokenData = Depends(get_current_user), db: Database = Depends(get_customer_db)):
+    renamed_from = None
     try:
+        validate_customer_ownership(customer_id, current_user.id)
+
         customer.password = hash(customer.password)
         db.cursor.execute(
             "UPDATE customers SET name = %s, email = %s, password = %s, address = %s WHERE id = %s RETURNING *" ,
-            (tuple(customer.dict().values()) + (customer_id,))
+            (tuple(customer.dict().values()) + (current_user.id,))
             )
         updated_customer = db.cursor.fetchone()
         validate_customer_exists(updated_customer, customer_id)
-        validate_customer_ownership(updated_customer["id"], current_user.id)
+        #a new password logs out every other session
+        revoke_refresh_tokens(db, current_user.id)
+        renamed_from = rename_customer(current_user.id, customer.email)
 
         db.conn.commit()
+        renamed_from = None
         return customer_relationship(updated_customer, db)
     
     except HTTPException as http_error:
@@ -94,20 +149,28 @@ def put_customer(customer_id: int, customer: CustomerPut, current_user: TokenDat
     
     except Exception as e:
         db.conn.rollback()
+        restore_customer_email(current_user.id, renamed_from)
         exception(e)
 
 
 @router.patch("/{customer_id}", response_model=CustomerResponse)
-def patch_customer(customer_id: int, customer: CustomerPatch, current_user: TokenData = Depends(get_current_user)):
+def patch_customer(customer_id: int, customer: CustomerPatch, current_user: TokenData = Depends(get_current_user), db: Database = Depends(get_customer_db)):
+    renamed_from = None
     try:
-        customer.password = hash(customer.password)
-        sql, values = dynamic_patch_query("customers", customer.dict(exclude_unset=True), table_id=customer_id)
+        validate_customer_ownership(customer_id, current_user.id)
+
+        if customer.password is not None:
+            customer.password = hash(customer.password)
+        sql, values = dynamic_patch_query("customers", customer.dict(exclude_unset=True), table_id=current_user.id)
         db.cursor.execute(sql, values)
         updated_customer = db.cursor.fetchone()
         validate_customer_exists(updated_customer, customer_id)
-        validate_customer_ownership(updated_customer["id"], current_user.id)
+        if customer.password is not None:
+            revoke_refresh_tokens(db, current_user.id)
+        renamed_from = rename_customer(current_user.id, customer.email)
 
         db.conn.commit()
+        renamed_from = None
         return customer_relationship(updated_customer, db)
     
     except HTTPException as http_error:
@@ -115,5 +178,6 @@ def patch_customer(customer_id: int, customer: CustomerPatch, current_user: Toke
     
     except Exception as e:
         db.conn.rollback()
+        restore_customer_email(current_user.id, renamed_from)
         exception(e)
 
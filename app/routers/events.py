@@ -0,0 +1,114 @@
+import asyncio
+import heapq
+import json
+from fastapi import APIRouter, Header, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from typing import Optional
+from ..database import session
+from ..events import QUEUE_SIZE, feed, last_event_id, replay
+from ..shards import shards
+
+router = APIRouter(
+    tags=["Repair Events"]
+)
+
+KEEP_ALIVE_SECONDS = 15
+
+
+def format_event(event: dict, event_id: str) -> str:
+    return f"id: {event_id}\nevent: repair\ndata: {json.dumps(event)}\n\n"
+
+
+#The event id is where a reconnect resumes from: the highest repair_events id sent. The shop-wide stream over sharded
+#customers gets its events from every shard, its ids are the highest id of each shard joined by dots ("120.97")
+
+def parse_positions(last_event_id: Optional[str], shard_count: int) -> Optional[list]:
+    parts = last_event_id.split(".") if last_event_id else []
+    if len(parts) != shard_count or not all(part.isdigit() for part in parts):
+        return None
+    return [int(part) for part in parts]
+
+
+def latest_positions() -> list:
+    return shards.scatter(lambda db, shard: last_event_id(db))
+
+
+#(position, event) pairs after the positions, the shards' backlogs merged by time, and whether a backlog was cut
+#at QUEUE_SIZE events
+def load_backlog(positions: list, customer_id: Optional[int], service_id: Optional[int]) -> tuple:
+    if len(positions) == 1:
+        with session(shards.pool(customer_id)) as db:
+            backlogs = [replay(db, positions[0], customer_id, service_id)]
+    else:
+        backlogs = shards.scatter(lambda db, shard: replay(db, positions[shard]))
+    pairs = heapq.merge(*([(shard, event) for event in events] for shard, events in enumerate(backlogs)),
+                        key=lambda pair: pair[1]["created_at"])
+    return list(pairs), any(len(events) >= QUEUE_SIZE for events in backlogs)
+
+
+#Server-Sent Events: backlog after Last-Event-ID first, then live notifications until the client disconnects
+async def stream(request: Request, last_event_id: Optional[str], customer_id: int = None, service_id: int = None):
+    subscriber = feed.subscribe(customer_id, service_id)     #subscribe before replaying so nothing falls in between
+    try:
+        yield "retry: 3000\n\n"
+        vector = customer_id is None and shards.sharded
+        positions = parse_positions(last_event_id, len(shards.pools) if vector else 1)
+        if positions is None and vector:
+            positions = await run_in_threadpool(latest_positions)
+        replayed = set()
+        if positions is not None:
+            backlog, cut = await run_in_threadpool(load_backlog, positions, customer_id, service_id)
+            for position, event in backlog:
+                positions[position] = event["id"]
+                replayed.add(event["id"])
+                yield format_event(event, ".".join(map(str, positions)))
+            #more backlog than one replay: end here, the client reconnects from where it got to
+            if cut:
+                return
+        positions = positions or [0]
+
+        while not await request.is_disconnected():
+            if subscriber.lagging and subscriber.queue.empty():
+                break
+            try:
+                event = await asyncio.wait_for(subscriber.queue.get(), KEEP_ALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+
+            if event is None:
+                break
+            #ids are taken before commit, a lower id can arrive after a higher one: only skip what was replayed
+            shard, event = event
+            if event["id"] in replayed:
+                continue
+            position = shard if vector else 0
+            positions[position] = max(positions[position], event["id"])
+            yield format_event(event, ".".join(map(str, positions)))
+
+    finally:
+        feed.unsubscribe(subscriber)
+
+
+def event_stream(request: Request, last_event_id: Optional[str], customer_id: int = None, service_id: int = None):
+    return StreamingResponse(
+        stream(request, last_event_id, customer_id, service_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.get("/repairs/events")
+async def shop_repair_events(request: Request, last_event_id: Optional[str] = Header(None)):
+    return event_stream(request, last_event_id)
+
+
+@router.get("/customers/{customer_id}/repairs/events")
+async def customer_repair_events(customer_id: int, request: Request, last_event_id: Optional[str] = Header(None)):
+    return event_stream(request, last_event_id, customer_id)
+
+
+@router.get("/customers/{customer_id}/services/{service_id}/repairs/events")
+async def service_repair_events(customer_id: int, service_id: int, request: Request, last_event_id: Optional[str] = Header(None)):
+    return event_stream(request, last_event_id, customer_id, service_id)
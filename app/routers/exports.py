@@ -0,0 +1,50 @@
+from datetime import date
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import StreamingResponse
+from typing import Optional
+from ..oauth2 import get_staff
+from ..exports import Export, date_range, SALES, REPAIRS
+
+router = APIRouter(
+    prefix="/exports",
+    tags=["Exports"],
+    dependencies=[Depends(get_staff)]       #every customer's rows: staff only
+)
+
+
+#returns the export's connection even when the body was never iterated (client gone before the first chunk)
+class ExportResponse(StreamingResponse):
+    def __init__(self, export: Export, **kwargs):
+        super().__init__(iter(export), **kwargs)
+        self.export = export
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.export.close()
+
+
+def csv_response(name: str, query: str, column: str, start: Optional[date], end: Optional[date]) -> StreamingResponse:
+    if start is not None and end is not None and start >= end:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="start must be before end")
+
+    sql, params = date_range(query, column, start, end)
+    filename = "_".join([name] + [str(day) for day in (start, end) if day is not None]) + ".csv"
+    return ExportResponse(
+        Export(sql, params),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+#item requests with their variant and product, start inclusive and end exclusive
+@router.get("/sales.csv")
+def export_sales(start: Optional[date] = None, end: Optional[date] = None):
+    return csv_response("sales", SALES, "item.created_at", start, end)
+
+
+#repairs with their service and customer
+@router.get("/repairs.csv")
+def export_repairs(start: Optional[date] = None, end: Optional[date] = None):
+    return csv_response("repairs", REPAIRS, "repair.created_at", start, end)
@@ -0,0 +1,21 @@
+from fastapi import APIRouter, status
+from fastapi.responses import JSONResponse
+from ..shards import shards
+
+router = APIRouter(
+    tags=["Health"]
+)
+
+
+#liveness: the process answers, no database work
+@router.get("/health")
+def health():
+    return {"status": "ok"}
+
+
+#readiness: only once the tables exist and the connection pools (catalog and customer shards) are warm
+@router.get("/ready")
+def ready():
+    if not all(source.warm for source in shards.all_pools()):
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"status": "starting"})
+    return {"status": "ready"}
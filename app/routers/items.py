@@ -1,41 +1,62 @@
-from fastapi import APIRouter, status, HTTPException, Depends
+from fastapi import APIRouter, status, HTTPException, Depends, Header
 from ..body import ItemRequest, TokenData
 from ..response import ItemRequestResponse
-from ..update import ItemRequestPatch, ItemRequestPut, dynamic_patch_query
+from ..update import ItemRequestPatch, ItemRequestPut
 from ..database import Database
-from typing import List
+from ..shards import get_customer_db, catalog
+from typing import List, Optional
 from ..status_code import validate_variant_exists, validate_service_type, validate_service_exists, validate_customer_exists, validate_item_request_exists, exception, validate_customer_ownership
 from ..oauth2 import get_current_user
-from ..relationships import type_of_service_relationship
+from ..relationships import type_of_service_relationship, types_of_service_relationship
+from ..fieldsets import Fieldset, fieldset
+from ..archive import fetch_one
+from ..idempotency import replay, remember
 
 router = APIRouter(
     prefix="/customers/{customer_id}/services/{service_id}/items",
     tags=["Item Requests"]
 )
 
-db = Database()
+
+#UPDATE of an item of the service, bounded by the service date like the reads so only the newer partitions are probed
+def item_update_query(data: dict, item_id: int, service: dict) -> tuple[str, tuple]:
+    set_clause = ", ".join(f"{k} = %s" for k in data)
+    sql = f"UPDATE item_requests SET {set_clause} WHERE id = %s AND service_id = %s AND created_at >= %s RETURNING *"
+    return sql, tuple(data.values()) + (item_id, service["id"], service["date"])
 
 
 @router.get("/", response_model=List[ItemRequestResponse])
-def get_item_requests(customer_id: int, service_id: int):
+def get_item_requests(customer_id: int, service_id: int, fields: Fieldset = Depends(fieldset("item_requests")), db: Database = Depends(get_customer_db)):
     db.cursor.execute("SELECT * FROM customers WHERE id = %s", (customer_id,))
     customer = db.cursor.fetchone()
     validate_customer_exists(customer, customer_id)
 
-    db.cursor.execute("SELECT * FROM service_requests WHERE id = %s AND customer_id = %s", (service_id, customer_id))
-    service = db.cursor.fetchone()
+    #an archived service has all of its items in the archive
+    service, archived = fetch_one(db, "service_requests", "*", "id = %s AND customer_id = %s", (service_id, customer_id))
     validate_service_exists(service, service_id)
     validate_service_type(service, "sale")
 
-    db.cursor.execute("SELECT * FROM item_requests WHERE service_id = %s", (service_id,))
+    if archived:
+        db.cursor.execute(f"SELECT {fields.select('service_id')} FROM item_requests_archive WHERE service_id = %s", (service_id,))
+    else:
+        #items are never older than their service: the date bound prunes the older item_requests partitions
+        db.cursor.execute(
+            f"SELECT {fields.select('service_id')} FROM item_requests WHERE service_id = %s AND created_at >= %s", (service_id, service["date"])
+        )
     item_requests = db.cursor.fetchall()
 
-    return [type_of_service_relationship(item_request, db) for item_request in item_requests]
+    return fields.respond(types_of_service_relationship(item_requests, db, fields.relations(), archived))
 
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=ItemRequestResponse)
-def create_item_request(customer_id: int, service_id: int, item: ItemRequest, current_user: TokenData = Depends(get_current_user)):
+def create_item_request(customer_id: int, service_id: int, item: ItemRequest, idempotency_key: Optional[str] = Header(None, max_length=255),
+                        current_user: TokenData = Depends(get_current_user), db: Database = Depends(get_customer_db)):
     try:
+        route = f"/customers/{customer_id}/services/{service_id}/items/"
+        replayed = replay(db, idempotency_key, current_user.id, route, item)
+        if replayed is not None:
+            return replayed
+
         db.cursor.execute("SELECT * FROM customers WHERE id = %s", (customer_id,))
         customer = db.cursor.fetchone()
         validate_customer_exists(customer, customer_id)
@@ -46,8 +67,10 @@ def create_item_request(customer_id: int, service_id: int, item: ItemRequest, cu
         validate_service_type(service, "sale")
         validate_customer_ownership(service["customer_id"], current_user.id)
 
-        db.cursor.execute("SELECT * FROM product_variants WHERE id = %s", (item.product_variant_id,))
-        product_variant = db.cursor.fetchone()
+        #product_variants is in the catalog database, there is no foreign key to it on a customer shard
+        with catalog(db) as catalog_db:
+            catalog_db.cursor.execute("SELECT * FROM product_variants WHERE id = %s", (item.product_variant_id,))
+            product_variant = catalog_db.cursor.fetchone()
         validate_variant_exists(product_variant, item.product_variant_id)
 
         item_request_data = item.dict()
@@ -57,10 +80,11 @@ def create_item_request(customer_id: int, service_id: int, item: ItemRequest, cu
             "INSERT INTO item_requests (product_variant_id, quantity, unit_price, service_id) VALUES (%s, %s, %s, %s) RETURNING *", 
             tuple(item_request_data.values())
             )
-        created_item_request = db.cursor.fetchone()
+        created_item_request = type_of_service_relationship(db.cursor.fetchone(), db)
 
+        remember(db, idempotency_key, current_user.id, route, item, status.HTTP_201_CREATED, ItemRequestResponse(**created_item_request))
         db.conn.commit()
-        return type_of_service_relationship(created_item_request, db)
+        return created_item_request
     
     except HTTPException as http_error:
         raise http_error
@@ -71,25 +95,32 @@ def create_item_request(customer_id: int, service_id: int, item: ItemRequest, cu
 
 
 @router.get("/{item_id}", response_model=ItemRequestResponse)
-def get_item_by_id(customer_id: int, service_id: int, item_id: int):
+def get_item_by_id(customer_id: int, service_id: int, item_id: int, fields: Fieldset = Depends(fieldset("item_requests")), db: Database = Depends(get_customer_db)):
     db.cursor.execute("SELECT * FROM customers WHERE id = %s", (customer_id,))
     customer = db.cursor.fetchone()
     validate_customer_exists(customer, customer_id)
     
-    db.cursor.execute("SELECT * FROM service_requests WHERE id = %s AND customer_id = %s", (service_id, customer_id))
-    service = db.cursor.fetchone()
+    service, archived = fetch_one(db, "service_requests", "*", "id = %s AND customer_id = %s", (service_id, customer_id))
     validate_service_exists(service, service_id)
     validate_service_type(service, "sale")
 
-    db.cursor.execute("SELECT * FROM item_requests WHERE id = %s AND service_id = %s", (item_id, service_id))
+    if archived:
+        db.cursor.execute(
+            f"SELECT {fields.select('service_id')} FROM item_requests_archive WHERE id = %s AND service_id = %s", (item_id, service_id)
+        )
+    else:
+        db.cursor.execute(
+            f"SELECT {fields.select('service_id')} FROM item_requests WHERE id = %s AND service_id = %s AND created_at >= %s",
+            (item_id, service_id, service["date"])
+        )
     item_request = db.cursor.fetchone()
     validate_item_request_exists(item_request, item_id)
 
-    return type_of_service_relationship(item_request, db)
+    return fields.respond(type_of_service_relationship(item_request, db, fields.relations(), archived))
 
 
 @router.delete("/{item_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_item_request(customer_id: int, service_id: int, item_id: int, current_user: TokenData = Depends(get_current_user)):
+def delete_item_request(customer_id: int, service_id: int, item_id: int, current_user: TokenData = Depends(get_current_user), db: Database = Depends(get_customer_db)):
     try:
         db.cursor.execute("SELECT * FROM customers WHERE id = %s", (customer_id,))
         customer = db.cursor.fetchone()
@@ -101,7 +132,9 @@ def delete_item_request(customer_id: int, service_id: int, item_id: int, current
         validate_service_type(service, "sale")
         validate_customer_ownership(service["customer_id"], current_user.id)
 
-        db.cursor.execute("DELETE FROM item_requests WHERE id = %s AND service_id = %s RETURNING *", (item_id, service_id))
+        db.cursor.execute(
+            "DELETE FROM item_requests WHERE id = %s AND service_id = %s AND created_at >= %s RETURNING *", (item_id, service_id, service["date"])
+        )
         item_request = db.cursor.fetchone()
         validate_item_request_exists(item_request, item_id)
         
@@ -117,7 +150,7 @@ def delete_item_request(customer_id: int, service_id: int, item_id: int, current
     
 
 @router.put("/{item_id}", response_model=ItemRequestResponse)
-def put_item_request(customer_id: int, service_id: int, item_id: int, item: ItemRequestPut, current_user: TokenData = Depends(get_current_user)):
+def put_item_request(customer_id: int, service_id: int, item_id: int, item: ItemRequestPut, current_user: TokenData = Depends(get_current_user), db: Database = Depends(get_customer_db)):
     try:
         db.cursor.execute("SELECT * FROM customers WHERE id = %s", (customer_id,))
         customer = db.cursor.fetchone()
@@ -129,7 +162,9 @@ def put_item_request(customer_id: int, service_id: int, item_id: int, item: Item
         validate_service_type(service, "sale")
         validate_customer_ownership(service["customer_id"], current_user.id)
 
-        db.cursor.execute("SELECT * FROM item_requests WHERE id = %s AND service_id = %s", (item_id, service_id))
+        db.cursor.execute(
+            "SELECT * FROM item_requests WHERE id = %s AND service_id = %s AND created_at >= %s", (item_id, service_id, service["date"])
+        )
         existing_item = db.cursor.fetchone()
         validate_item_request_exists(existing_item, item_id)
 
@@ -141,12 +176,7 @@ def put_item_request(customer_id: int, service_id: int, item_id: int, item: Item
                 raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Product variant cannot be changed after creation")
             update_data.pop("product_variant_id")
 
-        def dynamic_patch_query(table: str, data: dict, table_id: int, service_id: int) -> tuple[str, tuple]:
-            set_clause = ", ".join(f"{k} = %s" for k in data)                      
-            sql = f"UPDATE {table} SET {set_clause} WHERE id = %s AND service_id = %s RETURNING *"     
-            return sql, tuple(data.values()) + (table_id, service_id)         
-        
-        sql, values = dynamic_patch_query("item_requests", data=item.dict(exclude_unset=True), table_id=item_id, service_id=service_id)
+        sql, values = item_update_query(item.dict(exclude_unset=True), item_id, service)
         db.cursor.execute(sql, values)
         updated_item_request = db.cursor.fetchone()
         
@@ -162,7 +192,7 @@ def put_item_request(customer_id: int, service_id: int, item_id: int, item: Item
 
 
 @router.patch("/{item_id}", response_model=ItemRequestResponse)
-def put_item_request(customer_id: int, service_id: int, item_id: int, item: ItemRequestPatch, current_user: TokenData = Depends(get_current_user)):
+def put_item_request(customer_id: int, service_id: int, item_id: int, item: ItemRequestPatch, current_user: TokenData = Depends(get_current_user), db: Database = Depends(get_customer_db)):
     try:
         db.cursor.execute("SELECT * FROM customers WHERE id = %s", (customer_id,))
         customer = db.cursor.fetchone()
@@ -174,7 +204,9 @@ def put_item_request(customer_id: int, service_id: int, item_id: int, item: Item
         validate_service_type(service, "sale")
         validate_customer_ownership(service["customer_id"], current_user.id)
 
-        db.cursor.execute("SELECT * FROM item_requests WHERE id = %s AND service_id = %s", (item_id, service_id))
+        db.cursor.execute(
+            "SELECT * FROM item_requests WHERE id = %s AND service_id = %s AND created_at >= %s", (item_id, service_id, service["date"])
+        )
         existing_item = db.cursor.fetchone()
         validate_item_request_exists(existing_item, item_id)
 
@@ -190,7 +222,7 @@ def put_item_request(customer_id: int, service_id: int, item_id: int, item: Item
         if not update_data:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No valid fields provided for update")
         
-        sql, values = dynamic_patch_query("item_requests", data=item.dict(exclude_unset=True), table_id=item_id, service_id=service_id)
+        sql, values = item_update_query(item.dict(exclude_unset=True), item_id, service)
         db.cursor.execute(sql, values)
         updated_item_request = db.cursor.fetchone()
 
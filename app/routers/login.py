@@ -1,29 +1,63 @@
 from fastapi import APIRouter, status, HTTPException, Depends
 from fastapi.security.oauth2 import OAuth2PasswordRequestForm
-from ..body import Token
+from ..body import Token, RefreshToken, TokenData
 from ..utils import verify
-from ..oauth2 import create_token
-from ..database import Database
+from ..oauth2 import create_token, get_current_user, issue_refresh_token, rotate_refresh_token, revoke_refresh_tokens, token_customer
+from ..database import Database, session
+from ..shards import shards, get_user_db, customer_pool
 
 router = APIRouter(
     tags=["Login"]
 )
 
-db = Database()
-
 @router.post("/login", response_model=Token)
 def login(credentials: OAuth2PasswordRequestForm = Depends()):
-    db.cursor.execute("SELECT * FROM customers WHERE email = %s", (credentials.username,))
-    user = db.cursor.fetchone()
-
-    if not user:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
-                            detail="Invalid credentials.")
-    
-    if not verify(credentials.password, user["password"]):
+    #the shard of the email, from the customer directory when customers are sharded
+    source = customer_pool(credentials.username)
+    if source is None:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail="Invalid credentials.")
-    
-    access_token = create_token(data= {"user_id": user["id"]})
 
-    return {"access_token": access_token, "token_type": "bearer", "customer_id": user["id"]}
\ No newline at end of file
+    with session(source) as db:
+        db.cursor.execute("SELECT * FROM customers WHERE email = %s", (credentials.username,))
+        user = db.cursor.fetchone()
+
+        if not user:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                                detail="Invalid credentials.")
+
+        if not verify(credentials.password, user["password"]):
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                                detail="Invalid credentials.")
+
+        access_token = create_token(data= {"user_id": user["id"]})
+        refresh_token = issue_refresh_token(db, user["id"])
+        db.conn.commit()
+
+    return {"access_token": access_token, "token_type": "bearer", "customer_id": user["id"], "refresh_token": refresh_token}
+
+
+#renews the access token without the password, the refresh token is replaced by the returned one
+@router.post("/login/refresh", response_model=Token)
+def refresh(body: RefreshToken):
+    with session(shards.pool(token_customer(body.refresh_token))) as db:
+        rotated = rotate_refresh_token(db, body.refresh_token)
+        #commits the revocation when an already used token came back
+        db.conn.commit()
+
+    if rotated is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="Invalid refresh token.",
+                            headers={"WWW-Authenticate": "Bearer"})
+
+    customer_id, refresh_token = rotated
+    access_token = create_token(data= {"user_id": customer_id})
+
+    return {"access_token": access_token, "token_type": "bearer", "customer_id": customer_id, "refresh_token": refresh_token}
+
+
+#revokes the session of the refresh token, access tokens already issued last until they expire
+@router.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+def logout(body: RefreshToken, current_user: TokenData = Depends(get_current_user), db: Database = Depends(get_user_db)):
+    revoke_refresh_tokens(db, current_user.id, body.refresh_token)
+    db.conn.commit()
@@ -1,30 +1,51 @@
-from fastapi import status, HTTPException, APIRouter
-from typing import List
-from ..body import Product
+from fastapi import status, HTTPException, APIRouter, Depends, Response
+from typing import List, Optional
+from psycopg2.extras import execute_values
+from ..body import Product, BatchIds, VariantStock
 from ..update import ProductPatch, ProductPut, dynamic_patch_query
-from ..response import ProductResponse
-from ..database import Database
-from ..status_code import validate_product_exists, exception
-from ..relationships import product_relationship
+from ..response import ProductResponse, ProductBatchResponse, StockSyncResponse
+from ..database import Database, get_db
+from ..config import settings
+from ..status_code import validate_product_exists, validate_products_exist, exception
+from ..relationships import product_relationship, products_relationship
+from ..fieldsets import Fieldset, fieldset
+from ..batch import id_list, unique_ids, in_order, with_missing
+from ..pagination import Page, page, total, with_total
 
 router = APIRouter(
     prefix="/products",
     tags=["Products"]
 )
 
-db = Database()
-
 
 @router.get("/", response_model=List[ProductResponse])
-def get_products():
-    db.cursor.execute("SELECT * FROM products")
-    products = db.cursor.fetchall()
+def get_products(response: Response, ids: Optional[list] = Depends(id_list), paging: Page = Depends(page), fields: Fieldset = Depends(fieldset("products")),
+                 db: Database = Depends(get_db)):
+    missing = []
+    if ids is None:
+        db.cursor.execute(f"SELECT {fields.select('id')} FROM products{paging.clause()}")
+        products = db.cursor.fetchall()
+        counted = total(db, paging, products, "products")
+    else:
+        db.cursor.execute(f"SELECT {fields.select('id')} FROM products WHERE id = ANY(%s)", (ids,))
+        products, missing = in_order(db.cursor.fetchall(), ids)
+        counted = (len(products), "exact")
+
+    result = fields.respond(products_relationship(products, db, fields.relations()))
+    return with_total(with_missing(result, response, missing), response, counted)
+
 
-    return [product_relationship(product, db) for product in products]
+@router.post("/batch", response_model=ProductBatchResponse)
+def get_products_batch(batch: BatchIds, fields: Fieldset = Depends(fieldset("products")), db: Database = Depends(get_db)):
+    ids = unique_ids(batch.ids)
+    db.cursor.execute(f"SELECT {fields.select('id')} FROM products WHERE id = ANY(%s)", (ids,))
+    products, missing = in_order(db.cursor.fetchall(), ids)
+
+    return fields.respond_batch(products_relationship(products, db, fields.relations()), missing)
 
 
 @router.post("/", status_code=status.HTTP_201_CREATED)
-def create_product(product: Product):
+def create_product(product: Product, db: Database = Depends(get_db)):
     try:
         db.cursor.execute(
             "INSERT INTO products (name, description, price, stock_quantity) VALUES (%s, %s, %s, %s) RETURNING *",
@@ -43,17 +64,67 @@ def create_product(product: Product):
         exception(e)
 
 
+#Nightly warehouse sync: stock levels keyed by (product_id, size, color), upserted by one INSERT ... ON CONFLICT DO UPDATE.
+#Variants whose stock is already right aren't written and not returned, xmax = 0 tells an inserted row from an updated one
+@router.post("/stock-sync", response_model=StockSyncResponse)
+def sync_stock(rows: List[VariantStock], db: Database = Depends(get_db)):
+    if len(rows) > settings.stock_sync_max_rows:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {settings.stock_sync_max_rows} rows per request, got {len(rows)}"
+        )
+
+    #last row wins for a repeated key
+    stock = {(row.product_id, row.size, row.color): row.stock_quantity for row in rows}
+    #key order: concurrent syncs lock the variants they share in the same order instead of deadlocking
+    values = [key + (quantity,) for key, quantity in sorted(stock.items())]
+    if not values:
+        return {"received": 0, "inserted": 0, "updated": 0, "unchanged": 0}
+
+    try:
+        product_ids = list({product_id for product_id, _, _ in stock})
+        db.cursor.execute("SELECT id FROM products WHERE id = ANY(%s)", (product_ids,))
+        validate_products_exist([row["id"] for row in db.cursor.fetchall()], product_ids)
+
+        #page_size: every row goes into the one statement
+        written = execute_values(
+            db.cursor,
+            "INSERT INTO product_variants (product_id, size, color, stock_quantity) VALUES %s "
+            "ON CONFLICT (product_id, size, color) DO UPDATE SET stock_quantity = EXCLUDED.stock_quantity "
+            "WHERE product_variants.stock_quantity IS DISTINCT FROM EXCLUDED.stock_quantity "
+            "RETURNING (xmax = 0) AS inserted",
+            values, page_size=len(values), fetch=True
+        )
+        inserted = sum(1 for row in written if row["inserted"])
+
+        db.conn.commit()
+        return {
+            "received": len(values),
+            "inserted": inserted,
+            "updated": len(written) - inserted,
+            "unchanged": len(values) - len(written)
+        }
+
+    except HTTPException as http_error:
+        db.conn.rollback()
+        raise http_error
+
+    except Exception as e:
+        db.conn.rollback()
+        exception(e)
+
+
 @router.get("/{product_id}", response_model=ProductResponse)
-def get_product_by_id(product_id: int):
-    db.cursor.execute("SELECT * FROM products WHERE id = %s", (product_id,))
+def get_product_by_id(product_id: int, fields: Fieldset = Depends(fieldset("products")), db: Database = Depends(get_db)):
+    db.cursor.execute(f"SELECT {fields.select('id')} FROM products WHERE id = %s", (product_id,))
     product = db.cursor.fetchone()
     validate_product_exists(product, product_id)
 
-    return product_relationship(product, db)
+    return fields.respond(product_relationship(product, db, fields.relations()))
 
 
 @router.delete("/{product_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_product(product_id: int):
+def delete_product(product_id: int, db: Database = Depends(get_db)):
     try:
         db.cursor.execute("DELETE FROM products WHERE id = %s RETURNING *", (product_id,))    
         product = db.cursor.fetchone()
@@ -71,7 +142,7 @@ def delete_product(product_id: int):
 
 
 @router.put("/{product_id}", response_model=ProductResponse)
-def put_product(product_id: int, product: ProductPut):
+def put_product(product_id: int, product: ProductPut, db: Database = Depends(get_db)):
     try:
         db.cursor.execute(
             "UPDATE products SET name = %s, description = %s, price = %s, stock_quantity = %s WHERE id = %s RETURNING *", 
@@ -91,7 +162,7 @@ def put_product(product_id: int, product: ProductPut):
         exception(e)
 
 @router.patch("/{product_id}", response_model=ProductResponse)
-def patch_product(product_id: int, product: ProductPatch):
+def patch_product(product_id: int, product: ProductPatch, db: Database = Depends(get_db)):
     try:
         sql, values = dynamic_patch_query("products", product.dict(exclude_unset=True), table_id=product_id)
         db.cursor.execute(sql, values)
@@ -0,0 +1,94 @@
+from fastapi import status, HTTPException, APIRouter, Depends, Query, Response
+from datetime import datetime
+from typing import List, Literal, Optional
+from ..response import RepairResponse
+from ..database import Database, session
+from ..pagination import Page
+from ..shards import shards
+from ..config import settings
+from ..status_code import exception
+from ..oauth2 import get_staff
+from ..relationships import type_of_service_relationship, types_of_service_relationship
+from ..events import publish_repair_event
+
+#Shop-wide repair work queue: open repairs of every customer, oldest first.
+#POST /repairs/queue/claim moves the oldest pending repair to in_progress. SKIP LOCKED lets concurrent claims
+#pass over a row another technician is claiming, so each claim gets a different repair and none waits.
+#With sharded customers the queue is merged from every shard, a claim tries the shard with the oldest pending repair first.
+#The queue shows and changes every customer's repairs: technicians only, with the staff token.
+
+router = APIRouter(
+    prefix="/repairs/queue",
+    tags=["Repair Queue"],
+    dependencies=[Depends(get_staff)]
+)
+
+
+@router.get("/", response_model=List[RepairResponse])
+def get_queue(
+        status: Optional[Literal["pending", "in_progress"]] = Query(None, description="Only repairs in this status, pending and in_progress by default"),
+        limit: int = Query(50, ge=1, le=settings.page_max_limit),
+        offset: int = Query(0, ge=0)
+        ):
+    statuses = [status] if status is not None else ["pending", "in_progress"]
+
+    def fetch(db: Database, shard_page: Page) -> tuple:
+        #the literal IN matches the partial index predicate, the planner can't prove it from the parameter
+        db.cursor.execute(
+            "SELECT * FROM repairs WHERE status IN ('pending', 'in_progress') AND status = ANY(%s::status_type[]) "
+            "ORDER BY created_at, id LIMIT %s OFFSET %s",
+            (statuses, shard_page.limit, shard_page.offset)
+        )
+        return db.cursor.fetchall(), None
+
+    pairs, _ = shards.scatter_page(Page(limit, offset, "none"), fetch, lambda repair: (repair["created_at"], repair["id"]))
+    return shards.scatter_related(pairs, types_of_service_relationship)
+
+
+#(created_at, shard) of the oldest pending repair of every shard that has one, oldest first
+def claim_order() -> list:
+    def oldest(db: Database, shard: int):
+        db.cursor.execute("SELECT created_at FROM repairs WHERE status = 'pending' ORDER BY created_at, id LIMIT 1")
+        repair = db.cursor.fetchone()
+        return None if repair is None else (repair["created_at"], shard)
+
+    return sorted(candidate for candidate in shards.scatter(oldest) if candidate is not None)
+
+
+def claim(db: Database):
+    try:
+        db.cursor.execute(
+            "UPDATE repairs SET status = 'in_progress', start_date = %s WHERE id = ("
+            "SELECT id FROM repairs WHERE status = 'pending' ORDER BY created_at, id LIMIT 1 FOR UPDATE SKIP LOCKED"
+            ") RETURNING *",
+            (datetime.utcnow(),)
+        )
+        repair = db.cursor.fetchone()
+        if repair is None:
+            return None
+
+        claimed = type_of_service_relationship(repair, db)
+        publish_repair_event(db, repair, claimed["service"]["customer_id"], "status_changed")
+
+        db.conn.commit()
+        return claimed
+
+    except HTTPException as http_error:
+        raise http_error
+
+    except Exception as e:
+        db.conn.rollback()
+        exception(e)
+
+
+@router.post("/claim", response_model=RepairResponse, responses={204: {"description": "No pending repair to claim"}})
+def claim_repair():
+    #a shard whose pending repairs are all being claimed right now is passed over for the next one
+    order = [shard for _, shard in claim_order()] if shards.sharded else [0]
+    for shard in order:
+        with session(shards.pools[shard]) as db:
+            claimed = claim(db)
+        if claimed is not None:
+            return claimed
+
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
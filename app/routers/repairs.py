@@ -1,42 +1,51 @@
-from fastapi import status, HTTPException, APIRouter, Depends
+from fastapi import status, HTTPException, APIRouter, Depends, Header
 from datetime import datetime
 from ..body import Repair, TokenData
 from ..response import RepairResponse
 from ..update import RepairPatch, RepairPut, dynamic_patch_query
 from ..database import Database
-from typing import List
+from ..shards import get_customer_db
+from typing import List, Optional
 from ..status_code import validate_service_type, validate_customer_exists, validate_customer_ownership, validate_service_exists, validate_repair_exists, exception
 from ..oauth2 import get_current_user
-from ..relationships import type_of_service_relationship
+from ..relationships import type_of_service_relationship, types_of_service_relationship
+from ..fieldsets import Fieldset, fieldset
+from ..events import publish_repair_event
+from ..archive import fetch_one, archive_table
+from ..idempotency import replay, remember
 
 router = APIRouter(
     prefix="/customers/{customer_id}/services/{service_id}/repairs",
     tags=["Repairs"]
 )
 
-db = Database()
-
 
 @router.get("/", response_model=List[RepairResponse])
-def get_repairs(customer_id: int, service_id: int):
+def get_repairs(customer_id: int, service_id: int, fields: Fieldset = Depends(fieldset("repairs")), db: Database = Depends(get_customer_db)):
     db.cursor.execute("SELECT * FROM customers WHERE id = %s", (customer_id,))
     customer = db.cursor.fetchone()
     validate_customer_exists(customer, customer_id)
 
-    db.cursor.execute("SELECT * FROM service_requests WHERE id = %s AND customer_id = %s", (service_id, customer_id))
-    service = db.cursor.fetchone()
+    #an archived service has all of its repairs in the archive
+    service, archived = fetch_one(db, "service_requests", "*", "id = %s AND customer_id = %s", (service_id, customer_id))
     validate_service_exists(service, service_id)
     validate_service_type(service, "repair")
 
-    db.cursor.execute("SELECT * FROM repairs WHERE service_id = %s", (service_id,))
+    db.cursor.execute(f"SELECT {fields.select('service_id')} FROM {archive_table('repairs', archived)} WHERE service_id = %s", (service_id,))
     repairs = db.cursor.fetchall()
 
-    return [type_of_service_relationship(repair, db) for repair in repairs]
+    return fields.respond(types_of_service_relationship(repairs, db, fields.relations(), archived))
 
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=RepairResponse)
-def create_repair(customer_id: int, service_id: int, repair: Repair, current_user: TokenData = Depends(get_current_user)):
+def create_repair(customer_id: int, service_id: int, repair: Repair, idempotency_key: Optional[str] = Header(None, max_length=255),
+                  current_user: TokenData = Depends(get_current_user), db: Database = Depends(get_customer_db)):
     try:
+        route = f"/customers/{customer_id}/services/{service_id}/repairs/"
+        replayed = replay(db, idempotency_key, current_user.id, route, repair)
+        if replayed is not None:
+            return replayed
+
         db.cursor.execute("SELECT * FROM customers WHERE id = %s", (customer_id,))
         customer = db.cursor.fetchone()
         validate_customer_exists(customer, customer_id)
@@ -72,8 +81,12 @@ def create_repair(customer_id: int, service_id: int, repair: Repair, current_use
             )
             created_repair["finished_date"] = finished_date
 
+        publish_repair_event(db, created_repair, customer_id, "created")
+        created_repair = type_of_service_relationship(created_repair, db)
+
+        remember(db, idempotency_key, current_user.id, route, repair, status.HTTP_201_CREATED, RepairResponse(**created_repair))
         db.conn.commit()
-        return type_of_service_relationship(created_repair, db)
+        return created_repair
 
     except HTTPException as http_error:
         raise http_error
@@ -84,26 +97,27 @@ def create_repair(customer_id: int, service_id: int, repair: Repair, current_use
     
 
 @router.get("/{repair_id}", response_model=RepairResponse)
-def get_repair_by_id(customer_id: int, service_id: int, repair_id: int):
+def get_repair_by_id(customer_id: int, service_id: int, repair_id: int, fields: Fieldset = Depends(fieldset("repairs")), db: Database = Depends(get_customer_db)):
     db.cursor.execute("SELECT * FROM customers WHERE id = %s", (customer_id,))
     customer = db.cursor.fetchone()
     validate_customer_exists(customer, customer_id)
 
-    db.cursor.execute("SELECT * FROM service_requests WHERE id = %s AND customer_id = %s", (service_id, customer_id))
-    service = db.cursor.fetchone()
+    service, archived = fetch_one(db, "service_requests", "*", "id = %s AND customer_id = %s", (service_id, customer_id))
     validate_service_exists(service, service_id)
 
     validate_service_type(service, "repair")
 
-    db.cursor.execute("SELECT * FROM repairs WHERE id = %s AND service_id = %s", (repair_id, service_id))
+    db.cursor.execute(
+        f"SELECT {fields.select('service_id')} FROM {archive_table('repairs', archived)} WHERE id = %s AND service_id = %s", (repair_id, service_id)
+    )
     repair = db.cursor.fetchone()
     validate_repair_exists(repair, repair_id)
 
-    return type_of_service_relationship(repair, db)
+    return fields.respond(type_of_service_relationship(repair, db, fields.relations(), archived))
 
 
 @router.delete("/{repair_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_repair(customer_id: int, service_id: int, repair_id: int, current_user: TokenData = Depends(get_current_user)):
+def delete_repair(customer_id: int, service_id: int, repair_id: int, current_user: TokenData = Depends(get_current_user), db: Database = Depends(get_customer_db)):
     try:
         db.cursor.execute("SELECT * FROM customers WHERE id = %s", (customer_id,))
         customer = db.cursor.fetchone()
@@ -118,6 +132,7 @@ def delete_repair(customer_id: int, service_id: int, repair_id: int, current_use
         db.cursor.execute("DELETE FROM repairs WHERE id = %s AND service_id = %s RETURNING *", (repair_id, service_id))
         repair = db.cursor.fetchone()
         validate_repair_exists(repair, repair_id)
+        publish_repair_event(db, repair, customer_id, "deleted")
         
         db.conn.commit()
         return
@@ -131,7 +146,7 @@ def delete_repair(customer_id: int, service_id: int, repair_id: int, current_use
     
 
 @router.put("/{repair_id}", response_model=RepairResponse)
-def put_repair(customer_id: int, service_id: int, repair_id: int, repair: RepairPut, current_user: TokenData = Depends(get_current_user)):
+def put_repair(customer_id: int, service_id: int, repair_id: int, repair: RepairPut, current_user: TokenData = Depends(get_current_user), db: Database = Depends(get_customer_db)):
     try:
         # Validate customer
         db.cursor.execute("SELECT * FROM customers WHERE id = %s", (customer_id,))
@@ -178,6 +193,9 @@ def put_repair(customer_id: int, service_id: int, repair_id: int, repair: Repair
         elif previous_status == "completed" and new_status != "completed":
             update_timestamp("finished_date", None, repair_id)
 
+        if updated_repair["status"] != previous_status:
+            publish_repair_event(db, updated_repair, customer_id, "status_changed")
+
         db.conn.commit()
         return type_of_service_relationship(updated_repair, db)
 
@@ -190,7 +208,7 @@ def put_repair(customer_id: int, service_id: int, repair_id: int, repair: Repair
 
 
 @router.patch("/{repair_id}", response_model=RepairResponse)
-def patch_repair(customer_id: int, service_id: int, repair_id: int, repair: RepairPatch, current_user: TokenData = Depends(get_current_user)):
+def patch_repair(customer_id: int, service_id: int, repair_id: int, repair: RepairPatch, current_user: TokenData = Depends(get_current_user), db: Database = Depends(get_customer_db)):
     try:
         db.cursor.execute("SELECT * FROM customers WHERE id = %s", (customer_id,))
         customer = db.cursor.fetchone()
@@ -232,6 +250,9 @@ def patch_repair(customer_id: int, service_id: int, repair_id: int, repair: Repa
         elif previous_status == "completed" and new_status != "completed":
             update_timestamp("finished_date", None, repair_id)
 
+        if updated_repair["status"] != previous_status:
+            publish_repair_event(db, updated_repair, customer_id, "status_changed")
+
         db.conn.commit()
         return type_of_service_relationship(updated_repair, db)
     
@@ -1,37 +1,51 @@
-from fastapi import status, HTTPException, APIRouter, Depends
+from fastapi import status, HTTPException, APIRouter, Depends, Header, Response
 from ..response import ServiceResponse
 from ..update import ServiceRequestPatch, ServiceRequestPut, dynamic_patch_query
 from ..database import Database
+from ..shards import get_customer_db
 from ..body import ServiceRequest, TokenData
-from typing import List
+from typing import List, Optional
 from ..status_code import validate_customer_exists, validate_service_exists, exception, validate_customer_ownership
 from ..oauth2 import get_current_user
-from ..relationships import service_relationship
+from ..relationships import service_relationship, services_relationship
+from ..fieldsets import Fieldset, fieldset
+from ..archive import fetch_one
+from ..idempotency import replay, remember
+from ..pagination import Page, page, total, with_total
 
 router = APIRouter(
     prefix="/customers/{customer_id}/services",
     tags=["Service Requests"]
 )
 
-db = Database()
-
 
 @router.get("/", response_model=List[ServiceResponse])
-def get_services(customer_id: int):
-    db.cursor.execute("SELECT * FROM service_requests WHERE customer_id = %s", (customer_id,))
+def get_services(customer_id: int, response: Response, paging: Page = Depends(page), fields: Fieldset = Depends(fieldset("service_requests")),
+                 db: Database = Depends(get_customer_db)):
+    db.cursor.execute(f"SELECT {fields.select('id', 'customer_id')} FROM service_requests WHERE customer_id = %s{paging.clause()}", (customer_id,))
     services = db.cursor.fetchall()
-    validate_customer_exists(services, customer_id)
+    #past the first page an empty list is just the end of it
+    if not paging.offset:
+        validate_customer_exists(services, customer_id)
+    counted = total(db, paging, services, "service_requests", "customer_id = %s", (customer_id,))
 
-    return [service_relationship(service, db) for service in services]
+    return with_total(fields.respond(services_relationship(services, db, fields.relations())), response, counted)
 
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=ServiceResponse)
-def create_service(customer_id: int, service: ServiceRequest, current_user: TokenData = Depends(get_current_user)):
+def create_service(customer_id: int, service: ServiceRequest, idempotency_key: Optional[str] = Header(None, max_length=255),
+                   current_user: TokenData = Depends(get_current_user), db: Database = Depends(get_customer_db)):
     try:
+        validate_customer_ownership(customer_id, current_user.id)
+
+        route = f"/customers/{customer_id}/services/"
+        replayed = replay(db, idempotency_key, current_user.id, route, service)
+        if replayed is not None:
+            return replayed
+
         db.cursor.execute("SELECT * FROM customers WHERE id = %s", (customer_id,))
         customer = db.cursor.fetchone()
         validate_customer_exists(customer, customer_id)
-        validate_customer_ownership(customer["id"], current_user.id)
 
         service_data = service.dict()
         service_data["customer_id"] = customer_id
@@ -40,9 +54,11 @@ def create_service(customer_id: int, service: ServiceRequest, current_user: Toke
             "INSERT INTO service_requests (total_cost, type, customer_id) VALUES (%s, %s, %s) RETURNING *", 
             tuple(service_data.values())
             )
-        created_service = db.cursor.fetchone()
+        created_service = service_relationship(db.cursor.fetchone(), db)
+
+        remember(db, idempotency_key, current_user.id, route, service, status.HTTP_201_CREATED, ServiceResponse(**created_service))
         db.conn.commit()
-        return service_relationship(created_service, db)
+        return created_service
     
     except HTTPException as http_error:
         raise http_error
@@ -53,29 +69,29 @@ def create_service(customer_id: int, service: ServiceRequest, current_user: Toke
 
 
 @router.get("/{service_id}", response_model=ServiceResponse)
-def get_service_by_id(customer_id: int, service_id: int):
-    db.cursor.execute("SELECT * FROM customers WHERE id = %s", (customer_id,))
+def get_service_by_id(customer_id: int, service_id: int, fields: Fieldset = Depends(fieldset("service_requests")), db: Database = Depends(get_customer_db)):
+    db.cursor.execute("SELECT id FROM customers WHERE id = %s", (customer_id,))
     customer = db.cursor.fetchone()
     validate_customer_exists(customer, customer_id)
 
-    db.cursor.execute("SELECT * FROM service_requests WHERE id = %s AND customer_id = %s", (service_id, customer_id))
-    service = db.cursor.fetchone()
+    #archived services are still readable by id
+    service, archived = fetch_one(
+        db, "service_requests", fields.select("id", "customer_id"), "id = %s AND customer_id = %s", (service_id, customer_id)
+    )
     validate_service_exists(service, service_id)
 
-    return service_relationship(service, db)
+    return fields.respond(service_relationship(service, db, fields.relations(), archived))
 
 
 @router.delete("/{service_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_service(customer_id: int, service_id: int, current_user: TokenData = Depends(get_current_user)):
+def delete_service(customer_id: int, service_id: int, current_user: TokenData = Depends(get_current_user), db: Database = Depends(get_customer_db)):
     try:
-        db.cursor.execute("SELECT * FROM customers WHERE id = %s", (customer_id,))
-        customer = db.cursor.fetchone()
-        validate_customer_exists(customer, customer_id)
+        #ownership comes from the token, a forbidden request never reaches the database
+        validate_customer_ownership(customer_id, current_user.id)
 
-        db.cursor.execute("DELETE FROM service_requests WHERE id = %s AND customer_id = %s RETURNING *", (service_id, customer_id))
+        db.cursor.execute("DELETE FROM service_requests WHERE id = %s AND customer_id = %s RETURNING id", (service_id, current_user.id))
         service = db.cursor.fetchone()
         validate_service_exists(service, service_id)
-        validate_customer_ownership(service["customer_id"], current_user.id)
 
         db.conn.commit()
         return
@@ -89,20 +105,17 @@ def delete_service(customer_id: int, service_id: int, current_user: TokenData =
 
 
 @router.put("/{service_id}", response_model=ServiceResponse)
-def put_service(customer_id: int, service_id: int, service: ServiceRequestPut, current_user: TokenData = Depends(get_current_user)):
+def put_service(customer_id: int, service_id: int, service: ServiceRequestPut, current_user: TokenData = Depends(get_current_user), db: Database = Depends(get_customer_db)):
     try:
-        db.cursor.execute("SELECT * FROM customers WHERE id = %s", (customer_id,))
-        customer = db.cursor.fetchone()
-        validate_customer_exists(customer, customer_id)
+        validate_customer_ownership(customer_id, current_user.id)
 
         db.cursor.execute(
             "UPDATE service_requests " \
             "SET total_cost = %s, type = %s " \
             "WHERE id = %s AND customer_id = %s RETURNING *", 
-            tuple(service.dict().values()) + (service_id, customer_id))
+            tuple(service.dict().values()) + (service_id, current_user.id))
         updated_service = db.cursor.fetchone()
         validate_service_exists(updated_service, service_id)
-        validate_customer_ownership(updated_service["customer_id"], current_user.id)
 
         db.conn.commit()
         return service_relationship(updated_service, db)
@@ -116,18 +129,15 @@ def put_service(customer_id: int, service_id: int, service: ServiceRequestPut, c
 
 
 @router.patch("/{service_id}", response_model=ServiceResponse)
-def patch_service(customer_id: int, service_id: int, service: ServiceRequestPatch, current_user: TokenData = Depends(get_current_user)):
+def patch_service(customer_id: int, service_id: int, service: ServiceRequestPatch, current_user: TokenData = Depends(get_current_user), db: Database = Depends(get_customer_db)):
     try:
-        db.cursor.execute("SELECT * FROM customers WHERE id = %s", (customer_id,))
-        customer = db.cursor.fetchone()
-        validate_customer_exists(customer, customer_id)
+        validate_customer_ownership(customer_id, current_user.id)
 
-        sql, values = dynamic_patch_query("service_requests", data=service.dict(exclude_unset=True), table_id=service_id, customer_id=customer_id)
+        sql, values = dynamic_patch_query("service_requests", data=service.dict(exclude_unset=True), table_id=service_id, customer_id=current_user.id)
         db.cursor.execute(sql, values)
         updated_service = db.cursor.fetchone()
         validate_service_exists(updated_service, service_id)
-        validate_customer_ownership(updated_service["customer_id"], current_user.id)
-        
+
         db.conn.commit()
         return service_relationship(updated_service, db)
     
@@ -1,31 +1,56 @@
-from fastapi import status, HTTPException, APIRouter
-from ..body import ProductVariant
-from ..database import Database
+from fastapi import status, HTTPException, APIRouter, Depends, Response
+from ..body import ProductVariant, BatchIds
+from ..database import Database, get_db
 from ..update import ProductVariantPatch, ProductVariantPut, dynamic_patch_query
-from ..response import ProductVariantResponse
-from typing import List
+from ..response import ProductVariantResponse, ProductVariantBatchResponse
+from typing import List, Optional
 from ..status_code import validate_product_exists, validate_variant_exists, exception
-from ..relationships import variant_relationship
+from ..relationships import variant_relationship, variants_relationship
+from ..fieldsets import Fieldset, fieldset
+from ..batch import id_list, unique_ids, in_order, with_missing
 
 router = APIRouter(
     prefix="/products/{product_id}/variants",
     tags=["Product Variants"]
 )
 
-db = Database()
+#variant ids are unique across products, batch lookups don't need the product
+batch_router = APIRouter(
+    prefix="/products/variants",
+    tags=["Product Variants"]
+)
+
+
+@batch_router.post("/batch", response_model=ProductVariantBatchResponse)
+def get_variants_batch(batch: BatchIds, fields: Fieldset = Depends(fieldset("product_variants")), db: Database = Depends(get_db)):
+    ids = unique_ids(batch.ids)
+    db.cursor.execute(f"SELECT {fields.select('id', 'product_id')} FROM product_variants WHERE id = ANY(%s)", (ids,))
+    variants, missing = in_order(db.cursor.fetchall(), ids)
+
+    return fields.respond_batch(variants_relationship(variants, db, fields.relations()), missing)
 
 
 @router.get("/", response_model=List[ProductVariantResponse])
-def get_variants(product_id: int):
-    db.cursor.execute("SELECT * FROM product_variants WHERE product_id = %s", (product_id,))
-    variants = db.cursor.fetchall()
-    validate_variant_exists(variants, product_id)
+def get_variants(product_id: int, response: Response, ids: Optional[list] = Depends(id_list), fields: Fieldset = Depends(fieldset("product_variants")), db: Database = Depends(get_db)):
+    if ids is None:
+        db.cursor.execute(f"SELECT {fields.select('product_id')} FROM product_variants WHERE product_id = %s", (product_id,))
+        variants = db.cursor.fetchall()
+        validate_variant_exists(variants, product_id)
+        return fields.respond(variants_relationship(variants, db, fields.relations()))
+
+    db.cursor.execute("SELECT id FROM products WHERE id = %s", (product_id,))
+    validate_product_exists(db.cursor.fetchone(), product_id)
+
+    db.cursor.execute(
+        f"SELECT {fields.select('id', 'product_id')} FROM product_variants WHERE id = ANY(%s) AND product_id = %s", (ids, product_id)
+    )
+    variants, missing = in_order(db.cursor.fetchall(), ids)
 
-    return [variant_relationship(variant, db) for variant in variants]
+    return with_missing(fields.respond(variants_relationship(variants, db, fields.relations())), response, missing)
 
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=ProductVariantResponse)
-def create_variant(product_id: int, variant: ProductVariant):
+def create_variant(product_id: int, variant: ProductVariant, db: Database = Depends(get_db)):
     try:
         db.cursor.execute("SELECT * FROM products WHERE id = %s", (product_id,))
         product = db.cursor.fetchone()
@@ -52,26 +77,26 @@ def create_variant(product_id: int, variant: ProductVariant):
 
 
 @router.get("/{variant_id}", response_model=ProductVariantResponse)
-def get_variant_by_id(product_id: int, variant_id: int):
-    db.cursor.execute("SELECT * FROM products WHERE id = %s", (product_id,))
+def get_variant_by_id(product_id: int, variant_id: int, fields: Fieldset = Depends(fieldset("product_variants")), db: Database = Depends(get_db)):
+    db.cursor.execute("SELECT id FROM products WHERE id = %s", (product_id,))
     product = db.cursor.fetchone()
     validate_product_exists(product, product_id)
 
-    db.cursor.execute("SELECT * FROM product_variants WHERE id = %s AND product_id = %s", (variant_id, product_id))
+    db.cursor.execute(f"SELECT {fields.select('product_id')} FROM product_variants WHERE id = %s AND product_id = %s", (variant_id, product_id))
     variant = db.cursor.fetchone()
     validate_variant_exists(variant, variant_id)
 
-    return variant_relationship(variant, db)
+    return fields.respond(variant_relationship(variant, db, fields.relations()))
 
 
 @router.delete("/{variant_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_variant(product_id: int, variant_id: int):
+def delete_variant(product_id: int, variant_id: int, db: Database = Depends(get_db)):
     try:
         db.cursor.execute("SELECT * FROM products WHERE id = %s", (product_id,))
         product = db.cursor.fetchone()
         validate_product_exists(product, product_id)
 
-        db.cursor.execute("DELETE FROM product_variants WHERE id = %s AND product_id = %s RETURNING", (variant_id, product_id))
+        db.cursor.execute("DELETE FROM product_variants WHERE id = %s AND product_id = %s RETURNING *", (variant_id, product_id))
         variant = db.cursor.fetchone()
         validate_variant_exists(variant, variant_id)
 
@@ -87,7 +112,7 @@ def delete_variant(product_id: int, variant_id: int):
 
 
 @router.put("/{variant_id}", response_model=ProductVariantResponse)
-def put_variant(product_id: int, variant_id: int, variant: ProductVariantPut):
+def put_variant(product_id: int, variant_id: int, variant: ProductVariantPut, db: Database = Depends(get_db)):
     try:
         db.cursor.execute("SELECT * FROM products WHERE id = %s", (product_id,))
         product = db.cursor.fetchone()
@@ -113,7 +138,7 @@ def put_variant(product_id: int, variant_id: int, variant: ProductVariantPut):
 
 
 @router.patch("/{variant_id}", response_model=ProductVariantResponse)
-def patch_variant(product_id: int, variant_id: int, variant: ProductVariantPatch):
+def patch_variant(product_id: int, variant_id: int, variant: ProductVariantPatch, db: Database = Depends(get_db)):
     try:
         db.cursor.execute("SELECT * FROM products WHERE id = %s", (product_id,))
         product = db.cursor.fetchone()
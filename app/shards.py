@@ -0,0 +1,277 @@
+import heapq
+import threading
+import zlib
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import copy_context
+from itertools import islice
+from typing import Optional
+import psycopg2
+from fastapi import Depends
+from .config import settings
+from .database import ConnectionPool, Database, PoolTimeout, SchemaConflict, pool, session
+from .body import TokenData
+from .oauth2 import get_current_user
+from .pagination import Page, combined_total
+from . import metrics
+
+#Horizontal sharding of customer data by customer_id.
+#settings.shard_databases lists the customer shards. A customer, its services, repairs, items, refresh tokens,
+#idempotency keys and repair events live on the shard that owns the customer id:
+#  hash   crc32 of the customer id modulo the number of shards. Changing the number of shards moves customers
+#  range  settings.shard_range_bounds: the first customer id of every shard after the first
+#Products and variants stay in the catalog database (settings.database_name). It also holds customer_directory,
+#which allocates the customer ids and keeps emails unique over all shards (logins find their shard there).
+#Other ids are interleaved between the shards by their sequences, so they are unique too.
+#Lists across customers (customer list, repair queue, analytics, exports, the shop-wide event stream) scatter over
+#every shard in parallel and merge the results.
+#A request takes its shard connection before a catalog one, never the other way round, so the pools can't deadlock.
+#Without shard_databases the catalog database is the only shard and every function here is a no-op around `pool`.
+
+
+def parse_target(value: str) -> dict:
+    address, _, database = value.strip().rpartition("/")
+    target = {"database": database}
+    if address:
+        host, _, port = address.partition(":")
+        target["host"] = host
+        if port:
+            target["port"] = port
+    return target
+
+
+class ShardMap:
+    def __init__(self):
+        self.pools = [pool]
+        self.strategy = "hash"
+        self.bounds = []
+        self.executor = None
+
+    #also called by tests/conftest.py for the sharded run over its shoeshop_shardN_test databases
+    def configure(self, databases: Optional[str], strategy: str = "hash", bounds: Optional[str] = None):
+        targets = [parse_target(database) for database in databases.split(",") if database.strip()] if databases else []
+        bounds = [int(bound) for bound in bounds.split(",") if bound.strip()] if bounds else []
+        if targets and strategy == "range" and (len(bounds) != len(targets) - 1 or bounds != sorted(bounds)):
+            raise ValueError(f"shard_range_bounds needs {len(targets) - 1} increasing customer ids for {len(targets)} shards")
+
+        self.pools = [ConnectionPool(settings.database_pool_size, settings.database_pool_timeout, target) for target in targets] or [pool]
+        self.strategy = strategy
+        self.bounds = bounds
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.executor = ThreadPoolExecutor(settings.database_pool_size * len(targets), thread_name_prefix="shard") if targets else None
+
+    @property
+    def sharded(self) -> bool:
+        return self.pools != [pool]
+
+    #catalog first
+    def all_pools(self) -> list:
+        return [pool] + self.pools if self.sharded else [pool]
+
+    #customer ids that don't exist yet (None, e.g. an unknown refresh token) go to the first shard
+    def index(self, customer_id: Optional[int]) -> int:
+        if len(self.pools) == 1 or customer_id is None:
+            return 0
+        if self.strategy == "range":
+            return bisect_right(self.bounds, customer_id)
+        return zlib.crc32(str(customer_id).encode()) % len(self.pools)
+
+    def pool(self, customer_id: Optional[int]) -> ConnectionPool:
+        return self.pools[self.index(customer_id)]
+
+    #{shard: ids} for the shards owning the ids, in the order the shards first appear
+    def group(self, customer_ids: list) -> dict:
+        groups = {}
+        for customer_id in customer_ids:
+            groups.setdefault(self.index(customer_id), []).append(customer_id)
+        return groups
+
+    #function(db, shard) on the given shards (every shard by default) in parallel, the results in the same order.
+    #The threads run in the request's context, their statements count in its query stats
+    def scatter(self, function, indexes: list = None) -> list:
+        indexes = list(range(len(self.pools))) if indexes is None else indexes
+        if not indexes:
+            return []
+
+        def run(index):
+            with session(self.pools[index]) as db:
+                return function(db, index)
+
+        if len(indexes) == 1:
+            return [run(indexes[0])]
+        futures = [self.executor.submit(copy_context().run, run, index) for index in indexes]
+        return [future.result() for future in futures]
+
+    #one page of a list spread over the shards: fetch(db, page) returns (rows, total) of the spread page of a shard,
+    #the rows come back merged in `key` order and cut to the page as (shard, row) pairs, with the combined total
+    def scatter_page(self, paging: Page, fetch, key) -> tuple:
+        spread = paging.spread(len(self.pools))
+        results = self.scatter(lambda db, shard: fetch(db, spread))
+        pairs = heapq.merge(*([(shard, row) for row in rows] for shard, (rows, _) in enumerate(results)), key=lambda pair: key(pair[1]))
+        if spread is not paging:
+            pairs = islice(pairs, paging.offset, None if paging.limit is None else paging.offset + paging.limit)
+        return list(pairs), combined_total([counted for _, counted in results])
+
+    #relationship(rows, db) for (shard, row) pairs, set-based on each shard, the rows keep their order
+    def scatter_related(self, pairs: list, relationship) -> list:
+        groups = {}
+        for position, (shard, row) in enumerate(pairs):
+            groups.setdefault(shard, []).append((position, row))
+        if not groups:
+            return []
+
+        related = [None] * len(pairs)
+        results = self.scatter(lambda db, shard: relationship([row for _, row in groups[shard]], db), list(groups))
+        for shard, rows in zip(groups, results):
+            for (position, _), row in zip(groups[shard], rows):
+                related[position] = row
+        return related
+
+    def close(self):
+        for source in self.all_pools():
+            source.close()
+
+    def waiting(self) -> int:
+        return sum(source.waiting for source in self.all_pools())
+
+    def connection_gauges(self) -> dict:
+        gauges = {}
+        if self.sharded:
+            for index, source in enumerate(self.pools):
+                for (state,), value in source.connection_gauges().items():
+                    gauges[(str(index), state)] = value
+        return gauges
+
+
+shards = ShardMap()
+shards.configure(settings.shard_databases, settings.shard_strategy, settings.shard_range_bounds)
+metrics.Gauge("db_shard_pool_connections", "Customer shard database connections by shard and state", ("shard", "state"), shards.connection_gauges)
+
+
+#FastAPI dependency for the /customers/{customer_id}/... routes: a connection to the shard of the customer
+def get_customer_db(customer_id: int):
+    with session(shards.pool(customer_id)) as db:
+        yield db
+
+
+#FastAPI dependency: a connection to the shard of the logged in customer
+def get_user_db(current_user: TokenData = Depends(get_current_user)):
+    with session(shards.pool(current_user.id)) as db:
+        yield db
+
+
+#the catalog database next to a customer shard connection, the same connection when customers aren't sharded
+@contextmanager
+def catalog(db: Database):
+    if not shards.sharded:
+        yield db
+        return
+    with session(pool) as catalog_db:
+        yield catalog_db
+
+
+#customer_directory, only when sharded. Each call commits on its own catalog connection:
+#the directory row exists before the customer row, a customer that failed to be created is removed again
+
+#the id for a new customer, None when customers.id allocates it
+def register_customer(email: str) -> Optional[int]:
+    if not shards.sharded:
+        return None
+    with session(pool) as db:
+        try:
+            db.cursor.execute("INSERT INTO customer_directory (email) VALUES (%s) RETURNING id", (email,))
+            customer_id = db.cursor.fetchone()["id"]
+            db.conn.commit()
+            return customer_id
+        except Exception:
+            db.conn.rollback()
+            raise
+
+
+def unregister_customer(customer_id: Optional[int]):
+    if customer_id is None or not shards.sharded:
+        return
+    with session(pool) as db:
+        db.cursor.execute("DELETE FROM customer_directory WHERE id = %s", (customer_id,))
+        db.conn.commit()
+
+
+#call before committing the shard transaction that changes the email: a taken email fails here first.
+#Returns the email it replaced, for restore_customer_email when the shard transaction doesn't commit
+def rename_customer(customer_id: int, email: Optional[str]) -> Optional[str]:
+    if email is None or not shards.sharded:
+        return None
+    with session(pool) as db:
+        try:
+            db.cursor.execute(
+                "UPDATE customer_directory AS entry SET email = %s "
+                "FROM (SELECT id, email FROM customer_directory WHERE id = %s FOR UPDATE) AS previous "
+                "WHERE entry.id = previous.id RETURNING previous.email",
+                (email, customer_id)
+            )
+            previous = db.cursor.fetchone()
+            db.conn.commit()
+            return previous["email"] if previous is not None else None
+        except Exception:
+            db.conn.rollback()
+            raise
+
+
+#puts back the email rename_customer replaced, so the directory matches the shard again and the customer can log in
+def restore_customer_email(customer_id: int, email: Optional[str]):
+    if email is None:
+        return
+    try:
+        rename_customer(customer_id, email)
+    except Exception as e:
+        print(f"Restoring the directory email of customer {customer_id} failed. Error: {e}")
+
+
+#the pool of the shard holding the customer with this email, None for an unknown email
+def customer_pool(email: str) -> Optional[ConnectionPool]:
+    if not shards.sharded:
+        return pool
+    with session(pool) as db:
+        db.cursor.execute("SELECT id FROM customer_directory WHERE email = %s", (email,))
+        found = db.cursor.fetchone()
+    return shards.pool(found["id"]) if found is not None else None
+
+
+#(shard, label, connection) for every customer shard, for the command line tools. label prefixes their output
+def shard_databases():
+    for index, source in enumerate(shards.pools):
+        yield index, f"[shard {index}] " if shards.sharded else "", Database(target=source.target)
+
+
+def create_tables():
+    if not shards.sharded:
+        Database().create_tables()
+        return
+    Database().create_tables(customers=False)
+    for index, source in enumerate(shards.pools):
+        Database(target=source.target).create_tables(catalog=False, shard=index, shards=len(shards.pools))
+
+
+#Runs in a background thread at start-up: creates the tables and warms the pools,
+#retrying with backoff until the databases answer or the app shuts down. A schema conflict stops it, /ready stays 503
+def start_pools(stop: threading.Event):
+    delay = 1
+    for source in shards.all_pools():
+        source.open()
+    while not stop.is_set():
+        try:
+            create_tables()
+            for source in shards.all_pools():
+                source.warm_up(settings.database_pool_warm)
+            return
+
+        except SchemaConflict as e:
+            print(f"Database schema can't be updated: {e}")
+            return
+
+        except (PoolTimeout, psycopg2.Error) as e:
+            print(f"Database not ready, retrying in {delay}s. Error: {e}")
+            stop.wait(delay)
+            delay = min(delay * 2, 30)
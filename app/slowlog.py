@@ -0,0 +1,100 @@
+import json
+import logging
+import random
+import re
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from psycopg2.extensions import cursor as plain_cursor, TRANSACTION_STATUS_INERROR
+from .config import settings
+
+#Slow query log: statements slower than settings.slow_query_ms are written as JSON lines to a rotating file,
+#a sampled share of them with their EXPLAIN plan. The plan is estimated, not run again with ANALYZE: that would
+#repeat the statement's work (sequence increments and triggers included) on the request's connection and
+#transaction, doubling its latency and lock time just when the database is slow
+
+logger = logging.getLogger("app.slow_queries")
+logger.propagate = False
+
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "VALUES")
+REDACTED = "[REDACTED]"
+
+_placeholder = re.compile(r"%s|%\((\w+)\)s")
+_insert_columns = re.compile(r"^\s*INSERT\s+INTO\s+\w+\s*\(([^)]*)\)", re.IGNORECASE)
+_assigned_column = re.compile(r"(\w+)\s*=\s*$")
+
+
+def _handler():
+    if not logger.handlers:
+        handler = RotatingFileHandler(settings.slow_query_log, maxBytes=settings.slow_query_log_bytes,
+                                      backupCount=settings.slow_query_log_backups, delay=True)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+    return logger
+
+
+#column each positional placeholder is bound to: INSERT column list, or the "column = %s" before it
+def _placeholder_columns(query: str) -> list:
+    placeholders = list(_placeholder.finditer(query))
+    insert = _insert_columns.match(query)
+    if insert:
+        columns = [column.strip().lower() for column in insert.group(1).split(",")]
+        return [columns[index] if index < len(columns) else None for index in range(len(placeholders))]
+
+    columns = []
+    for match in placeholders:
+        assigned = _assigned_column.search(query, 0, match.start())
+        columns.append(assigned.group(1).lower() if assigned else None)
+    return columns
+
+
+#customers.password never reaches the log, hashed or not
+def redact(query: str, params):
+    if params is None or "customers" not in query.lower() or "password" not in query.lower():
+        return params
+
+    if isinstance(params, dict):
+        return {key: REDACTED if key == "password" else value for key, value in params.items()}
+
+    columns = _placeholder_columns(query)
+    return [REDACTED if index < len(columns) and columns[index] == "password" else value
+            for index, value in enumerate(params)]
+
+
+def _explain(conn, query: str, params) -> list:
+    cursor = conn.cursor(cursor_factory=plain_cursor)
+    try:
+        if conn.autocommit:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+            return cursor.fetchone()[0]
+
+        #a failing EXPLAIN must not abort the request's transaction
+        cursor.execute("SAVEPOINT slow_query_explain")
+        try:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+            return cursor.fetchone()[0]
+        finally:
+            cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+    finally:
+        cursor.close()
+
+
+def log_slow_query(conn, query: str, shape: str, params, duration: float, route: str = None):
+    entry = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "route": route,
+        "duration_ms": round(duration * 1000, 2),
+        "statement": shape,
+        "params": redact(query, params),
+    }
+
+    explainable = query.lstrip().split(None, 1)[0].upper() in EXPLAINABLE
+    usable = conn.info.transaction_status != TRANSACTION_STATUS_INERROR
+    if explainable and usable and random.random() < settings.slow_query_explain_rate:
+        try:
+            entry["plan"] = _explain(conn, query, params)
+        except Exception as e:
+            entry["plan_error"] = str(e)
+
+    _handler().info(json.dumps(entry, default=str))
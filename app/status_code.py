@@ -18,6 +18,16 @@ def validate_repair_exists(repair, repair_id: int = None):
         )
 
 
+#check every product referenced by a bulk request exists
+def validate_products_exist(found_ids, product_ids):
+    missing = sorted(set(product_ids) - set(found_ids))
+    if missing:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Products with ids {', '.join(str(id) for id in missing)} were not found"
+        )
+
+
 #check if customer.id is in database
 def validate_customer_exists(customer, customer_id: int = None):
     if not customer:
@@ -1,9 +1,27 @@
+import os
+import threading
+from time import perf_counter
 from passlib.context import CryptContext
+from .config import settings
+from . import metrics
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+#bcrypt is CPU bound, running more hashes than cores at once only makes every request slower
+bcrypt_slots = threading.BoundedSemaphore(settings.bcrypt_concurrency or os.cpu_count() or 1)
+
+def _bcrypt(operation: str, function, *args):
+    queued = perf_counter()
+    with bcrypt_slots:
+        started = perf_counter()
+        metrics.bcrypt_queue.observe(started - queued, operation)
+        try:
+            return function(*args)
+        finally:
+            metrics.bcrypt_latency.observe(perf_counter() - started, operation)
+
 def hash(password: str):
-    return pwd_context.hash(password)
+    return _bcrypt("hash", pwd_context.hash, password)
 
 def verify(plain_pw, hashed_pw):
-    return pwd_context.verify(plain_pw, hashed_pw)
\ No newline at end of file
+    return _bcrypt("verify", pwd_context.verify, plain_pw, hashed_pw)
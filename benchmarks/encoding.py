@@ -0,0 +1,98 @@
+import argparse
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from time import perf_counter
+from typing import List
+from pydantic import TypeAdapter
+
+#Response encoding benchmark: CPU time against bytes sent for gzip/brotli levels and MessagePack,
+#on List[ServiceResponse] and List[ProductResponse] payloads shaped like the real ones. No database needed.
+#Uses the encoders of app/encoding.py, JSON is serialized the way FastAPI does it for a response_model.
+#Usage: python benchmarks/encoding.py --rows 10 100 1000 --repeat 20   (needs the same .env / environment as the app)
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.response import ServiceResponse, ProductResponse
+from app.encoding import GzipEncoder, BrotliEncoder, brotli, msgpack, to_msgpack
+
+NOW = datetime(2024, 5, 1, 12, 0)
+SIZES = ("36", "37", "38", "39", "40", "41", "42", "43", "44", "45")
+COLORS = ("black", "brown", "white", "navy")
+
+
+def services(rows: int) -> list:
+    result = []
+    for i in range(rows):
+        repair = i % 3 == 0
+        date = NOW - timedelta(days=i)
+        result.append({
+            "id": i + 1, "customer_id": i // 5 + 1, "type": "repair" if repair else "sale", "total_cost": 120.5, "date": date,
+            "user": {"id": i // 5 + 1, "name": f"Customer {i // 5 + 1}", "email": f"customer{i // 5 + 1}@example.com",
+                     "address": f"{i} Main Street, Springfield", "created_at": NOW - timedelta(days=400), "services": []},
+            "repairs": [{"id": i * 2 + n, "service_id": i + 1, "description": "Resole and heel replacement", "status": "completed",
+                         "created_at": date, "start_date": date, "finished_date": date + timedelta(days=3)} for n in range(2 if repair else 0)],
+            "items": [{"id": i * 3 + n, "service_id": i + 1, "product_variant_id": (i * 7 + n) % 500 + 1, "quantity": 1 + n,
+                       "unit_price": 89.99, "created_at": date} for n in range(0 if repair else 3)],
+        })
+    return result
+
+
+def products(rows: int) -> list:
+    return [{
+        "id": i + 1, "name": f"Leather Derby {i + 1}", "description": "Full grain leather derby with a Goodyear welted sole",
+        "price": 149.0, "stock_quantity": 40, "created_at": NOW, "total_variant_stock": 120, "in_stock_variant_count": 12,
+        "available_sizes": list(SIZES[:6]),
+        "variants": [{"id": i * 40 + n, "product_id": i + 1, "size": SIZES[n % len(SIZES)], "color": COLORS[n % len(COLORS)],
+                      "stock_quantity": n % 7} for n in range(12)],
+    } for i in range(rows)]
+
+
+def timed(function, repeat: int):
+    best, result = None, None
+    for _ in range(repeat):
+        start = perf_counter()
+        result = function()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def report(name: str, seconds: float, size: int, json_size: int):
+    print(f"  {name:<22} {seconds * 1000:9.3f} ms {size:>11,} B {size / json_size:8.1%}")
+
+
+def bench(label: str, adapter: TypeAdapter, payload: list, repeat: int):
+    json_seconds, body = timed(lambda: adapter.dump_json(adapter.validate_python(payload)), repeat)
+    print(f"{label}")
+    report("json (response_model)", json_seconds, len(body), len(body))
+
+    if msgpack is not None:
+        seconds, packed = timed(lambda: to_msgpack(body), repeat)
+        report("+ msgpack", seconds, len(packed), len(body))
+
+    encoders = [(f"gzip {level}", lambda level=level: GzipEncoder(level)) for level in (1, 6, 9)]
+    if brotli is not None:
+        encoders += [(f"br {quality}", lambda quality=quality: BrotliEncoder(quality)) for quality in (1, 4, 6, 11)]
+    for name, encoder in encoders:
+        seconds, compressed = timed(lambda: encoder().compress(body, True), repeat)
+        report(f"+ {name}", seconds, len(compressed), len(body))
+        if msgpack is not None:
+            seconds, compressed = timed(lambda: encoder().compress(to_msgpack(body), True), repeat)
+            report(f"+ msgpack + {name}", seconds, len(compressed), len(body))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure response encoding cost and size")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=20, help="best of this many runs is reported")
+    args = parser.parse_args()
+
+    print(f"{'':<24} {'cpu':>12} {'bytes':>13} {'of json':>8}")
+    for rows in args.rows:
+        bench(f"List[ServiceResponse] x {rows}", TypeAdapter(List[ServiceResponse]), services(rows), args.repeat)
+        bench(f"List[ProductResponse] x {rows}", TypeAdapter(List[ProductResponse]), products(rows), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
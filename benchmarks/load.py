@@ -0,0 +1,315 @@
+import argparse
+import asyncio
+import random
+import statistics
+import uuid
+from collections import Counter, defaultdict
+from time import perf_counter
+import httpx
+
+#Mixed-traffic load test: virtual users run the shop's real flows against a running server, the error rate and
+#latency percentiles are printed every --interval seconds and per route and phase at the end.
+#A scenario is a list of phases, each phase runs a number of users per flow for --phase-seconds:
+#  opening   login spike at store opening
+#  browsing  morning catalog browsing
+#  lunch     sale bursts with multi-item orders, with browsing going on
+#  repairs   steady repair intake and status updates
+#  day       the four phases one after the other
+#Users wait a random think time (exponential, mean --think seconds) between steps.
+#Customers are the ones of app/generate.py: customer<id>@example.com sharing one password.
+#Usage: python benchmarks/load.py --base-url http://127.0.0.1:8000 --scenario day --phase-seconds 60 --scale 2
+#       python benchmarks/load.py --scenario lunch --users sale=40,browse=10 --think 0.5
+
+#users per flow in each phase, before --scale and --users
+PHASES = {
+    "opening": {"login": 30, "browse": 5},
+    "browsing": {"browse": 30, "login": 2},
+    "lunch": {"sale": 20, "browse": 15, "login": 5},
+    "repairs": {"repair": 15, "browse": 5},
+}
+SCENARIOS = {"day": ("opening", "browsing", "lunch", "repairs"), **{name: (name,) for name in PHASES}}
+
+
+def parse_users(value: str) -> dict:
+    users = {}
+    for part in value.split(","):
+        flow, _, count = part.partition("=")
+        if flow.strip() not in FLOWS:
+            raise argparse.ArgumentTypeError(f"unknown flow {flow.strip()!r}, one of {', '.join(FLOWS)}")
+        users[flow.strip()] = int(count)
+    return users
+
+
+def percentiles(latencies: list) -> tuple:
+    if len(latencies) < 2:
+        value = latencies[0] if latencies else 0.0
+        return value, value, value
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+    return cuts[49], cuts[89], cuts[98]
+
+
+class Recorder:
+    def __init__(self):
+        self.started = perf_counter()
+        self.samples = []   #(seconds since start, phase, route, status or None for a transport error, latency)
+
+    def record(self, phase: str, route: str, status, latency: float):
+        self.samples.append((perf_counter() - self.started, phase, route, status, latency))
+
+
+def summary(samples: list) -> tuple:
+    latencies = [sample[4] for sample in samples]
+    errors = sum(1 for sample in samples if sample[3] is None or sample[3] >= 400)
+    return len(samples), errors, latencies
+
+
+def ms(seconds: float) -> str:
+    return f"{seconds * 1000:8.1f}"
+
+
+async def report_intervals(recorder: Recorder, interval: float, phase: dict):
+    seen = 0
+    print(f"{'time':>8} {'phase':<9} {'requests':>9} {'req/s':>8} {'errors':>7} {'err %':>7} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8}")
+    while True:
+        await asyncio.sleep(interval)
+        window = recorder.samples[seen:]
+        seen += len(window)
+        requests, errors, latencies = summary(window)
+        p50, p90, p99 = percentiles(latencies)
+        print(f"{perf_counter() - recorder.started:7.1f}s {phase['name']:<9} {requests:>9} {requests / interval:8.1f} {errors:>7} "
+              f"{errors / requests if requests else 0:7.1%} {ms(p50)} {ms(p90)} {ms(p99)}")
+
+
+def report_totals(recorder: Recorder, title: str, key):
+    groups = defaultdict(list)
+    for sample in recorder.samples:
+        groups[key(sample)].append(sample)
+
+    print(f"\n{title:<48} {'requests':>9} {'errors':>7} {'err %':>7} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for name in sorted(groups):
+        requests, errors, latencies = summary(groups[name])
+        p50, p90, p99 = percentiles(latencies)
+        print(f"{name:<48} {requests:>9} {errors:>7} {errors / requests:7.1%} {ms(p50)} {ms(p90)} {ms(p99)} {ms(max(latencies))}")
+
+
+class Session:
+    def __init__(self, client: httpx.AsyncClient, recorder: Recorder, args, catalog: list, phase: str):
+        self.client = client
+        self.recorder = recorder
+        self.args = args
+        self.catalog = catalog
+        self.phase = phase
+        self.rng = random.Random()
+        self.customer_id = None
+        self.headers = {}
+        self.refresh_token = None
+
+    async def think(self, scale: float = 1.0):
+        if self.args.think > 0:
+            await asyncio.sleep(self.rng.expovariate(1 / (self.args.think * scale)))
+
+    #`route` is the path template the latency is reported under
+    async def call(self, method: str, route: str, path: str, retry: bool = True, **kwargs):
+        start = perf_counter()
+        try:
+            response = await self.client.request(method, path, headers={**self.headers, **kwargs.pop("headers", {})}, **kwargs)
+        except httpx.HTTPError:
+            self.recorder.record(self.phase, f"{method} {route}", None, perf_counter() - start)
+            return None
+        self.recorder.record(self.phase, f"{method} {route}", response.status_code, perf_counter() - start)
+
+        #an access token that expired during a long run is renewed once
+        if response.status_code == 401 and retry and self.refresh_token is not None and await self.refresh():
+            return await self.call(method, route, path, retry=False, **kwargs)
+        return response
+
+    async def login(self) -> bool:
+        self.headers = {}
+        customer_id = self.rng.randint(1, self.args.customers)
+        response = await self.call("POST", "/login", "/login",
+                                   data={"username": self.args.email.format(id=customer_id), "password": self.args.password})
+        if response is None or response.status_code != 200:
+            return False
+        token = response.json()
+        self.customer_id = token["customer_id"]
+        self.headers = {"Authorization": f"Bearer {token['access_token']}"}
+        self.refresh_token = token.get("refresh_token")
+        return True
+
+    async def refresh(self) -> bool:
+        response = await self.call("POST", "/login/refresh", "/login/refresh", retry=False, json={"refresh_token": self.refresh_token})
+        if response is None or response.status_code != 200:
+            self.refresh_token = None
+            return False
+        token = response.json()
+        self.headers = {"Authorization": f"Bearer {token['access_token']}"}
+        self.refresh_token = token["refresh_token"]
+        return True
+
+    async def logout(self):
+        await self.call("POST", "/logout", "/logout", json={"refresh_token": self.refresh_token})
+        self.customer_id, self.headers, self.refresh_token = None, {}, None
+
+
+#store opening: staff and customers sign in, look at their account and sign out again
+async def login_flow(session: Session):
+    if not await session.login():
+        return await session.think()
+    customer = f"/customers/{session.customer_id}"
+    await session.call("GET", "/customers/{id}", customer)
+    await session.think(0.5)
+    await session.call("GET", "/customers/{id}/services/", f"{customer}/services/?limit=20")
+    await session.think()
+    await session.refresh()
+    await session.logout()
+    await session.think()
+
+
+#catalog browsing, anonymous
+async def browse_flow(session: Session):
+    await session.call("GET", "/products/", f"/products/?limit=20&offset={session.rng.randrange(0, max(len(session.catalog) - 20, 1))}")
+    await session.think()
+    for _ in range(session.rng.randint(1, 3)):
+        product = session.rng.choice(session.catalog)
+        await session.call("GET", "/products/{id}", f"/products/{product['id']}")
+        await session.think(0.5)
+        await session.call("GET", "/products/{id}/variants/", f"/products/{product['id']}/variants/")
+        await session.think()
+
+
+#lunchtime sale: an order of one to five items, then the total is set on the service request
+async def sale_flow(session: Session):
+    if session.customer_id is None and not await session.login():
+        return await session.think()
+    services = f"/customers/{session.customer_id}/services"
+    await session.call("GET", "/products/", "/products/?limit=20")
+    await session.think(0.5)
+
+    response = await session.call("POST", "/customers/{id}/services/", f"{services}/",
+                                  json={"type": "sale", "total_cost": 0}, headers={"Idempotency-Key": str(uuid.uuid4())})
+    if response is None or response.status_code != 201:
+        return await session.think()
+    service_id = response.json()["id"]
+
+    total_cost = 0.0
+    #a variant is only once in an order
+    for product in session.rng.sample(session.catalog, min(session.rng.randint(1, 5), len(session.catalog))):
+        variant = session.rng.choice(product["variants"])
+        quantity = session.rng.randint(1, 2)
+        await session.call("POST", "/customers/{id}/services/{id}/items/", f"{services}/{service_id}/items/",
+                           json={"product_variant_id": variant["id"], "quantity": quantity, "unit_price": product["price"]},
+                           headers={"Idempotency-Key": str(uuid.uuid4())})
+        total_cost += quantity * product["price"]
+        await session.think(0.25)
+
+    await session.call("PATCH", "/customers/{id}/services/{id}", f"{services}/{service_id}", json={"total_cost": round(total_cost, 2)})
+    await session.call("GET", "/customers/{id}/services/{id}", f"{services}/{service_id}")
+    await session.think()
+
+
+#repair intake and the status updates of the workshop
+async def repair_flow(session: Session):
+    if session.customer_id is None and not await session.login():
+        return await session.think()
+    services = f"/customers/{session.customer_id}/services"
+    response = await session.call("POST", "/customers/{id}/services/", f"{services}/",
+                                  json={"type": "repair", "total_cost": 35.0}, headers={"Idempotency-Key": str(uuid.uuid4())})
+    if response is None or response.status_code != 201:
+        return await session.think()
+    repairs = f"{services}/{response.json()['id']}/repairs"
+
+    response = await session.call("POST", "/customers/{id}/services/{id}/repairs/", f"{repairs}/",
+                                  json={"description": "Resole and heel replacement", "status": "pending"},
+                                  headers={"Idempotency-Key": str(uuid.uuid4())})
+    if response is None or response.status_code != 201:
+        return await session.think()
+    repair = f"{repairs}/{response.json()['id']}"
+
+    #the technicians' view of the queue takes the staff token
+    if session.args.staff_token:
+        await session.call("GET", "/repairs/queue/", "/repairs/queue/?limit=20", headers={"X-Staff-Token": session.args.staff_token})
+    await session.think()
+    for status in ("in_progress", "completed"):
+        await session.call("PATCH", "/customers/{id}/services/{id}/repairs/{id}", repair, json={"status": status})
+        await session.think()
+    await session.call("GET", "/customers/{id}/services/{id}/repairs/", f"{repairs}/")
+
+
+FLOWS = {"login": login_flow, "browse": browse_flow, "sale": sale_flow, "repair": repair_flow}
+
+
+async def virtual_user(flow: str, session: Session, deadline: float, ramp: float):
+    await asyncio.sleep(session.rng.uniform(0, ramp))
+    while perf_counter() < deadline:
+        await FLOWS[flow](session)
+
+
+async def load_catalog(client: httpx.AsyncClient) -> list:
+    response = await client.get("/products/", params={"limit": 1000, "count": "none"})
+    response.raise_for_status()
+    return [{"id": product["id"], "price": product["price"], "variants": product["variants"]}
+            for product in response.json() if product.get("variants")]
+
+
+def phase_users(name: str, args) -> dict:
+    users = {flow: max(1, round(count * args.scale)) for flow, count in PHASES[name].items()}
+    users.update(args.users or {})
+    return {flow: count for flow, count in users.items() if count > 0}
+
+
+async def run(args):
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=args.max_connections, max_keepalive_connections=args.max_connections)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        catalog = await load_catalog(client)
+        if not catalog:
+            raise SystemExit("no product with variants in the catalog, generate data first (python -m app.generate)")
+
+        phase = {"name": ""}
+        reporter = asyncio.create_task(report_intervals(recorder, args.interval, phase))
+        try:
+            for name in SCENARIOS[args.scenario]:
+                users = phase_users(name, args)
+                phase["name"] = name
+                print(f"-- {name}: " + ", ".join(f"{count} {flow}" for flow, count in users.items()))
+                deadline = perf_counter() + args.phase_seconds
+                await asyncio.gather(*(
+                    virtual_user(flow, Session(client, recorder, args, catalog, name), deadline, args.ramp)
+                    for flow, count in users.items() for _ in range(count)
+                ))
+        finally:
+            reporter.cancel()
+
+    report_totals(recorder, "route", lambda sample: sample[2])
+    report_totals(recorder, "phase", lambda sample: sample[1])
+
+    failures = Counter((sample[2], sample[3] or "transport error") for sample in recorder.samples if sample[3] is None or sample[3] >= 400)
+    if failures:
+        print("\nerrors")
+        for (route, status), count in failures.most_common():
+            print(f"  {route:<46} {status!s:>15} {count:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run mixed-traffic load scenarios against a running server")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="day")
+    parser.add_argument("--phase-seconds", type=float, default=60, help="duration of each phase")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies the users of every flow")
+    parser.add_argument("--users", type=parse_users, help="users per flow in every phase, e.g. sale=40,browse=10 (0 removes a flow)")
+    parser.add_argument("--think", type=float, default=1.0, help="mean think time in seconds between steps, 0 for none")
+    parser.add_argument("--ramp", type=float, default=2.0, help="users of a phase start spread over this many seconds")
+    parser.add_argument("--interval", type=float, default=5.0, help="seconds between progress lines")
+    parser.add_argument("--customers", type=int, default=1000, help="users log in as a random customer between 1 and this id")
+    parser.add_argument("--email", default="customer{id}@example.com")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--staff-token", help="STAFF_TOKEN of the server, the repair flow skips the queue without it")
+    parser.add_argument("--max-connections", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
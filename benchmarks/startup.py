@@ -0,0 +1,55 @@
+import argparse
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+#Start-up benchmark: import time of app.main and time from lifespan start until GET /ready answers 200
+#Usage: python benchmarks/startup.py --runs 10   (needs the same .env / environment as the app)
+
+ROOT = Path(__file__).resolve().parent.parent
+
+IMPORT = """
+from time import perf_counter
+start = perf_counter()
+import app.main
+print(perf_counter() - start)
+"""
+
+READY = """
+from time import perf_counter, sleep
+from fastapi.testclient import TestClient
+from app.main import app
+start = perf_counter()
+with TestClient(app) as client:
+    while client.get("/ready").status_code != 200:
+        sleep(0.005)
+    print(perf_counter() - start)
+"""
+
+
+def measure(code: str, runs: int) -> list:
+    timings = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-W", "ignore", "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+        timings.append(float(result.stdout.strip().splitlines()[-1]))
+    return timings
+
+
+def report(name: str, timings: list):
+    print(f"{name:<20} min {min(timings) * 1000:8.1f} ms   median {statistics.median(timings) * 1000:8.1f} ms   max {max(timings) * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure app start-up time")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--skip-ready", action="store_true", help="only measure the import, no database needed")
+    args = parser.parse_args()
+
+    report("import app.main", measure(IMPORT, args.runs))
+    if not args.skip_ready:
+        report("lifespan to ready", measure(READY, args.runs))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+import os
+import time
+import pytest
+import psycopg2
+
+#Query-count harness: the app runs against its own database (TEST_DATABASE_NAME, shoeshop_test by default) on the
+#server configured for the app, created and seeded for the session and dropped afterwards.
+#Every test runs twice: unsharded, then with customers sharded over SHARDS more databases (shoeshop_shard0_test, ...)
+#through app.shards.configure, whatever SHARD_DATABASES says.
+#Every test is skipped when the settings or PostgreSQL aren't available.
+
+os.environ["DATABASE_NAME"] = os.environ.get("TEST_DATABASE_NAME", "shoeshop_test")
+os.environ["STAFF_TOKEN"] = STAFF_TOKEN = "staff-token"
+
+PASSWORD = "password"
+
+#rows per relationship, enough that a per-row query shows up in the counts
+SERVICES_PER_CUSTOMER = 4
+ROWS_PER_SERVICE = 3
+VARIANTS_PER_PRODUCT = 4
+
+#customers 1 and 3 (the seeded customer and the doomed one) hash to different shards of three
+SHARDS = 3
+
+
+def _admin_connection(settings):
+    conn = psycopg2.connect(
+        host=settings.database_hostname,
+        port=settings.database_port,
+        database="postgres",
+        user=settings.database_server,
+        password=settings.database_password)
+    conn.autocommit = True
+    return conn
+
+
+def _insert(db, sql: str, values: tuple) -> int:
+    db.cursor.execute(sql + " RETURNING id", values)
+    return db.cursor.fetchone()["id"]
+
+
+#a customer row on the customer's shard, with its id from customer_directory when sharded. Returns (id, shard db)
+def _insert_customer(db, shard_dbs: list, values: tuple) -> tuple:
+    from app.shards import shards
+
+    if not shard_dbs:
+        return _insert(db, "INSERT INTO customers (name, email, password, address) VALUES (%s, %s, %s, %s)", values), db
+    customer_id = _insert(db, "INSERT INTO customer_directory (email) VALUES (%s)", (values[1],))
+    shard_db = shard_dbs[shards.index(customer_id)]
+    _insert(shard_db, "INSERT INTO customers (id, name, email, password, address) VALUES (%s, %s, %s, %s, %s)", (customer_id,) + values)
+    return customer_id, shard_db
+
+
+#ids the routes are called with, see test_query_counts.ROUTES. shard_dbs: a connection to every customer shard, if sharded
+def seed(db, shard_dbs: list = None) -> dict:
+    from app.utils import hash
+    from app.oauth2 import issue_refresh_token
+
+    password = hash(PASSWORD)
+    ids = {}
+
+    products = [
+        _insert(db, "INSERT INTO products (name, description, price, stock_quantity) VALUES (%s, %s, %s, %s)",
+                (f"Product {n}", "Leather shoe", 100 + n, 10))
+        for n in range(4)
+    ]
+    variants = {
+        product: [
+            _insert(db, "INSERT INTO product_variants (product_id, size, color, stock_quantity) VALUES (%s, %s, %s, %s)",
+                    (product, str(38 + n), "black", 5))
+            for n in range(VARIANTS_PER_PRODUCT)
+        ]
+        for product in products
+    }
+    ids["product"], ids["product_doomed"] = products[0], products[-1]
+    ids["variant"], ids["variant_doomed"] = variants[products[0]][0], variants[products[0]][-1]
+    ids["variant_ids"] = ",".join(str(variant) for variant in variants[products[0]])
+
+    customer_dbs = dict(
+        _insert_customer(db, shard_dbs, (f"Customer {n}", f"customer{n}@example.com", password, f"{n} Main Street"))
+        for n in range(3)
+    )
+    customers = list(customer_dbs)
+    ids["customer"], ids["customer_doomed"] = customers[0], customers[-1]
+    ids["customer_ids"] = ",".join(str(customer) for customer in customers)
+    ids["email"], ids["email_doomed"] = "customer0@example.com", "customer2@example.com"
+
+    #services of the first customer by type, with their items or repairs
+    services = {"sale": [], "repair": []}
+    children = {}
+    for customer, customer_db in customer_dbs.items():
+        for n in range(SERVICES_PER_CUSTOMER):
+            kind = "sale" if n % 2 == 0 else "repair"
+            service = _insert(customer_db, "INSERT INTO service_requests (total_cost, type, customer_id) VALUES (%s, %s, %s)", (50, kind, customer))
+            if kind == "sale":
+                rows = [
+                    _insert(customer_db, "INSERT INTO item_requests (product_variant_id, quantity, unit_price, service_id) VALUES (%s, %s, %s, %s)",
+                            (variants[products[i % len(products)]][i // len(products)], 1, 100, service))
+                    for i in range(ROWS_PER_SERVICE)
+                ]
+            else:
+                rows = [
+                    _insert(customer_db, "INSERT INTO repairs (description, status, service_id) VALUES (%s, %s, %s)", ("Resole", "pending", service))
+                    for _ in range(ROWS_PER_SERVICE)
+                ]
+            if customer == customers[0]:
+                services[kind].append(service)
+                children[service] = rows
+
+    #the first service of each type is read and updated, the second one deleted
+    ids["sale_service"], ids["sale_service_doomed"] = services["sale"][0], services["sale"][-1]
+    ids["repair_service"], ids["repair_service_doomed"] = services["repair"][0], services["repair"][-1]
+    ids["item"], ids["item_doomed"] = children[ids["sale_service"]][0], children[ids["sale_service"]][-1]
+    ids["repair"], ids["repair_doomed"] = children[ids["repair_service"]][0], children[ids["repair_service"]][-1]
+
+    #a variant the main sale doesn't have yet, for creating an item
+    ids["variant_free"] = variants[products[-2]][-1]
+
+    ids["refresh_token"] = issue_refresh_token(customer_dbs[customers[0]], customers[0])
+    ids["logout_token"] = issue_refresh_token(customer_dbs[customers[0]], customers[0])
+    for connection in [db] + (shard_dbs or []):
+        connection.conn.commit()
+    return ids
+
+
+def shard_names(database_name: str) -> list:
+    return [f"{database_name[:-len('_test')]}_shard{n}_test" for n in range(SHARDS)]
+
+
+@pytest.fixture(scope="session", params=["unsharded", "sharded"])
+def database(request):
+    try:
+        from app.config import settings
+    except Exception as e:
+        pytest.skip(f"app settings are not configured: {e}")
+    if not settings.database_name.endswith("_test"):
+        pytest.skip(f"refusing to recreate {settings.database_name}, test database names end with _test")
+
+    try:
+        admin = _admin_connection(settings)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"PostgreSQL is not available: {e}")
+
+    sharded = request.param == "sharded"
+    names = [settings.database_name] + (shard_names(settings.database_name) if sharded else [])
+    with admin.cursor() as cursor:
+        for name in names:
+            cursor.execute(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+            cursor.execute(f'CREATE DATABASE "{name}"')
+
+    from app.database import Database
+    from app.shards import shards, create_tables
+    from app.routers.analytics import cache
+    shards.configure(",".join(names[1:]) if sharded else None)
+    cache.clear()
+    create_tables()
+    db = Database()
+    shard_dbs = [Database(target=source.target) for source in shards.pools] if sharded else None
+    try:
+        yield {**seed(db, shard_dbs), "sharded": sharded}
+    finally:
+        for connection in [db] + (shard_dbs or []):
+            connection.conn.close()
+        shards.close()
+        shards.configure(None)
+        with admin.cursor() as cursor:
+            for name in names:
+                cursor.execute(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+        admin.close()
+
+
+@pytest.fixture(scope="session")
+def client(database):
+    from fastapi.testclient import TestClient
+    from app.main import app
+    from app.shards import shards
+
+    with TestClient(app) as client:
+        while not all(source.warm for source in shards.all_pools()):
+            time.sleep(0.05)
+        yield client
+
+
+@pytest.fixture(scope="session")
+def tokens(client, database) -> dict:
+    tokens = {}
+    for user, email in (("customer", database["email"]), ("customer_doomed", database["email_doomed"])):
+        response = client.post("/login", data={"username": email, "password": PASSWORD})
+        tokens[user] = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    tokens["staff"] = {"X-Staff-Token": STAFF_TOKEN}
+    return tokens
+
+
+#statement shapes executed while the test runs, in order
+@pytest.fixture
+def queries(monkeypatch) -> list:
+    from app.database import QueryStats, statement_shape
+
+    executed = []
+    record = QueryStats.record
+
+    def recording(self, query, duration: float):
+        executed.append(statement_shape(query))
+        record(self, query, duration)
+
+    monkeypatch.setattr(QueryStats, "record", recording)
+    return executed
@@ -0,0 +1,145 @@
+from collections import Counter
+import pytest
+
+#Upper bound of SQL statements per request for every route. The seeded lists have several rows per relationship
+#(see conftest.py), so a query run per row breaks the bound. When a change legitimately needs another statement,
+#raise the bound here in the same commit.
+
+C = "/customers/{customer}"
+SALE = C + "/services/{sale_service}"
+REPAIR = C + "/services/{repair_service}"
+P = "/products/{product}"
+
+#(method, path, request kwargs, statements, user). Runs in this order: reads, writes, deletes
+ROUTES = [
+    ("GET", "/customers/", {}, 2, "customer"),
+    ("GET", "/customers/?limit=2", {}, 5, "customer"),
+    ("GET", "/customers/?ids={customer_ids}", {}, 2, "customer"),
+    ("POST", "/customers/batch", {"json": {"ids": [1, 2, 3]}}, 2, "customer"),
+    ("GET", C, {}, 2, "customer"),
+    ("GET", C + "/services/", {}, 4, "customer"),
+    ("GET", C + "/services/?limit=2", {}, 6, "customer"),
+    ("GET", SALE, {}, 5, "customer"),
+    ("GET", SALE + "/items/", {}, 4, "customer"),
+    ("GET", SALE + "/items/{item}", {}, 4, "customer"),
+    ("GET", REPAIR + "/repairs/", {}, 4, "customer"),
+    ("GET", REPAIR + "/repairs/{repair}", {}, 4, "customer"),
+    ("GET", "/products/", {}, 2, "customer"),
+    ("GET", "/products/?limit=2", {}, 5, "customer"),
+    ("POST", "/products/batch", {"json": {"ids": [1, 2, 3, 4]}}, 2, "customer"),
+    ("GET", P, {}, 2, "customer"),
+    ("GET", P + "/variants/", {}, 2, "customer"),
+    ("GET", P + "/variants/?ids={variant_ids}", {}, 3, "customer"),
+    ("GET", P + "/variants/{variant}", {}, 3, "customer"),
+    ("POST", "/products/variants/batch", {"json": {"ids": [1, 2, 3, 4, 5, 6]}}, 2, "customer"),
+    ("GET", "/repairs/queue/", {}, 2, "staff"),
+    ("GET", "/analytics/repairs/turnaround", {}, 1, "customer"),
+    ("GET", "/analytics/repairs/throughput", {}, 1, "customer"),
+    ("GET", "/analytics/repairs/backlog", {}, 1, "customer"),
+    ("GET", "/health", {}, 0, "customer"),
+    ("GET", "/ready", {}, 0, "customer"),
+    ("GET", "/metrics", {}, 0, "customer"),
+
+    ("POST", "/login", {"data": {"username": "{email}", "password": "password"}}, 3, None),
+    ("POST", "/login/refresh", {"json": {"refresh_token": "{refresh_token}"}}, 3, None),
+    ("POST", "/logout", {"json": {"refresh_token": "{logout_token}"}}, 1, "customer"),
+    ("POST", "/customers/", {"json": {"name": "New", "email": "new@example.com", "password": "password", "address": "1 Road"}}, 1, None),
+    ("PUT", C, {"json": {"name": "Customer 0", "email": "{email}", "password": "password", "address": "2 Road"}}, 3, "customer"),
+    ("PATCH", C, {"json": {"address": "3 Road"}}, 2, "customer"),
+    ("POST", C + "/services/", {"json": {"type": "sale"}}, 5, "customer"),
+    ("PUT", SALE, {"json": {"total_cost": 80, "type": "sale"}}, 4, "customer"),
+    ("PATCH", SALE, {"json": {"total_cost": 90}}, 4, "customer"),
+    ("POST", SALE + "/items/", {"json": {"product_variant_id": "{variant_free}", "quantity": 1, "unit_price": 10}}, 5, "customer"),
+    ("PUT", SALE + "/items/{item}", {"json": {"product_variant_id": "{variant}", "quantity": 2, "unit_price": 10}}, 5, "customer"),
+    ("PATCH", SALE + "/items/{item}", {"json": {"quantity": 3}}, 5, "customer"),
+    ("POST", REPAIR + "/repairs/", {"json": {"description": "Stitching", "status": "pending"}}, 5, "customer"),
+    ("PUT", REPAIR + "/repairs/{repair}", {"json": {"description": "Resole", "status": "in_progress"}}, 7, "customer"),
+    ("PATCH", REPAIR + "/repairs/{repair}", {"json": {"status": "completed"}}, 7, "customer"),
+    ("POST", "/repairs/queue/claim", {}, 3, "staff"),
+    ("POST", "/products/", {"json": {"name": "New", "description": "Shoe", "price": 10, "stock_quantity": 1}}, 1, None),
+    ("PUT", P, {"json": {"name": "Product 0", "description": "Shoe", "price": 99, "stock_quantity": 3}}, 2, None),
+    ("PATCH", P, {"json": {"price": 98}}, 2, None),
+    ("POST", P + "/variants/", {"json": {"size": "47", "color": "red", "stock_quantity": 1}}, 3, None),
+    ("PUT", P + "/variants/{variant}", {"json": {"size": "38", "color": "black", "stock_quantity": 7}}, 3, None),
+    ("PATCH", P + "/variants/{variant}", {"json": {"stock_quantity": 8}}, 3, None),
+    ("POST", "/products/stock-sync", {"json": [{"product_id": "{product}", "size": "38", "color": "black", "stock_quantity": n} for n in (1,)]
+                                      + [{"product_id": "{product}", "size": "50", "color": "blue", "stock_quantity": 2}]}, 2, None),
+
+    ("DELETE", SALE + "/items/{item_doomed}", {}, 3, "customer"),
+    ("DELETE", REPAIR + "/repairs/{repair_doomed}", {}, 4, "customer"),
+    ("DELETE", C + "/services/{sale_service_doomed}", {}, 1, "customer"),
+    ("DELETE", P + "/variants/{variant_doomed}", {}, 2, None),
+    ("DELETE", "/products/{product_doomed}", {}, 1, None),
+    ("DELETE", "/customers/{customer_doomed}", {}, 1, "customer_doomed"),
+]
+
+#Bounds with customers sharded over conftest.SHARDS databases, where they differ: lists across customers run their
+#statements on every shard that has rows, logins and customer writes also read or write customer_directory
+SHARDED_BOUNDS = {
+    ("GET", "/customers/"): 5,
+    ("GET", "/customers/?limit=2"): 8,
+    ("GET", "/customers/?ids={customer_ids}"): 4,
+    ("POST", "/customers/batch"): 4,
+    ("GET", "/repairs/queue/"): 5,
+    ("GET", "/analytics/repairs/turnaround"): 3,
+    ("GET", "/analytics/repairs/throughput"): 3,
+    ("GET", "/analytics/repairs/backlog"): 3,
+    ("POST", "/login"): 4,
+    ("POST", "/customers/"): 2,
+    ("PUT", C): 4,
+    ("POST", "/repairs/queue/claim"): 6,
+    ("DELETE", "/customers/{customer_doomed}"): 2,
+}
+
+#streams: the statements run outside the request (COPY in its own thread, LISTEN on a dedicated connection)
+NOT_COUNTED = {
+    ("GET", "/exports/sales.csv"),
+    ("GET", "/exports/repairs.csv"),
+    ("GET", "/repairs/events"),
+    ("GET", "/customers/{customer_id}/repairs/events"),
+    ("GET", "/customers/{customer_id}/services/{service_id}/repairs/events"),
+}
+
+
+def _fill(value, ids: dict):
+    if isinstance(value, str):
+        filled = value.format(**ids)
+        return int(filled) if value.startswith("{") and filled.isdigit() else filled
+    if isinstance(value, dict):
+        return {key: _fill(item, ids) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_fill(item, ids) for item in value]
+    return value
+
+
+def _report(method: str, path: str, executed: list, bound: int) -> str:
+    lines = [f"{method} {path} ran {len(executed)} statements, at most {bound} expected:"]
+    lines += [f"  {count}x {shape}" for shape, count in Counter(executed).most_common()]
+    return "\n".join(lines)
+
+
+@pytest.mark.parametrize("method, path, kwargs, bound, user", ROUTES, ids=[f"{method} {path.split('?')[0]}{'?' if '?' in path else ''}" for method, path, *_ in ROUTES])
+def test_query_count(client, database, tokens, queries, method, path, kwargs, bound, user):
+    if database["sharded"]:
+        bound = SHARDED_BOUNDS.get((method, path), bound)
+    path = path.format(**database)
+    response = client.request(method, path, headers=tokens.get(user, {}), **_fill(kwargs, database))
+    assert response.status_code < 400, f"{method} {path}: {response.status_code} {response.text}"
+    assert len(queries) <= bound, _report(method, path, queries, bound)
+
+
+#a new endpoint needs a bound here
+def test_every_route_has_a_bound(client):
+    covered = {(method, path.split("?")[0]) for method, path, *_ in ROUTES}
+    templates = {
+        "{customer}": "{customer_id}", "{sale_service}": "{service_id}", "{repair_service}": "{service_id}", "{product}": "{product_id}",
+        "{item}": "{item_id}", "{repair}": "{repair_id}", "{variant}": "{variant_id}", "{customer_doomed}": "{customer_id}",
+        "{sale_service_doomed}": "{service_id}", "{item_doomed}": "{item_id}", "{repair_doomed}": "{repair_id}",
+        "{variant_doomed}": "{variant_id}", "{product_doomed}": "{product_id}",
+    }
+    for placeholder, parameter in templates.items():
+        covered = {(method, path.replace(placeholder, parameter)) for method, path in covered}
+
+    routes = {(method.upper(), path) for path, operations in client.app.openapi()["paths"].items() for method in operations}
+    assert routes - covered - NOT_COUNTED == set()
+    assert set(SHARDED_BOUNDS) - {(method, path) for method, path, *_ in ROUTES} == set()
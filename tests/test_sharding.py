@@ -0,0 +1,212 @@
+import asyncio
+import csv
+import io
+import json
+import pytest
+
+#Flows that cross shards, run in the sharded session of conftest.database only: customers on every shard,
+#customer_directory keeping emails unique, lists and the queue merged from every shard, and the dotted event ids
+#of the shop-wide stream. The app is imported in the tests, like conftest.py does, so a missing configuration skips them.
+
+PASSWORD = "password"
+
+
+@pytest.fixture
+def sharded(database):
+    if not database["sharded"]:
+        pytest.skip("customers are not sharded in this run")
+
+
+def create_customer(client, email: str) -> dict:
+    response = client.post("/customers/", json={"name": "Sharded", "email": email, "password": PASSWORD, "address": "1 Road"})
+    assert response.status_code == 201, response.text
+    return response.json()
+
+
+def login(client, email: str) -> dict:
+    response = client.post("/login", data={"username": email, "password": PASSWORD})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def bearer(token: dict) -> dict:
+    return {"Authorization": f"Bearer {token['access_token']}"}
+
+
+#a new customer on every shard: {shard: customer}
+@pytest.fixture(scope="module")
+def customers(client, database) -> dict:
+    from app.shards import shards
+
+    if not database["sharded"]:
+        return {}
+    customers = {}
+    for n in range(30):
+        customer = create_customer(client, f"sharded{n}@example.com")
+        customers.setdefault(shards.index(customer["id"]), customer)
+        if len(customers) == len(shards.pools):
+            return customers
+    pytest.fail(f"no customer created on some of {len(shards.pools)} shards")
+
+
+def create_repair(client, customer: dict) -> dict:
+    headers = bearer(login(client, customer["email"]))
+    service = client.post(f"/customers/{customer['id']}/services/", json={"type": "repair"}, headers=headers)
+    assert service.status_code == 201, service.text
+    repair = client.post(f"/customers/{customer['id']}/services/{service.json()['id']}/repairs/",
+                         json={"description": "Heel", "status": "pending"}, headers=headers)
+    assert repair.status_code == 201, repair.text
+    return repair.json()
+
+
+def test_customers_of_every_shard_log_in_and_refresh(client, sharded, customers):
+    from app.shards import shards
+
+    for shard, customer in customers.items():
+        found = shards.scatter(lambda db, index: db.cursor.execute("SELECT id FROM customers WHERE id = %s", (customer["id"],))
+                               or db.cursor.fetchone() is not None)
+        assert found == [index == shard for index in range(len(shards.pools))]
+
+        token = login(client, customer["email"])
+        assert token["customer_id"] == customer["id"]
+        assert client.patch(f"/customers/{customer['id']}", json={"address": "2 Road"}, headers=bearer(token)).status_code == 200
+
+        refreshed = client.post("/login/refresh", json={"refresh_token": token["refresh_token"]})
+        assert refreshed.status_code == 200, refreshed.text
+        assert refreshed.json()["customer_id"] == customer["id"]
+        assert client.patch(f"/customers/{customer['id']}", json={"address": "3 Road"}, headers=bearer(refreshed.json())).status_code == 200
+
+
+def test_email_is_unique_across_shards(client, sharded, customers):
+    from app.database import session
+    from app.shards import shards
+
+    for customer in customers.values():
+        response = client.post("/customers/", json={"name": "Copy", "email": customer["email"], "password": "other", "address": "2 Road"})
+        assert response.status_code >= 400
+
+        with session(shards.all_pools()[0]) as db:
+            db.cursor.execute("SELECT count(*) AS total FROM customer_directory WHERE email = %s", (customer["email"],))
+            assert db.cursor.fetchone()["total"] == 1
+        rows = shards.scatter(lambda db, shard: db.cursor.execute("SELECT count(*) AS total FROM customers WHERE email = %s",
+                                                                  (customer["email"],)) or db.cursor.fetchone()["total"])
+        assert sum(rows) == 1
+        assert login(client, customer["email"])["customer_id"] == customer["id"]
+
+
+def test_customer_pages_merge_every_shard(client, sharded, customers):
+    from app.shards import shards
+
+    #without ?limit the rows come in no particular order, pages are in id order
+    everyone = sorted(customer["id"] for customer in client.get("/customers/").json())
+    assert {shards.index(customer) for customer in everyone} == set(range(len(shards.pools)))
+
+    paged = []
+    for offset in range(0, len(everyone) + 2, 2):
+        response = client.get(f"/customers/?limit=2&offset={offset}&count=exact")
+        assert response.status_code == 200
+        assert int(response.headers["X-Total-Count"]) == len(everyone)
+        paged += [customer["id"] for customer in response.json()]
+    assert paged == everyone
+
+
+def test_claim_takes_the_oldest_pending_repair_of_every_shard(client, sharded, customers, tokens):
+    from app.database import session
+    from app.shards import shards
+
+    #the seeded customers aren't on the last new customer's shard, its repair is made the oldest one
+    shard, customer = max(customers.items())
+    repair = create_repair(client, customer)
+    with session(shards.pools[shard]) as db:
+        db.cursor.execute("UPDATE repairs SET created_at = '2000-01-01' WHERE id = %s", (repair["id"],))
+        db.conn.commit()
+
+    assert client.get("/repairs/queue/", headers=tokens["customer"]).status_code == 403
+    assert client.post("/repairs/queue/claim", headers=tokens["customer"]).status_code == 403
+    queue = client.get("/repairs/queue/?status=pending", headers=tokens["staff"]).json()
+    assert queue[0]["id"] == repair["id"]
+    assert {shards.index(repair["service"]["customer_id"]) for repair in queue} > {shard}
+
+    claimed = client.post("/repairs/queue/claim", headers=tokens["staff"])
+    assert claimed.status_code == 200, claimed.text
+    assert claimed.json()["id"] == repair["id"]
+    assert claimed.json()["status"] == "in_progress"
+    assert client.get("/repairs/queue/?status=pending", headers=tokens["staff"]).json()[0]["id"] != repair["id"]
+
+
+class Disconnected:
+    async def is_disconnected(self) -> bool:
+        return True
+
+
+#(id, event) of the shop-wide stream's backlog after last_event_id
+def replay(last_event_id: str) -> list:
+    from app.routers.events import stream
+
+    async def collect() -> list:
+        return [chunk async for chunk in stream(Disconnected(), last_event_id)]
+
+    events = []
+    for chunk in asyncio.run(collect()):
+        fields = dict(line.split(": ", 1) for line in chunk.strip().split("\n") if not line.startswith(":"))
+        if "id" in fields:
+            events.append((fields["id"], json.loads(fields["data"])))
+    return events
+
+
+def test_shop_events_resume_from_a_dotted_last_event_id(client, sharded, customers):
+    from app.shards import shards
+    from app.routers.events import latest_positions
+
+    start = ".".join(map(str, latest_positions()))
+    repairs = [create_repair(client, customer)["id"] for customer in customers.values()]
+
+    events = replay(start)
+    assert [event["repair_id"] for _, event in events] == repairs
+    for event_id, _ in events:
+        assert len(event_id.split(".")) == len(shards.pools)
+    assert events[-1][0] == ".".join(map(str, latest_positions()))
+
+    #every event after the one a client got to, none before it
+    assert replay(events[0][0]) == events[1:]
+    assert replay(events[-1][0]) == []
+
+
+def test_rename_failing_on_the_shard_keeps_the_directory_email(client, sharded, customers):
+    from app.database import session
+    from app.shards import shards
+
+    shard, customer = min(customers.items())
+    token = login(client, customer["email"])
+    with session(shards.pools[shard]) as db:
+        db.cursor.execute(
+            "CREATE FUNCTION reject_rename() RETURNS trigger LANGUAGE plpgsql AS "
+            "$$ BEGIN RAISE EXCEPTION 'rename rejected'; END $$; "
+            "CREATE CONSTRAINT TRIGGER reject_rename AFTER UPDATE OF email ON customers "
+            "DEFERRABLE INITIALLY DEFERRED FOR EACH ROW EXECUTE FUNCTION reject_rename()"
+        )
+        db.conn.commit()
+    try:
+        response = client.patch(f"/customers/{customer['id']}", json={"email": "renamed@example.com"}, headers=bearer(token))
+        assert response.status_code == 500
+    finally:
+        with session(shards.pools[shard]) as db:
+            db.cursor.execute("DROP TRIGGER reject_rename ON customers; DROP FUNCTION reject_rename()")
+            db.conn.commit()
+
+    assert login(client, customer["email"])["customer_id"] == customer["id"]
+    assert client.post("/login", data={"username": "renamed@example.com", "password": PASSWORD}).status_code == 403
+
+
+def test_sales_export_has_the_items_of_every_shard(client, sharded, tokens):
+    from app.shards import shards
+
+    assert client.get("/exports/sales.csv", headers=tokens["customer"]).status_code == 403
+    response = client.get("/exports/sales.csv", headers=tokens["staff"])
+    assert response.status_code == 200
+    rows = list(csv.reader(io.StringIO(response.text)))
+    assert rows[0][0] == "item_id"
+    assert sum(row[0] == "item_id" for row in rows) == 1
+
+    items = shards.scatter(lambda db, shard: db.cursor.execute("SELECT id FROM item_requests") or db.cursor.fetchall())
+    assert sorted(int(row[0]) for row in rows[1:]) == sorted(item["id"] for shard_items in items for item in shard_items)